@@ -0,0 +1,273 @@
+# ----------------------------------------------------------------------------
+# benchmark_sample_matrix.py
+# Author: Antoine Beauchamp
+# Created: October 17th, 2026
+
+"""
+Benchmark the fast AHBA probe selection and normalization methods.
+
+Description
+-----------
+This is a script to compare the multi-threaded implementations of
+differential stability probe selection and scaled robust sigmoid
+normalization in fast_processing.py against the abagen
+implementations used by build_sample_matrix.py. Both are run on the
+same prepared samples and probes. The run time of each step and the
+maximal absolute difference between the outputs are reported. The
+script exits with an error if the outputs differ by more than the
+tolerance.
+"""
+
+
+# Packages -------------------------------------------------------------------
+
+import argparse
+import os
+import sys
+import time
+import abagen
+import numpy as np
+import pandas as pd
+from build_sample_matrix import (load_microarray_cache, prepare_samples,
+                                 get_selected_probes, normalize_microarray)
+
+
+# Command line arguments -----------------------------------------------------
+
+def parse_args():
+
+    """Parse command line arguments"""
+
+    parser = argparse.ArgumentParser(
+        formatter_class = argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        '--datadir',
+        type = str,
+        default = 'data/',
+        help = ("Directory containing the AHBA data sets. If the data are not "
+                "found, they will be downloaded.")
+    )
+
+    parser.add_argument(
+        '--ibf-threshold',
+        type = float,
+        default = 0.5,
+        help = ("Threshold for intensity-based filtering.")
+    )
+
+    parser.add_argument(
+        '--nthreads',
+        type = int,
+        help = ("Number of threads used by the fast methods. Defaults to "
+                "the number of CPUs.")
+    )
+
+    parser.add_argument(
+        '--repeats',
+        type = int,
+        default = 3,
+        help = ("Number of times each step is timed. The fastest time is "
+                "reported.")
+    )
+
+    parser.add_argument(
+        '--cache',
+        type = str,
+        default = 'false',
+        choices = ['true', 'false'],
+        help = ("Option to load the microarray tables from the binary "
+                "cache, creating it if needed. The abagen methods then "
+                "compute in float32, so that a larger --tolerance is "
+                "needed.")
+    )
+
+    parser.add_argument(
+        '--tolerance',
+        type = float,
+        default = 1e-6,
+        help = ("Maximal absolute difference allowed between the outputs "
+                "of the fast and abagen methods. The script exits with an "
+                "error if it is exceeded.")
+    )
+
+    parser.add_argument(
+        '--outfile',
+        type = str,
+        help = ("Optional .csv file in which to save the results.")
+    )
+
+    args = vars(parser.parse_args())
+
+    return args
+
+
+# Functions ------------------------------------------------------------------
+
+def time_function(func, repeats = 3, **kwargs):
+
+    """
+    Time a function
+
+    Arguments
+    ---------
+    func: callable
+        Function to time.
+    repeats: int
+        Number of times to run the function. (default 3)
+    **kwargs
+        Arguments passed to the function.
+
+    Returns
+    -------
+    result: object
+        Output of the last run.
+    seconds: float
+        Fastest run time in seconds.
+    """
+
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        result = func(**kwargs)
+        times.append(time.perf_counter() - start)
+
+    return result, min(times)
+
+
+def compare_expression(reference, expression):
+
+    """
+    Compare two sets of expression data frames
+
+    Description
+    -----------
+    Values that are missing in only one of the data frames differ by
+    an infinite amount. If the donors or the row and column labels of
+    the data frames differ, the maximal difference is infinite.
+
+    Arguments
+    ---------
+    reference: dict
+        Reference expression data frames for each donor.
+    expression: dict
+        Expression data frames to compare.
+
+    Returns
+    -------
+    comparison: dict
+        Whether the labels and the missing values are identical, and
+        maximal absolute difference between the values.
+    """
+
+    comparison = {'identical_labels': reference.keys() == expression.keys(),
+                  'identical_missing': True,
+                  'max_diff': 0.0}
+    for donor, ref in reference.items():
+        exp = expression.get(donor)
+        if ((exp is None) or not (ref.index.equals(exp.index) and
+                                  ref.columns.equals(exp.columns))):
+            comparison['identical_labels'] = False
+            continue
+        ref = ref.to_numpy(dtype = 'float64')
+        exp = exp.to_numpy(dtype = 'float64')
+        missing = np.isnan(ref)
+        if not np.array_equal(missing, np.isnan(exp)):
+            comparison['identical_missing'] = False
+        diff = np.where(missing & np.isnan(exp), 0, np.abs(ref - exp))
+        if diff.size > 0:
+            diff = np.nan_to_num(diff, nan = np.inf)
+            comparison['max_diff'] = max(comparison['max_diff'], 
+                                         float(diff.max()))
+
+    if not comparison['identical_labels']:
+        comparison['max_diff'] = np.inf
+
+    return comparison
+
+
+# Main -----------------------------------------------------------------------
+
+def main():
+
+    #Parse command line arguments
+    args = parse_args()
+    datadir = os.path.join(args['datadir'], '')
+    nthreads = args['nthreads']
+    repeats = args['repeats']
+    outfile = args['outfile']
+
+    #Fetch AHBA files, downloading if needed
+    files = abagen.fetch_microarray(data_dir = datadir, donors = 'all',
+                                    verbose = 0)
+    if args['cache'] == 'true':
+        files = load_microarray_cache(files = files)
+
+    print("Preparing samples...")
+    annotation, probes, _ = prepare_samples(
+        files = files,
+        ibf_threshold = args['ibf_threshold']
+    )
+
+    results = []
+
+    #Probe selection
+    selected = {}
+    for method in ['diff_stability', 'fast_diff_stability']:
+        print("Timing {} probe selection...".format(method))
+        selected[method], seconds = time_function(
+            get_selected_probes,
+            repeats = repeats,
+            files = files,
+            annotation = annotation,
+            probes = probes,
+            probe_selection = method,
+            nthreads = nthreads,
+            verbose = False
+        )
+        results.append({'step': 'probe_selection',
+                        'method': method,
+                        'seconds': seconds})
+
+    results[-1].update(compare_expression(selected['diff_stability'],
+                                          selected['fast_diff_stability']))
+
+    #Normalization of the same probe-selected data
+    normalized = {}
+    for method in ['srs', 'fast_srs']:
+        print("Timing {} normalization...".format(method))
+        normalized[method], seconds = time_function(
+            normalize_microarray,
+            repeats = repeats,
+            microarray = selected['diff_stability'],
+            sample_norm = method,
+            gene_norm = method,
+            nthreads = nthreads
+        )
+        results.append({'step': 'normalization',
+                        'method': method,
+                        'seconds': seconds})
+
+    results[-1].update(compare_expression(normalized['srs'],
+                                          normalized['fast_srs']))
+
+    results = pd.DataFrame(results)
+    results['speedup'] = (results.groupby('step')['seconds']
+                          .transform('first') / results['seconds'])
+    print(results.to_string(index = False))
+
+    if outfile is not None:
+        results.to_csv(outfile, index = False)
+
+    #Fail if the fast methods differ from abagen
+    failed = results.loc[results['max_diff'] > args['tolerance'], 'method']
+    if len(failed) > 0:
+        sys.exit("Outputs of {} differ from abagen by more than {}."
+                 .format(', '.join(failed), args['tolerance']))
+
+    return
+
+
+if __name__=='__main__':
+    main()
@@ -11,6 +11,12 @@ Description
 This is a script to process the Allen Human Brain Atlas microarray gene 
 expression data and build a gene-by-sample expression matrix. 
 The processing steps are implemented using the abagen package.
+With --cache true, the binary cache of the microarray tables written 
+by download_AHBA.py is used in place of the CSV files. Since the cache 
+stores expression values in float32, the results then match those of 
+abagen to float32 precision. With --cache-results true, intermediate 
+results of the pipeline are cached so that they can be reused by runs
+with different parameters.
 """
 
 
@@ -18,8 +24,19 @@ The processing steps are implemented using the abagen package.
 
 import argparse
 import os
+import json
+import hashlib
 import abagen
+import numpy as np
 import pandas as pd
+import nibabel as nib
+from abagen             import correct, images, io, probes_, samples_
+from abagen.utils       import first_entry, flatten_dict
+import fast_processing
+from concurrent.futures import ThreadPoolExecutor
+from download_AHBA      import (is_cache_valid, write_microarray_cache,
+                                read_microarray_cache, read_manifest,
+                                checksum_file)
 
 
 # Command line arguments -----------------------------------------------------
@@ -36,7 +53,7 @@ def parse_args():
         '--datadir',
         type = str,
         default = 'data/',
-        help = ("Directory containing the AHBA data sets. If the data are not ",
+        help = ("Directory containing the AHBA data sets. If the data are not "
                 "found, they will be downloaded.")
     )
     
@@ -65,7 +82,9 @@ def parse_args():
         '--probe-selection',
         type = str,
         default = 'diff_stability',
-        help = ("Method used to subset multiple probes.")
+        help = ("Method used to subset multiple probes. Use "
+                "'fast_diff_stability' for the multi-threaded "
+                "implementation of 'diff_stability'.")
     )
     
     parser.add_argument(
@@ -85,14 +104,53 @@ def parse_args():
         '--sample-norm',
         type = str,
         default = 'srs',
-        help = ("")
+        help = ("Method used to normalize samples across genes. Use "
+                "'fast_srs' for the multi-threaded implementation of "
+                "'srs'.")
     )
     
     parser.add_argument(
         '--gene-norm',
         type = str,
         default = 'srs',
-        help = ("")
+        help = ("Method used to normalize genes across samples. Use "
+                "'fast_srs' for the multi-threaded implementation of "
+                "'srs'.")
+    )
+
+    parser.add_argument(
+        '--cache',
+        type = str,
+        default = 'false',
+        choices = ['true', 'false'],
+        help = ("Option to load the microarray tables from the float32 "
+                "binary cache, creating it if needed.")
+    )
+
+    parser.add_argument(
+        '--cache-results',
+        type = str,
+        default = 'false',
+        choices = ['true', 'false'],
+        help = ("Option to cache intermediate pipeline results in "
+                "--cachedir, so that runs with different normalization "
+                "methods reuse the filtered and selected probes. Results "
+                "computed from the CSV files and from the binary cache "
+                "are cached separately.")
+    )
+
+    parser.add_argument(
+        '--nthreads',
+        type = int,
+        help = ("Number of threads used by the fast probe selection and "
+                "normalization methods. Defaults to the number of CPUs.")
+    )
+
+    parser.add_argument(
+        '--cachedir',
+        type = str,
+        help = ("Directory in which to cache intermediate pipeline "
+                "results. Defaults to cache/ in --datadir.")
     )
 
     parser.add_argument(
@@ -110,6 +168,40 @@ def parse_args():
 
 # Functions ------------------------------------------------------------------
 
+def read_sample_annotation(data_dir, donor_file_id, donor_id):
+
+    """
+    Import the sample annotations of a donor
+    
+    Arguments
+    ---------
+    data_dir: str
+        Path to directory containing AHBA data sets.
+    donor_file_id: str
+        Donor ID used in the AHBA directory names.
+    donor_id: str
+        Donor ID used in the sample metadata.
+    
+    Returns
+    -------
+    df_sample: pandas.core.frame.DataFrame
+        Dataframe containing the sample metadata for the donor.
+    """
+    
+    donor_dir = 'normalized_microarray_{}'.format(donor_file_id)
+    samplefile = os.path.join(data_dir, donor_dir, 'SampleAnnot.csv')
+    df_sample = pd.read_csv(samplefile)
+    
+    #Sample IDs of the form structure_id-slab_num-well_id
+    df_sample['SampleID'] = (df_sample['structure_id'].astype(str) + '-' +
+                             df_sample['slab_num'].astype(str) + '-' +
+                             df_sample['well_id'].astype(str))
+    
+    df_sample['Donor'] = donor_id
+    
+    return df_sample
+
+
 def get_sample_metadata(data_dir, donors):
 
     """
@@ -129,23 +221,13 @@ def get_sample_metadata(data_dir, donors):
     """
     
     donors = pd.read_csv(donors)
-    sample_data = []
-    for i, row in donors.iterrows():
-        
-        donor_dir = 'normalized_microarray_{}'.format(row['donorFileID'])
-        samplefile = os.path.join(data_dir, donor_dir, 'SampleAnnot.csv')
-        df_sample = pd.read_csv(samplefile)
-    
-        sample_ids = (df_sample
-                      .apply(lambda x: '%s-%s-%s' % (x['structure_id'], 
-                                                     x['slab_num'], 
-                                                     x['well_id']), 
-                             axis = 1))
-        df_sample['SampleID'] = sample_ids
-    
-        df_sample['Donor'] = row['donorID']
     
-        sample_data.append(df_sample)
+    #Import the donor annotations concurrently
+    with ThreadPoolExecutor(max_workers = len(donors)) as executor:
+        sample_data = list(executor.map(read_sample_annotation,
+                                        [data_dir]*len(donors),
+                                        donors['donorFileID'],
+                                        donors['donorID']))
         
     df_samples = pd.concat(sample_data, 
                            axis = 0, 
@@ -154,6 +236,611 @@ def get_sample_metadata(data_dir, donors):
     return df_samples
     
 
+def load_microarray_cache(files, verbose = True):
+
+    """
+    Load the binary cache of the AHBA microarray tables
+    
+    Arguments
+    ---------
+    files: dict
+        Dictionary of AHBA file paths from abagen.fetch_microarray().
+    verbose: bool
+        Verbosity option. (default True)
+    
+    Returns
+    -------
+    tables: dict
+        Copy of `files` in which the microarray, PACall and probe
+        file paths are replaced by memory-mapped data frames.
+    """
+
+    tables = {}
+    for donor, data in files.items():
+        donor_dir = os.path.dirname(data['microarray'])
+        if not is_cache_valid(donor_dir):
+            if verbose:
+                print("Converting microarray data for donor {} to "
+                      "binary cache...".format(donor))
+            write_microarray_cache(donor_dir)
+        tables[donor] = dict(data, **read_microarray_cache(donor_dir))
+
+    return tables
+
+
+def get_table_dtype(files):
+
+    """
+    Get the data type of the AHBA microarray tables
+    
+    Arguments
+    ---------
+    files: dict
+        Dictionary of AHBA files or tables.
+    
+    Returns
+    -------
+    dtype: str
+        Data type of the expression values: 'float64' for the CSV 
+        files, as read by abagen, or the data type of the tables loaded
+        from the binary cache.
+    """
+
+    microarray = first_entry(files, 'microarray')
+    if isinstance(microarray, pd.DataFrame):
+        return str(microarray.dtypes.iloc[0])
+
+    return 'float64'
+
+
+def get_input_checksums(files):
+
+    """
+    Get the checksums of the AHBA input files
+    
+    Description
+    -----------
+    Checksums are taken from the download manifest written by 
+    download_AHBA.py when it has a record for a file of the same size.
+    Other files are checksummed directly.
+    
+    Arguments
+    ---------
+    files: dict
+        Dictionary of AHBA file paths from abagen.fetch_microarray().
+    
+    Returns
+    -------
+    checksums: dict
+        Dictionary with donor IDs as keys and dictionaries of file 
+        checksums as values.
+    """
+
+    manifests = {}
+    checksums = {}
+    for donor, data in files.items():
+        
+        #Manifest in the directory containing the donor directories
+        manifest = os.path.join(os.path.dirname(os.path.dirname(
+            data['microarray'])), 'manifest.csv')
+        if manifest not in manifests:
+            manifests[manifest] = (read_manifest(manifest)
+                                   .query("status == 'complete'")
+                                   .set_index(['donor', 'file']))
+        df_manifest = manifests[manifest]
+        
+        checksums[donor] = {}
+        for key, infile in sorted(data.items()):
+            record = (donor, os.path.basename(infile))
+            if ((record in df_manifest.index) and
+                (df_manifest.loc[record, 'bytes'] == 
+                 os.path.getsize(infile))):
+                checksums[donor][key] = df_manifest.loc[record, 'checksum']
+            else:
+                checksums[donor][key] = checksum_file(infile)
+
+    return checksums
+
+
+def get_cache_key(**kwargs):
+
+    """
+    Get the key of a cached pipeline result
+    
+    Arguments
+    ---------
+    **kwargs
+        Pipeline parameters and input checksums. Values must be 
+        serializable to JSON.
+    
+    Returns
+    -------
+    key: str
+        Hexadecimal SHA-256 digest of the arguments.
+    """
+
+    kwargs = json.dumps(kwargs, sort_keys = True)
+
+    return hashlib.sha256(kwargs.encode()).hexdigest()
+
+
+def read_cache(cachedir, stage, key):
+
+    """
+    Import a cached pipeline result
+    
+    Arguments
+    ---------
+    cachedir: str
+        Path to the cache directory.
+    stage: str
+        Name of the pipeline stage.
+    key: str
+        Key from get_cache_key().
+    
+    Returns
+    -------
+    result: object or None
+        The cached result, or None if it does not exist.
+    """
+
+    cachefile = os.path.join(cachedir, stage, key+'.pkl')
+    if not os.path.isfile(cachefile):
+        return None
+
+    return pd.read_pickle(cachefile)
+
+
+def write_cache(result, cachedir, stage, key):
+
+    """
+    Write a pipeline result to the cache
+    
+    Arguments
+    ---------
+    result: object
+        Result to cache.
+    cachedir: str
+        Path to the cache directory.
+    stage: str
+        Name of the pipeline stage.
+    key: str
+        Key from get_cache_key().
+    
+    Returns
+    -------
+    None
+    """
+
+    cachefile = os.path.join(cachedir, stage, key+'.pkl')
+    os.makedirs(os.path.dirname(cachefile), exist_ok = True)
+    
+    #Write to temporary file so that partial results are never read
+    partfile = '{}.{}.part'.format(cachefile, os.getpid())
+    pd.to_pickle(result, partfile)
+    os.replace(partfile, cachefile)
+
+    return
+
+
+def prepare_samples(files, ibf_threshold = 0.5, sim_threshold = None,
+                    tolerance = 2):
+
+    """
+    Prepare the AHBA samples and probes for probe selection
+    
+    Description
+    -----------
+    Probes are reannotated and filtered by intensity, and the sample
+    coordinates are corrected, following abagen.get_samples_in_mask().
+    Samples are labelled with a mask covering all samples.
+    
+    Arguments
+    ---------
+    files: dict
+        Dictionary of AHBA files or tables.
+    ibf_threshold: float
+        Threshold for intensity-based filtering. (default 0.5)
+    sim_threshold: float
+        Threshold for inter-sample correlation filtering. (default None)
+    tolerance: int
+        Distance tolerance when labelling samples. (default 2)
+    
+    Returns
+    -------
+    annotation: dict
+        Dictionary of sample annotation data frames for each donor.
+    probes: pandas.core.frame.DataFrame
+        Data frame containing the probes that survive filtering.
+    labels: dict
+        Dictionary of sample label data frames for each donor.
+    """
+
+    #Probe information is the same for every donor
+    probes = io.read_probes(first_entry(files, 'probes'))
+    probes = probes_.reannotate_probes(probes)
+    probes = probes.dropna(subset = ['entrez_id'])
+    
+    #Correct sample coordinates and drop mismatched samples
+    coords = []
+    annotation = {}
+    for donor, data in files.items():
+        annot = samples_.update_coords(data['annotation'], 
+                                       corrected_mni = True)
+        coords.append(annot[['mni_x', 'mni_y', 'mni_z']])
+        annot = samples_.drop_mismatch_samples(annot, data['ontology'])
+        if sim_threshold is not None:
+            annot = samples_.similarity_threshold(data['microarray'], 
+                                                  annot, probes,
+                                                  threshold = sim_threshold)
+        annotation[donor] = annot
+        
+    #Label samples using a mask that covers all samples
+    coords = pd.concat(coords).to_numpy()
+    affine = np.eye(4)
+    affine[:-1, -1] = -1 * np.floor(np.max(np.abs(coords), axis = 0))
+    mask = np.ones(np.asarray(-2 * affine[:-1, -1], dtype = int))
+    mask = nib.Nifti1Image(mask, affine = affine)
+    atlas, _ = images.coerce_atlas_to_dict(mask, list(files.keys()))
+    labels = {donor: atlas[donor].label_samples(annot, tolerance)
+              for donor, annot in annotation.items()}
+    
+    #Intensity-based filtering of probes
+    probes = probes_.filter_probes(flatten_dict(files, 'pacall'),
+                                   annotation, probes,
+                                   threshold = ibf_threshold)
+
+    return annotation, probes, labels
+
+
+def normalize_microarray(microarray, sample_norm = 'srs', gene_norm = 'srs',
+                         nthreads = None):
+
+    """
+    Normalize the probe-selected expression data of every donor
+    
+    Arguments
+    ---------
+    microarray: dict
+        Dictionary of sample-by-gene expression data frames for each 
+        donor.
+    sample_norm: str
+        Method used to normalize samples across genes. (default 'srs')
+    gene_norm: str
+        Method used to normalize genes across samples. (default 'srs')
+    nthreads: int
+        Number of threads used by the fast methods. (default None)
+    
+    Returns
+    -------
+    microarray: dict
+        Dictionary of normalized expression data frames for each donor.
+    """
+
+    if sample_norm == 'fast_srs':
+        microarray = fast_processing.normalize_expression(microarray,
+                                                          axis = 1,
+                                                          nthreads = nthreads)
+    elif sample_norm is not None:
+        microarray = {donor: correct.normalize_expression(
+                          micro.T, norm = sample_norm, ignore_warn = True).T
+                      for donor, micro in microarray.items()}
+        
+    if gene_norm == 'fast_srs':
+        microarray = fast_processing.normalize_expression(microarray,
+                                                          axis = 0,
+                                                          nthreads = nthreads)
+    elif gene_norm is not None:
+        microarray = {donor: correct.normalize_expression(
+                          micro, norm = gene_norm, ignore_warn = True)
+                      for donor, micro in microarray.items()}
+
+    return microarray
+
+
+def normalize_samples(microarray, annotation, labels, sample_norm = 'srs',
+                      gene_norm = 'srs', nthreads = None):
+
+    """
+    Normalize the probe-selected expression data of all donors
+    
+    Arguments
+    ---------
+    microarray: dict
+        Dictionary of sample-by-gene expression data frames for each 
+        donor.
+    annotation: dict
+        Dictionary of sample annotation data frames for each donor.
+    labels: dict
+        Dictionary of sample label data frames for each donor.
+    sample_norm: str
+        Method used to normalize samples across genes. (default 'srs')
+    gene_norm: str
+        Method used to normalize genes across samples. (default 'srs')
+    nthreads: int
+        Number of threads used by the fast methods. (default None)
+    
+    Returns
+    -------
+    expression: pandas.core.frame.DataFrame
+        Sample-by-gene expression data frame, indexed by well ID.
+    """
+
+    microarray = normalize_microarray(microarray = microarray,
+                                      sample_norm = sample_norm,
+                                      gene_norm = gene_norm,
+                                      nthreads = nthreads)
+
+    expression = []
+    for donor, micro in microarray.items():
+        micro = (pd.merge(micro, labels[donor], on = 'sample_id')
+                 .set_index('label')
+                 .rename_axis('gene_symbol', axis = 1)
+                 .set_index(annotation[donor]['well_id'], append = True)
+                 .dropna(axis = 1, how = 'any'))
+        expression.append(micro)
+    
+    #Drop samples outside of the mask
+    expression = (pd.concat(expression)
+                  .drop(index = [0], level = 'label', errors = 'ignore')
+                  .droplevel('label'))
+
+    return expression
+
+
+def get_prepared_samples(files, ibf_threshold = 0.5, sim_threshold = None,
+                         cachedir = None, checksums = None, verbose = True):
+
+    """
+    Prepare the AHBA samples and probes, using the cache if possible
+    
+    Arguments
+    ---------
+    files: dict
+        Dictionary of AHBA files or tables.
+    ibf_threshold: float
+        Threshold for intensity-based filtering. (default 0.5)
+    sim_threshold: float
+        Threshold for inter-sample correlation filtering. (default None)
+    cachedir: str
+        Path to the cache directory. (default None)
+    checksums: dict
+        Input checksums from get_input_checksums(). Required to use the
+        cache. (default None)
+    verbose: bool
+        Verbosity option. (default True)
+    
+    Returns
+    -------
+    result: tuple
+        Annotation, probes and labels from prepare_samples().
+    """
+
+    cache = (cachedir is not None) and (checksums is not None)
+    
+    key = get_cache_key(stage = 'samples', version = 1, 
+                        checksums = checksums,
+                        abagen_version = abagen.__version__,
+                        dtype = get_table_dtype(files),
+                        ibf_threshold = ibf_threshold,
+                        sim_threshold = sim_threshold)
+    result = read_cache(cachedir, 'samples', key) if cache else None
+    if result is None:
+        if verbose:
+            print("Filtering probes...")
+        result = prepare_samples(files = files, 
+                                 ibf_threshold = ibf_threshold,
+                                 sim_threshold = sim_threshold)
+        if cache:
+            write_cache(result, cachedir, 'samples', key)
+    elif verbose:
+        print("Using cached filtered probes...")
+
+    return result
+
+
+def get_selected_probes(files, annotation, probes, ibf_threshold = 0.5,
+                        probe_selection = 'diff_stability',
+                        donor_probes = 'aggregate', sim_threshold = None,
+                        cachedir = None, checksums = None, nthreads = None,
+                        verbose = True):
+
+    """
+    Select probes for every gene, using the cache if possible
+    
+    Arguments
+    ---------
+    files: dict
+        Dictionary of AHBA files or tables.
+    annotation: dict
+        Dictionary of sample annotation data frames for each donor.
+    probes: pandas.core.frame.DataFrame
+        Data frame containing the probes that survive filtering.
+    ibf_threshold: float
+        Threshold used for intensity-based filtering. (default 0.5)
+    probe_selection: str
+        Method used to subset multiple probes. (default 'diff_stability')
+    donor_probes: str
+        Method used to select probes across donors. (default 'aggregate')
+    sim_threshold: float
+        Threshold used for inter-sample correlation filtering. 
+        (default None)
+    cachedir: str
+        Path to the cache directory. (default None)
+    checksums: dict
+        Input checksums from get_input_checksums(). Required to use the
+        cache. (default None)
+    nthreads: int
+        Number of threads used by the fast methods. (default None)
+    verbose: bool
+        Verbosity option. (default True)
+    
+    Returns
+    -------
+    microarray: dict
+        Dictionary of sample-by-gene expression data frames for each 
+        donor.
+    """
+
+    cache = (cachedir is not None) and (checksums is not None)
+    
+    key = get_cache_key(stage = 'probes', version = 1, 
+                        checksums = checksums,
+                        abagen_version = abagen.__version__,
+                        dtype = get_table_dtype(files),
+                        ibf_threshold = ibf_threshold,
+                        sim_threshold = sim_threshold,
+                        probe_selection = probe_selection,
+                        donor_probes = donor_probes)
+    microarray = read_cache(cachedir, 'probes', key) if cache else None
+    if microarray is None:
+        if verbose:
+            print("Selecting probes...")
+        if probe_selection == 'fast_diff_stability':
+            if donor_probes != 'aggregate':
+                raise ValueError("fast_diff_stability only supports "
+                                 "donor_probes = 'aggregate'.")
+            microarray = fast_processing.diff_stability(
+                flatten_dict(files, 'microarray'), annotation, probes,
+                nthreads = nthreads
+            )
+        else:
+            microarray = probes_.collapse_probes(flatten_dict(files, 
+                                                              'microarray'),
+                                                 annotation, probes,
+                                                 method = probe_selection,
+                                                 donor_probes = donor_probes)
+        if cache:
+            write_cache(microarray, cachedir, 'probes', key)
+    elif verbose:
+        print("Using cached probe selection...")
+
+    return microarray
+
+
+def get_sample_expression(files, ibf_threshold = 0.5, 
+                          probe_selection = 'diff_stability',
+                          donor_probes = 'aggregate', sim_threshold = None,
+                          sample_norm = 'srs', gene_norm = 'srs',
+                          cachedir = None, checksums = None, nthreads = None,
+                          verbose = True):
+
+    """
+    Build the sample-by-gene expression matrix
+    
+    Description
+    -----------
+    The processing steps are those of abagen.get_samples_in_mask()
+    without a mask. When a cache directory and input checksums are 
+    given, the prepared samples and the probe-selected expression data
+    are cached under keys derived from the parameters of the steps that
+    produced them, the checksums of the input files, the data type of 
+    the microarray tables and the abagen version. Changing only the 
+    normalization methods then reuses the probe-selected data.
+    
+    Arguments
+    ---------
+    files: dict
+        Dictionary of AHBA files or tables.
+    ibf_threshold: float
+        Threshold for intensity-based filtering. (default 0.5)
+    probe_selection: str
+        Method used to subset multiple probes. (default 'diff_stability')
+    donor_probes: str
+        Method used to select probes across donors. (default 'aggregate')
+    sim_threshold: float
+        Threshold for inter-sample correlation filtering. (default None)
+    sample_norm: str
+        Method used to normalize samples across genes. (default 'srs')
+    gene_norm: str
+        Method used to normalize genes across samples. (default 'srs')
+    cachedir: str
+        Path to the cache directory. (default None)
+    checksums: dict
+        Input checksums from get_input_checksums(). Required to use the
+        cache. (default None)
+    nthreads: int
+        Number of threads used by the fast methods. (default None)
+    verbose: bool
+        Verbosity option. (default True)
+    
+    Returns
+    -------
+    expression: pandas.core.frame.DataFrame
+        Sample-by-gene expression data frame, indexed by well ID.
+    """
+
+    annotation, probes, labels = get_prepared_samples(
+        files = files,
+        ibf_threshold = ibf_threshold,
+        sim_threshold = sim_threshold,
+        cachedir = cachedir,
+        checksums = checksums,
+        verbose = verbose
+    )
+    
+    microarray = get_selected_probes(files = files,
+                                     annotation = annotation,
+                                     probes = probes,
+                                     ibf_threshold = ibf_threshold,
+                                     probe_selection = probe_selection,
+                                     donor_probes = donor_probes,
+                                     sim_threshold = sim_threshold,
+                                     cachedir = cachedir,
+                                     checksums = checksums,
+                                     nthreads = nthreads,
+                                     verbose = verbose)
+    
+    if verbose:
+        print("Normalizing expression data...")
+        
+    expression = normalize_samples(microarray = microarray, 
+                                   annotation = annotation, 
+                                   labels = labels,
+                                   sample_norm = sample_norm,
+                                   gene_norm = gene_norm,
+                                   nthreads = nthreads)
+
+    return expression
+
+
+def match_sample_metadata(expression, df_samples):
+
+    """
+    Match the sample expression data and metadata
+    
+    Arguments
+    ---------
+    expression: pandas.core.frame.DataFrame
+        Sample-by-gene expression data frame, indexed by well ID.
+    df_samples: pandas.core.frame.DataFrame
+        Dataframe containing sample metadata.
+    
+    Returns
+    -------
+    expression: pandas.core.frame.DataFrame
+        Gene-by-sample expression data frame, with sample IDs as 
+        columns.
+    df_samples: pandas.core.frame.DataFrame
+        Sample metadata in the order of the expression columns.
+    """
+
+    #Match ordering of expression and metadata using well IDs
+    df_samples = (df_samples
+                  .set_index('well_id', drop = False)
+                  .reindex(index = expression.index))
+    expression = expression.set_axis(df_samples['SampleID'].to_numpy(),
+                                      axis = 0)
+    df_samples = (df_samples
+                  .set_index('SampleID')
+                  .reset_index(level = 'SampleID'))
+    
+    #Transpose expression data
+    expression = expression.transpose().sort_index()
+
+    return expression, df_samples
+
+
 # Main -----------------------------------------------------------------------
 
 def main():
@@ -169,12 +856,18 @@ def main():
     sim_threshold = args['sim_threshold']
     sample_norm = args['sample_norm']
     gene_norm = args['gene_norm']
+    cache = True if args['cache'] == 'true' else False
+    cache_results = True if args['cache_results'] == 'true' else False
+    cachedir = args['cachedir']
+    nthreads = args['nthreads']
     verbose = True if args['verbose'] == 'true' else False
     verbose_int = 1 if verbose else 0
     
     #Format the paths properly
     outdir = os.path.join(outdir, '')
     datadir = os.path.join(datadir, '')
+    if cachedir is None:
+        cachedir = os.path.join(datadir, 'cache', '')
     
     #Create directories if needed
     if not os.path.exists(outdir):
@@ -186,17 +879,54 @@ def main():
     if verbose:
         print("Creating sample expression matrix...")
         
-    #Build sample expression matrix
-    expression, coords = abagen.get_samples_in_mask(mask=None, 
-                                                    data_dir = datadir, 
-                                                    donors = 'all',
-                                                    ibf_threshold = ibf_threshold,
-                                                    probe_selection = probe_selection,
-                                                    donor_probes = donor_probes,
-                                                    sim_threshold = sim_threshold,
-                                                    sample_norm = sample_norm,
-                                                    gene_norm = gene_norm,
-                                                    verbose = verbose_int)
+    #Fast methods are only available in the pipeline of this script
+    fast = ((probe_selection == 'fast_diff_stability') or 
+            ('fast_srs' in [sample_norm, gene_norm]))
+    
+    if cache or cache_results or fast:
+        
+        #Fetch AHBA files, downloading if needed
+        files = abagen.fetch_microarray(data_dir = datadir, 
+                                        donors = 'all',
+                                        verbose = verbose_int)
+        
+        #Checksums of the input files for the keys of cached results
+        checksums = None
+        if cache_results:
+            checksums = get_input_checksums(files = files)
+        
+        #Load microarray tables from binary cache
+        if cache:
+            files = load_microarray_cache(files = files, verbose = verbose)
+        
+        #Build sample expression matrix
+        expression = get_sample_expression(files = files,
+                                           ibf_threshold = ibf_threshold,
+                                           probe_selection = probe_selection,
+                                           donor_probes = donor_probes,
+                                           sim_threshold = sim_threshold,
+                                           sample_norm = sample_norm,
+                                           gene_norm = gene_norm,
+                                           cachedir = cachedir,
+                                           checksums = checksums,
+                                           nthreads = nthreads,
+                                           verbose = verbose)
+        
+    else:
+        
+        #Build sample expression matrix using abagen
+        expression, coords = abagen.get_samples_in_mask(
+            mask = None, 
+            data_dir = datadir, 
+            donors = 'all',
+            ibf_threshold = ibf_threshold,
+            probe_selection = probe_selection,
+            donor_probes = donor_probes,
+            sim_threshold = sim_threshold,
+            sample_norm = sample_norm,
+            gene_norm = gene_norm,
+            verbose = verbose_int
+        )
     
     if verbose:
         print("Getting sample metadata...")
@@ -209,20 +939,8 @@ def main():
         print("Matching sample expression and metadata...")
     
     #Match ordering of expression and metadata
-    expression = (expression
-                  .merge(df_samples.loc[:,['well_id', 'SampleID']],
-                         on = 'well_id', how = 'left')
-                  .drop(labels = 'well_id', axis = 1))
-    
-    df_samples = (df_samples
-                  .set_index('SampleID')
-                  .reindex(index = expression['SampleID'])
-                  .reset_index(level = 'SampleID'))
-    
-    #Transpose expression data
-    expression = expression.set_index('SampleID')
-    expression.index.name = None
-    expression = expression.transpose().sort_index()
+    expression, df_samples = match_sample_metadata(expression = expression,
+                                                   df_samples = df_samples)
     
     if verbose:
         print("Writing sample expression matrix to file...")
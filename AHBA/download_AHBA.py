@@ -10,6 +10,18 @@ Description
 -----------
 This script downloads the microarray data sets from all six donors in the
 AHBA. It also downloads the hierarchical ontology from the AHBA.
+
+The ontology is cached and revalidated against the server on every run.
+If --connections is specified, the donor archives are downloaded
+concurrently, resumed if interrupted, and the extracted files are
+recorded with their sizes and checksums in a manifest. Donors whose
+files match the manifest are skipped.
+
+With --cache true, the microarray expression, PACall and probe tables 
+of every donor are converted once to a binary cache that 
+build_sample_matrix.py --cache true loads as memory-mapped float32 
+arrays instead of parsing the CSV files. build_sample_matrix.py also
+creates the cache when it is first needed.
 """
 
 # Packages -------------------------------------------------------------------
@@ -19,6 +31,16 @@ import argparse
 import abagen
 import requests
 import json
+import hashlib
+import time
+import threading
+import zlib
+import numpy                as np
+import pandas               as pd
+from abagen.datasets.fetchers import WELL_KNOWN_IDS, check_donors
+from concurrent.futures     import ThreadPoolExecutor, as_completed
+from zipfile                import ZipFile, BadZipFile
+from datetime               import datetime
 
 # Command line arguments -----------------------------------------------------
 
@@ -37,6 +59,77 @@ def parse_args():
         help = "Directory in which to download the data"
     )
     
+    parser.add_argument(
+        '--donors',
+        type = str,
+        nargs = '+',
+        default = ['all'],
+        help = ("AHBA donors to download, as donor numbers or UIDs, "
+                "or 'all'.")
+    )
+    
+    parser.add_argument(
+        '--connections',
+        type = int,
+        help = ("Number of donor archives to download concurrently. If "
+                "specified, downloads are resumable and recorded in "
+                "--manifest. If not specified, the data are downloaded "
+                "using abagen.")
+    )
+    
+    parser.add_argument(
+        '--manifest',
+        type = str,
+        default = 'manifest.csv',
+        help = ("File in the microarray sub-directory of --outdir in "
+                "which to record the size and checksum of every "
+                "downloaded file. Ignored if --connections is not "
+                "specified.")
+    )
+    
+    parser.add_argument(
+        '--verify',
+        type = str,
+        default = 'false',
+        choices = ['true', 'false'],
+        help = ("Option to verify the checksums of previously downloaded "
+                "files before skipping a donor. If false, only file "
+                "sizes are verified.")
+    )
+    
+    parser.add_argument(
+        '--cache',
+        type = str,
+        default = 'false',
+        choices = ['true', 'false'],
+        help = ("Option to convert the microarray tables of every donor "
+                "to the float32 binary cache read by "
+                "build_sample_matrix.py --cache true after downloading "
+                "them.")
+    )
+    
+    parser.add_argument(
+        '--retries',
+        type = int,
+        default = 3,
+        help = ("Number of times a failed download is retried before "
+                "the donor is recorded as failed.")
+    )
+    
+    parser.add_argument(
+        '--api-url',
+        type = str,
+        default = 'http://api.brain-map.org',
+        help = "Base URL of the Allen Brain Atlas API for the ontology."
+    )
+    
+    parser.add_argument(
+        '--microarray-url',
+        type = str,
+        default = 'https://human.brain-map.org',
+        help = "Base URL from which to download the donor archives."
+    )
+    
     parser.add_argument(
         '--verbose',
         type = str,
@@ -49,6 +142,645 @@ def parse_args():
     
     return args
 
+# Functions ------------------------------------------------------------------
+
+def fetch_ontology(outfile, api_url = 'http://api.brain-map.org',
+                   session = None, timeout = 60.0, verbose = True):
+    
+    """
+    Download the AHBA hierarchical ontology, revalidating a cached copy
+    
+    Description
+    -----------
+    The ETag and Last-Modified headers of the response are kept in a
+    JSON file next to the ontology. If the ontology was downloaded
+    before, the request is made conditional on these headers and the
+    cached file is kept if the server reports it as unchanged. The
+    cached file is also kept if the request fails, e.g. because the 
+    server cannot be reached or does not respond in time.
+    
+    Arguments
+    ---------
+    outfile: str
+        Path to the JSON file in which to save the ontology.
+    api_url: str, optional
+        Base URL of the Allen Brain Atlas API.
+        (default 'http://api.brain-map.org')
+    session: requests.Session, optional
+        HTTP session used to send the request.
+        (default None)
+    timeout: float, optional
+        Time in seconds to wait for the connection and for every read
+        from the server.
+        (default 60.0)
+    verbose: bool, optional
+        Verbosity.
+        (default True)
+    
+    Returns
+    -------
+    fetched: bool
+        True if the ontology was downloaded, False if the cached copy
+        was kept.
+    """
+    
+    session = requests.Session() if session is None else session
+    
+    hierarchy_url = '{}/api/v2/structure_graph_download/10.json'.format(api_url)
+    cachefile = outfile+'.cache.json'
+    
+    headers = {}
+    if os.path.isfile(outfile) and os.path.isfile(cachefile):
+        with open(cachefile, 'r') as file:
+            cache = json.load(file)
+        if cache.get('etag') is not None:
+            headers['If-None-Match'] = cache['etag']
+        if cache.get('last_modified') is not None:
+            headers['If-Modified-Since'] = cache['last_modified']
+    
+    try:
+        hierarchy_url_get = session.get(hierarchy_url, headers = headers,
+                                        timeout = timeout)
+        if hierarchy_url_get.status_code != 304:
+            hierarchy_url_get.raise_for_status()
+    except requests.exceptions.RequestException as err:
+        if os.path.isfile(outfile):
+            if verbose:
+                print("Could not download {}: {}. Using cached ontology."
+                      .format(hierarchy_url, err))
+            return False
+        raise
+    
+    if hierarchy_url_get.status_code == 304:
+        if verbose:
+            print("Cached ontology is up to date.")
+        return False
+    
+    hierarchy_dict = json.loads(hierarchy_url_get.text)
+    with open(outfile, 'w') as file:
+        json.dump(hierarchy_dict, file)
+    
+    cache = {'url': hierarchy_url,
+             'etag': hierarchy_url_get.headers.get('ETag'),
+             'last_modified': hierarchy_url_get.headers.get('Last-Modified')}
+    with open(cachefile, 'w') as file:
+        json.dump(cache, file)
+    
+    return True
+
+
+def checksum_file(infile, blocksize = 2**20):
+
+    """
+    Compute the MD5 checksum of a file
+    
+    Description
+    -----------
+    This is the same checksum as in AMBA/download_AMBA.py, so that the
+    manifests of both downloaders can be compared. The AHBA scripts are
+    run from their own directory and do not import the AMBA scripts,
+    since download_AMBA.py requires pyminc and h5py at import time.
+    Changes to one copy should be made to the other.
+    
+    Arguments
+    ---------
+    infile: str
+        Path to the file.
+    blocksize: int, optional
+        Number of bytes read at a time.
+        (default 2**20)
+    
+    Returns
+    -------
+    checksum: str
+        Hexadecimal MD5 digest of the file.
+    """
+    
+    md5 = hashlib.md5()
+    with open(infile, 'rb') as file:
+        for block in iter(lambda: file.read(blocksize), b''):
+            md5.update(block)
+    
+    return md5.hexdigest()
+
+
+def get_donor_dir(donor):
+
+    """
+    Get the name of the directory containing the files of a donor
+    
+    Arguments
+    ---------
+    donor: str
+        Donor number.
+    
+    Returns
+    -------
+    donor_dir: str
+        Name of the donor directory, as used by abagen.
+    """
+    
+    return 'normalized_microarray_donor{}'.format(donor)
+
+
+_manifest_lock = threading.Lock()
+
+def update_manifest(manifest, records):
+
+    """
+    Append records to the download manifest
+    
+    Arguments
+    ---------
+    manifest: str
+        Path to the manifest CSV file.
+    records: list of dict
+        Records with keys 'donor', 'file', 'bytes', 'checksum',
+        'status' and 'timestamp'.
+    
+    Returns
+    -------
+    None
+    """
+    
+    with _manifest_lock:
+        header = not os.path.isfile(manifest)
+        (pd.DataFrame(records)
+         .to_csv(manifest, mode = 'a', header = header, index = False))
+    
+    return
+
+
+def read_manifest(manifest):
+
+    """
+    Import the download manifest
+    
+    Description
+    -----------
+    Only the most recent record for every donor file is kept.
+    
+    Arguments
+    ---------
+    manifest: str
+        Path to the manifest CSV file.
+    
+    Returns
+    -------
+    df_manifest: pandas.core.frame.DataFrame
+        Data frame containing the latest record for every file.
+    """
+    
+    columns = ['donor', 'file', 'bytes', 'checksum', 'status', 'timestamp']
+    
+    if not os.path.isfile(manifest):
+        return pd.DataFrame(columns = columns)
+    
+    df_manifest = (pd.read_csv(manifest, dtype = {'donor': str,
+                                                  'checksum': str})
+                   .drop_duplicates(subset = ['donor', 'file'],
+                                    keep = 'last')
+                   .reset_index(drop = True))
+    
+    return df_manifest
+
+
+def get_pending_donors(donors, outdir, manifest, verify = False):
+
+    """
+    Identify AHBA donors that still need to be downloaded
+    
+    Description
+    -----------
+    A donor is considered done if the manifest records all of its
+    files as complete and every file exists with the recorded size
+    (and checksum, if `verify` is True).
+    
+    Arguments
+    ---------
+    donors: list of str
+        Donor numbers.
+    outdir: str
+        Directory containing the donor directories.
+    manifest: str
+        Path to the manifest CSV file.
+    verify: bool, optional
+        Option to verify file checksums.
+        (default False)
+    
+    Returns
+    -------
+    pending: list of str
+        Subset of `donors` that are missing or corrupt.
+    """
+    
+    df_manifest = read_manifest(manifest)
+    
+    pending = []
+    for donor in donors:
+    
+        df_donor = df_manifest.loc[df_manifest['donor'] == donor]
+        
+        done = ((len(df_donor) > 0) and
+                (df_donor['status'] == 'complete').all())
+        for record in df_donor.itertuples():
+            if not done:
+                break
+            infile = os.path.join(outdir, get_donor_dir(donor), record.file)
+            done = (os.path.isfile(infile) and
+                    (os.path.getsize(infile) == record.bytes))
+            if done and verify:
+                done = checksum_file(infile) == record.checksum
+        
+        if not done:
+            pending.append(donor)
+    
+    return pending
+
+
+def fetch_donor(donor, outdir, session = None,
+                url = 'https://human.brain-map.org', retries = 3,
+                backoff = 1.0, chunksize = 2**20):
+    
+    """
+    Download and extract the microarray data of an AHBA donor
+    
+    Description
+    -----------
+    The donor archive is streamed to a partial file in the donor
+    directory. If a partial file exists from an interrupted download,
+    the download is resumed from its end. The size of the complete
+    archive is checked against the size reported by the server and the
+    archive is tested before it is extracted and removed. Archives 
+    that cannot be extracted are removed.
+    
+    Arguments
+    ---------
+    donor: str
+        Donor number.
+    outdir: str
+        Directory in which to create the donor directory.
+    session: requests.Session, optional
+        HTTP session used to send the requests.
+        (default None)
+    url: str, optional
+        Base URL from which to download the donor archive.
+        (default 'https://human.brain-map.org')
+    retries: int, optional
+        Maximal number of retries for failed downloads.
+        (default 3)
+    backoff: float, optional
+        Delay in seconds before the first retry. The delay doubles
+        with every retry.
+        (default 1.0)
+    chunksize: int, optional
+        Number of bytes written at a time.
+        (default 2**20)
+    
+    Returns
+    -------
+    records: list of dict
+        Manifest records for the files extracted from the archive.
+    """
+    
+    session = requests.Session() if session is None else session
+    
+    donor_url = ('{}/api/v2/well_known_file_download/{}'
+                 .format(url, WELL_KNOWN_IDS.url[donor]))
+    donor_dir = os.path.join(outdir, get_donor_dir(donor), '')
+    os.makedirs(donor_dir, exist_ok = True)
+    partfile = donor_dir+'donor{}.zip.part'.format(donor)
+    
+    for attempt in range(retries+1):
+    
+        offset = os.path.getsize(partfile) if os.path.isfile(partfile) else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset > 0 else {}
+        
+        try:
+            with session.get(donor_url, headers = headers, stream = True,
+                             timeout = 60) as response:
+                
+                #Server ignored the range request. Start over.
+                if response.status_code == 200:
+                    offset = 0
+                elif response.status_code != 206:
+                    response.raise_for_status()
+                
+                size = response.headers.get('Content-Length')
+                size = None if size is None else offset+int(size)
+                
+                with open(partfile, 'ab' if offset > 0 else 'wb') as file:
+                    for chunk in response.iter_content(chunksize):
+                        file.write(chunk)
+            
+            if (size is not None) and (os.path.getsize(partfile) != size):
+                raise IOError('Incomplete download: {} of {} bytes.'
+                              .format(os.path.getsize(partfile), size))
+            break
+        
+        except (requests.exceptions.RequestException, IOError) as err:
+            if isinstance(err, requests.exceptions.HTTPError):
+                #Discard a partial file the server cannot resume
+                if err.response.status_code == 416:
+                    os.remove(partfile)
+            if attempt == retries:
+                raise
+            time.sleep(backoff*2**attempt)
+    
+    #Discard archives that cannot be extracted, so that the next run 
+    #downloads them again instead of resuming from a corrupt file
+    try:
+        with ZipFile(partfile, 'r') as archive:
+            corrupt = archive.testzip()
+            if corrupt is not None:
+                raise BadZipFile('Bad CRC-32 for {} in {}.'
+                                 .format(corrupt, partfile))
+            files = [name for name in archive.namelist()
+                     if not name.endswith('/')]
+            archive.extractall(path = donor_dir)
+    except (BadZipFile, zlib.error, EOFError):
+        os.remove(partfile)
+        raise
+    os.remove(partfile)
+    
+    records = []
+    for name in files:
+        infile = donor_dir+name
+        records.append({'donor': donor,
+                        'file': name,
+                        'bytes': os.path.getsize(infile),
+                        'checksum': checksum_file(infile),
+                        'status': 'complete',
+                        'timestamp': (datetime.now()
+                                      .isoformat(timespec = 'seconds'))})
+    
+    return records
+
+
+def download_donors(donors, outdir, manifest, connections = 6,
+                    url = 'https://human.brain-map.org', retries = 3,
+                    verbose = True):
+    
+    """
+    Download the microarray data of AHBA donors concurrently
+    
+    Arguments
+    ---------
+    donors: list of str
+        Donor numbers.
+    outdir: str
+        Directory in which to create the donor directories.
+    manifest: str
+        Path to the manifest CSV file.
+    connections: int, optional
+        Number of donors downloaded concurrently.
+        (default 6)
+    url: str, optional
+        Base URL from which to download the donor archives.
+        (default 'https://human.brain-map.org')
+    retries: int, optional
+        Maximal number of retries for failed downloads.
+        (default 3)
+    verbose: bool, optional
+        Verbosity.
+        (default True)
+    
+    Returns
+    -------
+    failed: list of str
+        Donors that could not be downloaded.
+    """
+    
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize = connections)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    
+    failed = []
+    with ThreadPoolExecutor(max_workers = connections) as executor:
+    
+        futures = {executor.submit(fetch_donor, donor, outdir,
+                                   session = session, url = url,
+                                   retries = retries): donor
+                   for donor in donors}
+        
+        for future in as_completed(futures):
+            donor = futures[future]
+            try:
+                records = future.result()
+            except Exception as err:
+                print("Error downloading donor {}: {}".format(donor, err))
+                failed.append(donor)
+                continue
+            update_manifest(manifest, records)
+            if verbose:
+                print("Downloaded donor {}.".format(donor))
+    
+    session.close()
+    
+    return failed
+
+
+def get_cache_info(donor_dir):
+
+    """
+    Describe the CSV files from which the binary cache of a donor is built
+    
+    Arguments
+    ---------
+    donor_dir: str
+        Path to the donor directory.
+    
+    Returns
+    -------
+    info: dict
+        Dictionary with the cache format version and the size and
+        modification time of every source file.
+    """
+    
+    info = {'version': 1}
+    for name in ['MicroarrayExpression.csv', 'PACall.csv', 'Probes.csv']:
+        infile = os.path.join(donor_dir, name)
+        info[name] = [os.path.getsize(infile), os.path.getmtime(infile)]
+    
+    return info
+
+
+def is_cache_valid(donor_dir):
+
+    """
+    Check whether the binary cache of a donor is up to date
+    
+    Arguments
+    ---------
+    donor_dir: str
+        Path to the donor directory.
+    
+    Returns
+    -------
+    valid: bool
+        True if the cache exists and was built from the current CSV
+        files.
+    """
+    
+    cachefile = os.path.join(donor_dir, 'cache', 'cache.json')
+    if not os.path.isfile(cachefile):
+        return False
+    
+    with open(cachefile, 'r') as file:
+        cache = json.load(file)
+    
+    return cache.get('source') == get_cache_info(donor_dir)
+
+
+def read_table(infile, dtype):
+
+    """
+    Import a headerless AHBA probe-by-sample table
+    
+    Arguments
+    ---------
+    infile: str
+        Path to the CSV file, with probe IDs in the first column.
+    dtype: str
+        Data type of the sample columns.
+    
+    Returns
+    -------
+    probe_id: numpy.ndarray
+        Probe IDs.
+    values: numpy.ndarray
+        Array of shape (probes, samples).
+    """
+    
+    ncols = pd.read_csv(infile, header = None, nrows = 1).shape[1]
+    dtypes = {i: dtype for i in range(1, ncols)}
+    dtypes[0] = 'int64'
+    df = pd.read_csv(infile, header = None, dtype = dtypes)
+    
+    probe_id = df[0].to_numpy()
+    values = np.ascontiguousarray(df.iloc[:, 1:].to_numpy(dtype = dtype))
+    
+    return probe_id, values
+
+
+def write_microarray_cache(donor_dir):
+
+    """
+    Convert the microarray tables of a donor to a binary cache
+    
+    Description
+    -----------
+    The cache is written to the 'cache' sub-directory of the donor 
+    directory. MicroarrayExpression.csv is stored as a float32 array
+    and PACall.csv as a boolean array, both of shape (probes, samples)
+    in NumPy format, with the probe IDs indexing their rows in a 
+    separate array. The columns of Probes.csv are stored as separate
+    arrays in a NumPy archive. The sizes and modification times of 
+    the CSV files are recorded to detect stale caches.
+    
+    Arguments
+    ---------
+    donor_dir: str
+        Path to the donor directory.
+    
+    Returns
+    -------
+    None
+    """
+    
+    cachedir = os.path.join(donor_dir, 'cache', '')
+    os.makedirs(cachedir, exist_ok = True)
+    
+    probe_id, microarray = read_table(donor_dir+'/MicroarrayExpression.csv',
+                                      dtype = 'float32')
+    np.save(cachedir+'MicroarrayExpression.npy', microarray)
+    np.save(cachedir+'probe_id.npy', probe_id)
+    del microarray
+    
+    probe_id_pacall, pacall = read_table(donor_dir+'/PACall.csv',
+                                         dtype = 'bool')
+    if not np.array_equal(probe_id, probe_id_pacall):
+        raise Exception("Probes in MicroarrayExpression.csv and PACall.csv "
+                        "do not match in {}.".format(donor_dir))
+    np.save(cachedir+'PACall.npy', pacall)
+    del pacall
+    
+    probes = pd.read_csv(donor_dir+'/Probes.csv',
+                         dtype = {'entrez_id': pd.Int64Dtype()})
+    columns = {}
+    for column in probes.columns:
+        if column == 'entrez_id':
+            columns[column] = probes[column].to_numpy(dtype = 'float64',
+                                                      na_value = np.nan)
+        elif pd.api.types.is_numeric_dtype(probes[column]):
+            columns[column] = probes[column].to_numpy()
+        else:
+            columns[column] = probes[column].fillna('').to_numpy(dtype = str)
+    np.savez(cachedir+'Probes.npz', **columns)
+    
+    #Written last, so that interrupted conversions are not used
+    with open(cachedir+'cache.json', 'w') as file:
+        json.dump({'source': get_cache_info(donor_dir),
+                   'columns': list(probes.columns)}, file)
+    
+    return
+
+
+def read_microarray_cache(donor_dir):
+
+    """
+    Import the microarray tables of a donor from the binary cache
+    
+    Description
+    -----------
+    The expression and PACall arrays are memory-mapped rather than 
+    read into memory. The data frames follow the conventions of the 
+    abagen readers: rows are indexed by probe ID and columns by sample
+    IDs starting at 1.
+    
+    Arguments
+    ---------
+    donor_dir: str
+        Path to the donor directory.
+    
+    Returns
+    -------
+    tables: dict
+        Dictionary with keys 'microarray', 'pacall' and 'probes'
+        containing the corresponding data frames.
+    """
+    
+    cachedir = os.path.join(donor_dir, 'cache', '')
+    
+    with open(cachedir+'cache.json', 'r') as file:
+        columns = json.load(file)['columns']
+    
+    probe_id = pd.Index(np.load(cachedir+'probe_id.npy'), name = 'probe_id')
+    microarray = np.load(cachedir+'MicroarrayExpression.npy', mmap_mode = 'r')
+    pacall = np.load(cachedir+'PACall.npy', mmap_mode = 'r')
+    sample_id = pd.Series(range(1, microarray.shape[1] + 1),
+                          name = 'sample_id')
+    
+    tables = {}
+    tables['microarray'] = pd.DataFrame(microarray, index = probe_id,
+                                        columns = sample_id, copy = False)
+    tables['pacall'] = pd.DataFrame(pacall, index = probe_id,
+                                    columns = sample_id, copy = False)
+    
+    with np.load(cachedir+'Probes.npz') as archive:
+        probes = pd.DataFrame({column: archive[column]
+                               for column in columns})
+    for column in columns:
+        if probes[column].dtype.kind == 'U':
+            probes[column] = (probes[column].astype(object)
+                              .replace({'': np.nan}))
+    probes['entrez_id'] = probes['entrez_id'].astype(pd.Int64Dtype())
+    tables['probes'] = probes.set_index(columns[0])
+    
+    return tables
+
+
 # Main -----------------------------------------------------------------------
 
 def main():
@@ -67,22 +799,62 @@ def main():
     #Download AHBA hierarchical ontology as JSON
     if verbose:
         print("Downloading AHBA hierarchical ontology...")
-    hierarchy_url = ('http://api.brain-map.org/api/v2/'
-                     'structure_graph_download/10.json')
-    hierarchy_url_get = requests.get(hierarchy_url)
-    hierarchy_dict = json.loads(hierarchy_url_get.text)
-    with open(outdir+'AHBA_hierarchy_definitions.json', 'w') as outfile: 
-        json.dump(hierarchy_dict, outfile)
+    fetch_ontology(outfile = outdir+'AHBA_hierarchy_definitions.json',
+                   api_url = args['api_url'],
+                   verbose = verbose)
     
     #Include 'microarray' sub-directory. abagen will download to ~/ otherwise
     outdir = os.path.join(outdir, 'microarray', '')
     if not os.path.exists(outdir):
         os.mkdir(outdir)
 
+    donors = args['donors']
+    donors = 'all' if donors == ['all'] else donors
+    
     #Download microarray data
-    if verbose:
-        print("Downloading AHBA microarray data...")
-    files = abagen.fetch_microarray(donors = 'all', data_dir = outdir)
+    if args['connections'] is not None:
+    
+        donors = check_donors(donors)
+        manifest = outdir+args['manifest']
+        verify = True if args['verify'] == 'true' else False
+        
+        #Skip donors that were downloaded in a previous run
+        pending = get_pending_donors(donors = donors,
+                                     outdir = outdir,
+                                     manifest = manifest,
+                                     verify = verify)
+        
+        if verbose:
+            print("Downloading AHBA microarray data for {} of {} donors..."
+                  .format(len(pending), len(donors)))
+        
+        failed = download_donors(donors = pending,
+                                 outdir = outdir,
+                                 manifest = manifest,
+                                 connections = args['connections'],
+                                 url = args['microarray_url'],
+                                 retries = args['retries'],
+                                 verbose = verbose)
+        
+        if len(failed) > 0:
+            raise Exception("Failed to download donors: {}"
+                            .format(', '.join(failed)))
+    
+    else:
+    
+        if verbose:
+            print("Downloading AHBA microarray data...")
+        files = abagen.fetch_microarray(donors = donors, data_dir = outdir)
+    
+    #Convert microarray tables to binary cache
+    if args['cache'] == 'true':
+        for donor in check_donors(donors):
+            donor_dir = os.path.join(outdir, get_donor_dir(donor))
+            if not is_cache_valid(donor_dir):
+                if verbose:
+                    print("Converting microarray data for donor {} to "
+                          "binary cache...".format(donor))
+                write_microarray_cache(donor_dir)
 
     return
     
@@ -0,0 +1,505 @@
+# ----------------------------------------------------------------------------
+# sweep_sample_matrix.py
+# Author: Antoine Beauchamp
+# Created: October 17th, 2026
+
+"""
+Build gene-by-sample expression matrices for several abagen settings.
+
+Description
+-----------
+This is a script to build the AHBA gene-by-sample expression matrix for
+every combination of the processing options given. Each option accepts
+a list of values. The microarray tables of all donors are loaded from
+the binary cache written by download_AHBA.py, which every worker
+process memory-maps so that the donor arrays are shared read-only
+between processes. The filtered samples and probes of every filtering
+setting are prepared first and cached. Combinations that share probe
+selection settings are then evaluated by the same worker so that the
+probe-selected data are computed once. One expression matrix is
+written per combination, along with a summary table.
+"""
+
+
+# Packages -------------------------------------------------------------------
+
+import argparse
+import os
+import itertools
+import time
+import abagen
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from build_sample_matrix import (get_sample_metadata, get_input_checksums,
+                                 load_microarray_cache, get_prepared_samples,
+                                 get_selected_probes, normalize_samples,
+                                 match_sample_metadata)
+
+
+# Command line arguments -----------------------------------------------------
+
+def parse_args():
+
+    """Parse command line arguments"""
+
+    parser = argparse.ArgumentParser(
+        formatter_class = argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        '--datadir',
+        type = str,
+        default = 'data/',
+        help = ("Directory containing the AHBA data sets. If the data are not "
+                "found, they will be downloaded.")
+    )
+
+    parser.add_argument(
+        '--outdir',
+        type = str,
+        default = 'data/sweep/',
+        help = "Directory in which to save the sample expression matrices."
+    )
+
+    parser.add_argument(
+        '--donorsfile',
+        type = str,
+        default = 'data/donors.csv',
+        help = ("Path to .csv file containing donor naming conventions.")
+    )
+
+    parser.add_argument(
+        '--ibf-threshold',
+        type = float,
+        nargs = '+',
+        default = [0.5],
+        help = ("Thresholds for intensity-based filtering.")
+    )
+
+    parser.add_argument(
+        '--probe-selection',
+        type = str,
+        nargs = '+',
+        default = ['diff_stability'],
+        help = ("Methods used to subset multiple probes.")
+    )
+
+    parser.add_argument(
+        '--donor-probes',
+        type = str,
+        nargs = '+',
+        default = ['aggregate'],
+        help = ("Methods used to select probes across donors.")
+    )
+
+    parser.add_argument(
+        '--sim-threshold',
+        type = str,
+        nargs = '+',
+        default = ['none'],
+        help = ("Thresholds for inter-sample correlation filtering. Use "
+                "'none' to disable the filtering.")
+    )
+
+    parser.add_argument(
+        '--sample-norm',
+        type = str,
+        nargs = '+',
+        default = ['srs'],
+        help = ("Methods used to normalize samples across genes. Use "
+                "'none' to disable the normalization.")
+    )
+
+    parser.add_argument(
+        '--gene-norm',
+        type = str,
+        nargs = '+',
+        default = ['srs'],
+        help = ("Methods used to normalize genes across samples. Use "
+                "'none' to disable the normalization.")
+    )
+
+    parser.add_argument(
+        '--cachedir',
+        type = str,
+        default = 'data/cache/',
+        help = ("Directory in which to cache intermediate pipeline "
+                "results.")
+    )
+
+    parser.add_argument(
+        '--nproc',
+        type = int,
+        default = 1,
+        help = ("Number of worker processes.")
+    )
+
+    parser.add_argument(
+        '--nthreads',
+        type = int,
+        default = 1,
+        help = ("Number of threads per process used by the fast probe "
+                "selection and normalization methods.")
+    )
+
+    parser.add_argument(
+        '--verbose',
+        type = str,
+        default = 'true',
+        choices = ['true', 'false'],
+        help = 'Verbosity.'
+    )
+
+    args = vars(parser.parse_args())
+
+    return args
+
+
+# Functions ------------------------------------------------------------------
+
+def parse_option(value, dtype = str):
+
+    """
+    Convert a command line option value, mapping 'none' to None
+
+    Arguments
+    ---------
+    value: str
+        Value of the option.
+    dtype: type
+        Type of the option. (default str)
+
+    Returns
+    -------
+    value: object
+        Converted value.
+    """
+
+    if value.lower() == 'none':
+        return None
+
+    return dtype(value)
+
+
+def get_combinations(ibf_threshold, probe_selection, donor_probes,
+                     sim_threshold, sample_norm, gene_norm):
+
+    """
+    Get the combinations of processing options
+
+    Description
+    -----------
+    Combinations are grouped by the options that determine the
+    probe-selected expression data, i.e. everything except the
+    normalization methods.
+
+    Arguments
+    ---------
+    ibf_threshold: list of float
+        Thresholds for intensity-based filtering.
+    probe_selection: list of str
+        Methods used to subset multiple probes.
+    donor_probes: list of str
+        Methods used to select probes across donors.
+    sim_threshold: list of float
+        Thresholds for inter-sample correlation filtering.
+    sample_norm: list of str
+        Methods used to normalize samples across genes.
+    gene_norm: list of str
+        Methods used to normalize genes across samples.
+
+    Returns
+    -------
+    groups: list of tuple
+        List of (selection, normalizations) tuples, where selection is
+        a dictionary of probe selection options and normalizations is
+        a list of dictionaries of normalization options.
+    """
+
+    normalizations = [{'sample_norm': sn, 'gene_norm': gn}
+                      for sn, gn in itertools.product(sample_norm,
+                                                      gene_norm)]
+
+    groups = []
+    for ibf, sim, ps, dp in itertools.product(ibf_threshold, sim_threshold,
+                                              probe_selection, donor_probes):
+        selection = {'ibf_threshold': ibf,
+                     'sim_threshold': sim,
+                     'probe_selection': ps,
+                     'donor_probes': dp}
+        groups.append((selection, normalizations))
+
+    return groups
+
+
+def get_combination_name(combination):
+
+    """
+    Get the file name suffix of a combination of processing options
+
+    Arguments
+    ---------
+    combination: dict
+        Processing options.
+
+    Returns
+    -------
+    name: str
+        Suffix identifying the combination.
+    """
+
+    name = ('ibf{ibf_threshold}_sim{sim_threshold}_{probe_selection}_'
+            '{donor_probes}_{sample_norm}_{gene_norm}'
+            .format(**combination))
+
+    return name
+
+
+#Donor data of the current worker process
+_files = None
+
+
+def init_worker(files):
+
+    """
+    Load the donor data in a worker process
+
+    Description
+    -----------
+    The microarray tables are memory-mapped from the binary cache, so
+    that the operating system shares them between workers.
+
+    Arguments
+    ---------
+    files: dict
+        Dictionary of AHBA file paths from abagen.fetch_microarray().
+
+    Returns
+    -------
+    None
+    """
+
+    global _files
+    _files = load_microarray_cache(files = files, verbose = False)
+
+    return
+
+
+def run_samples(ibf_threshold, sim_threshold, cachedir, checksums):
+
+    """
+    Prepare and cache the samples and probes of a filtering setting
+
+    Arguments
+    ---------
+    ibf_threshold: float
+        Threshold for intensity-based filtering.
+    sim_threshold: float
+        Threshold for inter-sample correlation filtering.
+    cachedir: str
+        Path to the cache directory.
+    checksums: dict
+        Input checksums from get_input_checksums().
+
+    Returns
+    -------
+    None
+    """
+
+    get_prepared_samples(files = _files,
+                         ibf_threshold = ibf_threshold,
+                         sim_threshold = sim_threshold,
+                         cachedir = cachedir,
+                         checksums = checksums,
+                         verbose = False)
+
+    return
+
+
+def run_group(selection, normalizations, df_samples, outdir,
+              cachedir = None, checksums = None, nthreads = 1):
+
+    """
+    Build the expression matrices of a group of combinations
+
+    Arguments
+    ---------
+    selection: dict
+        Probe selection options shared by the group.
+    normalizations: list of dict
+        Normalization options of each combination.
+    df_samples: pandas.core.frame.DataFrame
+        Dataframe containing sample metadata.
+    outdir: str
+        Path to the output directory.
+    cachedir: str
+        Path to the cache directory. (default None)
+    checksums: dict
+        Input checksums from get_input_checksums(). (default None)
+    nthreads: int
+        Number of threads used by the fast methods. (default 1)
+
+    Returns
+    -------
+    summary: list of dict
+        Summary record of every combination.
+    """
+
+    start = time.time()
+
+    annotation, probes, labels = get_prepared_samples(
+        files = _files,
+        ibf_threshold = selection['ibf_threshold'],
+        sim_threshold = selection['sim_threshold'],
+        cachedir = cachedir,
+        checksums = checksums,
+        verbose = False
+    )
+
+    microarray = get_selected_probes(files = _files,
+                                     annotation = annotation,
+                                     probes = probes,
+                                     cachedir = cachedir,
+                                     checksums = checksums,
+                                     nthreads = nthreads,
+                                     verbose = False,
+                                     **selection)
+
+    summary = []
+    for normalization in normalizations:
+
+        expression = normalize_samples(microarray = microarray,
+                                       annotation = annotation,
+                                       labels = labels,
+                                       nthreads = nthreads,
+                                       **normalization)
+
+        expression, df_expr_samples = match_sample_metadata(
+            expression = expression,
+            df_samples = df_samples
+        )
+
+        combination = dict(selection, **normalization)
+        name = get_combination_name(combination)
+
+        exprfile = 'HumanExpressionMatrix_samples_pipeline_abagen_{}.csv'
+        exprfile = os.path.join(outdir, exprfile.format(name))
+        expression.to_csv(exprfile, index_label = 'Gene')
+
+        samplefile = 'SampleInformation_pipeline_abagen_{}.csv'
+        samplefile = os.path.join(outdir, samplefile.format(name))
+        df_expr_samples.to_csv(samplefile, index = False)
+
+        combination.update({'genes': expression.shape[0],
+                            'samples': expression.shape[1],
+                            'exprfile': os.path.basename(exprfile),
+                            'samplefile': os.path.basename(samplefile),
+                            'seconds': round(time.time() - start, 1)})
+        summary.append(combination)
+        start = time.time()
+
+    return summary
+
+
+# Main -----------------------------------------------------------------------
+
+def main():
+
+    #Parse command line arguments
+    args = parse_args()
+    datadir = args['datadir']
+    outdir = args['outdir']
+    donorsfile = args['donorsfile']
+    cachedir = args['cachedir']
+    nproc = args['nproc']
+    nthreads = args['nthreads']
+    verbose = True if args['verbose'] == 'true' else False
+    verbose_int = 1 if verbose else 0
+
+    #Parse option values
+    sim_threshold = [parse_option(x, dtype = float)
+                     for x in args['sim_threshold']]
+    sample_norm = [parse_option(x) for x in args['sample_norm']]
+    gene_norm = [parse_option(x) for x in args['gene_norm']]
+
+    #Format the paths properly
+    outdir = os.path.join(outdir, '')
+    datadir = os.path.join(datadir, '')
+
+    #Create directories if needed
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    if not os.path.exists(datadir):
+        os.makedirs(datadir)
+
+    #Fetch AHBA files, downloading if needed
+    files = abagen.fetch_microarray(data_dir = datadir,
+                                    donors = 'all',
+                                    verbose = verbose_int)
+
+    if verbose:
+        print("Loading microarray data...")
+
+    #Create the binary cache once, before starting workers
+    checksums = get_input_checksums(files = files)
+    load_microarray_cache(files = files, verbose = verbose)
+
+    #Build sample metadata data frame
+    df_samples = get_sample_metadata(data_dir = datadir,
+                                     donors = donorsfile)
+
+    groups = get_combinations(ibf_threshold = args['ibf_threshold'],
+                              probe_selection = args['probe_selection'],
+                              donor_probes = args['donor_probes'],
+                              sim_threshold = sim_threshold,
+                              sample_norm = sample_norm,
+                              gene_norm = gene_norm)
+
+    if verbose:
+        print("Building {} sample expression matrices using {} processes..."
+              .format(len(groups)*len(groups[0][1]), nproc))
+
+    summary = []
+    with ProcessPoolExecutor(max_workers = nproc,
+                             initializer = init_worker,
+                             initargs = (files,)) as executor:
+
+        #Prepare samples for every filtering setting
+        futures = [executor.submit(run_samples,
+                                   ibf_threshold = ibf,
+                                   sim_threshold = sim,
+                                   cachedir = cachedir,
+                                   checksums = checksums)
+                   for ibf, sim in itertools.product(args['ibf_threshold'],
+                                                     sim_threshold)]
+        for future in as_completed(futures):
+            future.result()
+
+        futures = [executor.submit(run_group,
+                                   selection = selection,
+                                   normalizations = normalizations,
+                                   df_samples = df_samples,
+                                   outdir = outdir,
+                                   cachedir = cachedir,
+                                   checksums = checksums,
+                                   nthreads = nthreads)
+                   for selection, normalizations in groups]
+
+        for future in as_completed(futures):
+            for combination in future.result():
+                if verbose:
+                    print("Wrote {}".format(combination['exprfile']))
+                summary.append(combination)
+
+    #Write summary table
+    summary = pd.DataFrame(summary)
+    summary = summary.sort_values(by = 'exprfile').reset_index(drop = True)
+    summaryfile = os.path.join(outdir, 'sweep_summary.csv')
+    summary.to_csv(summaryfile, index = False)
+
+    return
+
+
+if __name__=='__main__':
+    main()
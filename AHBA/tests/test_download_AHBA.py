@@ -0,0 +1,322 @@
+# ----------------------------------------------------------------------------
+# test_download_AHBA.py
+# Author: Antoine Beauchamp
+# Created: October 17th, 2026
+
+"""
+Tests of the concurrent AHBA downloader.
+
+Description
+-----------
+The donor archives and the ontology are served by a local HTTP server,
+which records every request and can interrupt a transfer to test the
+resumption of partial downloads.
+"""
+
+
+# Packages -------------------------------------------------------------------
+
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import http.server
+import pytest
+from types      import SimpleNamespace
+from zipfile    import ZipFile, BadZipFile
+
+download_AHBA = pytest.importorskip('download_AHBA')
+
+
+# Fixtures -------------------------------------------------------------------
+
+def make_handler(routes, log):
+
+    """
+    Create a request handler serving fixed responses
+
+    Arguments
+    ---------
+    routes: dict
+        Dictionary with URL paths as keys and dictionaries with keys
+        'body', and optionally 'etag', 'truncate' and 'delay', as 
+        values. If 'truncate' is non-zero, the next response is 
+        interrupted after that many bytes. Responses are sent after
+        'delay' seconds.
+    log: list
+        List to which the path and headers of every request are
+        appended.
+
+    Returns
+    -------
+    handler: type
+        Subclass of http.server.BaseHTTPRequestHandler.
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+
+            log.append((self.path, dict(self.headers)))
+            route = routes.get(self.path)
+            if route is None:
+                self.send_error(404)
+                return
+            time.sleep(route.get('delay', 0))
+
+            etag = route.get('etag')
+            if (etag is not None) and (self.headers['If-None-Match'] == etag):
+                self.send_response(304)
+                self.end_headers()
+                return
+
+            body = route['body']
+            offset = 0
+            rangeheader = self.headers['Range']
+            if rangeheader is not None:
+                offset = int(rangeheader.split('=')[1].rstrip('-'))
+                if offset >= len(body):
+                    self.send_error(416)
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'
+                                 .format(offset, len(body)-1, len(body)))
+            else:
+                self.send_response(200)
+            if etag is not None:
+                self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)-offset))
+            self.end_headers()
+
+            truncate = route.pop('truncate', 0)
+            if truncate > 0:
+                self.wfile.write(body[offset:offset+truncate])
+                self.wfile.flush()
+                self.close_connection = True
+                return
+            self.wfile.write(body[offset:])
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+@pytest.fixture
+def server():
+
+    """Local HTTP server, with its URL, routes and request log"""
+
+    routes, log = {}, []
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                            make_handler(routes, log))
+    thread = threading.Thread(target = httpd.serve_forever, daemon = True)
+    thread.start()
+
+    yield SimpleNamespace(url = 'http://127.0.0.1:{}'.format(httpd.server_port),
+                          routes = routes,
+                          log = log)
+
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def make_archive(donor):
+
+    """Create a donor archive with small microarray tables"""
+
+    files = {'MicroarrayExpression.csv': '1,{0}.5,2.5\n2,3.5,{0}.25\n',
+             'PACall.csv': '1,1,0\n2,1,1\n',
+             'Probes.csv': 'probe_id,gene_symbol\n1,A\n2,B\n',
+             'SampleAnnot.csv': 'well_id,structure_id\n{0}1,4\n{0}2,5\n'}
+    files = {name: (content.format(donor) * 200).encode()
+             for name, content in files.items()}
+
+    buffer = io.BytesIO()
+    with ZipFile(buffer, 'w') as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+
+    return buffer.getvalue(), files
+
+
+def add_donor(server, donor):
+
+    """Serve the archive of a donor and return its files"""
+
+    archive, files = make_archive(donor)
+    path = ('/api/v2/well_known_file_download/{}'
+            .format(download_AHBA.WELL_KNOWN_IDS.url[donor]))
+    server.routes[path] = {'body': archive}
+
+    return path, files
+
+
+# Tests ----------------------------------------------------------------------
+
+def test_fetch_donor_extracts_archive(server, tmp_path):
+
+    _, files = add_donor(server, '9861')
+
+    records = download_AHBA.fetch_donor('9861', str(tmp_path),
+                                        url = server.url, retries = 0)
+
+    donor_dir = tmp_path/download_AHBA.get_donor_dir('9861')
+    assert sorted(record['file'] for record in records) == sorted(files)
+    for record in records:
+        content = files[record['file']]
+        assert (donor_dir/record['file']).read_bytes() == content
+        assert record['bytes'] == len(content)
+        assert record['checksum'] == hashlib.md5(content).hexdigest()
+        assert record['status'] == 'complete'
+    assert not (donor_dir/'donor9861.zip.part').exists()
+
+
+def test_fetch_donor_resumes_interrupted_download(server, tmp_path):
+
+    path, files = add_donor(server, '9861')
+    server.routes[path]['truncate'] = 2048
+
+    records = download_AHBA.fetch_donor('9861', str(tmp_path),
+                                        url = server.url, retries = 1,
+                                        backoff = 0, chunksize = 256)
+
+    requests = [headers for request, headers in server.log
+                if request == path]
+    assert len(requests) == 2
+    assert 'Range' not in requests[0]
+    assert requests[1]['Range'] == 'bytes=2048-'
+
+    donor_dir = tmp_path/download_AHBA.get_donor_dir('9861')
+    for record in records:
+        assert (donor_dir/record['file']).read_bytes() == files[record['file']]
+
+
+def test_fetch_donor_discards_unresumable_partial_file(server, tmp_path):
+
+    path, files = add_donor(server, '9861')
+    donor_dir = tmp_path/download_AHBA.get_donor_dir('9861')
+    donor_dir.mkdir()
+    archive = server.routes[path]['body']
+    (donor_dir/'donor9861.zip.part').write_bytes(archive + b'garbage')
+
+    download_AHBA.fetch_donor('9861', str(tmp_path), url = server.url,
+                              retries = 1, backoff = 0)
+
+    for name, content in files.items():
+        assert (donor_dir/name).read_bytes() == content
+
+
+@pytest.mark.parametrize('corruption', ['crc', 'truncated'])
+def test_fetch_donor_discards_corrupt_archive(server, tmp_path, corruption):
+
+    path, files = add_donor(server, '9861')
+    archive = server.routes[path]['body']
+    if corruption == 'crc':
+        #Flip a byte of the first compressed file, keeping the size
+        corrupt = bytearray(archive)
+        corrupt[100] ^= 0xFF
+        server.routes[path]['body'] = bytes(corrupt)
+    else:
+        server.routes[path]['body'] = archive[:len(archive)//2]
+
+    with pytest.raises(BadZipFile):
+        download_AHBA.fetch_donor('9861', str(tmp_path), url = server.url,
+                                  retries = 0)
+
+    donor_dir = tmp_path/download_AHBA.get_donor_dir('9861')
+    assert not (donor_dir/'donor9861.zip.part').exists()
+
+    #The next run downloads the archive from the start
+    server.routes[path]['body'] = archive
+    download_AHBA.fetch_donor('9861', str(tmp_path), url = server.url,
+                              retries = 0)
+    assert 'Range' not in server.log[-1][1]
+    for name, content in files.items():
+        assert (donor_dir/name).read_bytes() == content
+
+
+def test_download_donors_skips_recorded_donors(server, tmp_path):
+
+    donors = ['9861', '10021']
+    for donor in donors:
+        add_donor(server, donor)
+    manifest = str(tmp_path/'manifest.csv')
+
+    failed = download_AHBA.download_donors(donors, str(tmp_path), manifest,
+                                           connections = 2,
+                                           url = server.url, retries = 0,
+                                           verbose = False)
+
+    assert failed == []
+    df_manifest = download_AHBA.read_manifest(manifest)
+    assert len(df_manifest) == 8
+    assert (df_manifest['status'] == 'complete').all()
+    assert download_AHBA.get_pending_donors(donors, str(tmp_path),
+                                            manifest) == []
+
+    #Corrupt a file without changing its size
+    infile = (tmp_path/download_AHBA.get_donor_dir('10021')/'PACall.csv')
+    content = infile.read_bytes()
+    infile.write_bytes(content[::-1])
+    assert download_AHBA.get_pending_donors(donors, str(tmp_path),
+                                            manifest) == []
+    assert download_AHBA.get_pending_donors(donors, str(tmp_path), manifest,
+                                            verify = True) == ['10021']
+
+    #Remove a file
+    os.remove(tmp_path/download_AHBA.get_donor_dir('9861')/'Probes.csv')
+    assert download_AHBA.get_pending_donors(donors, str(tmp_path),
+                                            manifest) == ['9861']
+
+
+def test_download_donors_reports_failed_donors(server, tmp_path):
+
+    add_donor(server, '9861')
+    manifest = str(tmp_path/'manifest.csv')
+
+    failed = download_AHBA.download_donors(['9861', '10021'], str(tmp_path),
+                                           manifest, connections = 2,
+                                           url = server.url, retries = 0,
+                                           verbose = False)
+
+    assert failed == ['10021']
+    assert download_AHBA.get_pending_donors(['9861', '10021'],
+                                            str(tmp_path),
+                                            manifest) == ['10021']
+
+
+def test_fetch_ontology_revalidates_cached_copy(server, tmp_path):
+
+    path = '/api/v2/structure_graph_download/10.json'
+    ontology = {'msg': [{'id': 4005, 'acronym': 'Br'}]}
+    server.routes[path] = {'body': json.dumps(ontology).encode(),
+                           'etag': '"v1"'}
+    outfile = str(tmp_path/'AHBA_hierarchy_definitions.json')
+
+    assert download_AHBA.fetch_ontology(outfile, api_url = server.url,
+                                        verbose = False)
+    assert not download_AHBA.fetch_ontology(outfile, api_url = server.url,
+                                            verbose = False)
+
+    assert server.log[1][1]['If-None-Match'] == '"v1"'
+    with open(outfile, 'r') as file:
+        assert json.load(file) == ontology
+
+
+def test_fetch_ontology_keeps_cached_copy_on_timeout(server, tmp_path):
+
+    path = '/api/v2/structure_graph_download/10.json'
+    ontology = {'msg': [{'id': 4005, 'acronym': 'Br'}]}
+    server.routes[path] = {'body': json.dumps(ontology).encode()}
+    outfile = str(tmp_path/'AHBA_hierarchy_definitions.json')
+    assert download_AHBA.fetch_ontology(outfile, api_url = server.url,
+                                        verbose = False)
+
+    server.routes[path]['delay'] = 1
+    assert not download_AHBA.fetch_ontology(outfile, api_url = server.url,
+                                            timeout = 0.2, verbose = False)
+    with open(outfile, 'r') as file:
+        assert json.load(file) == ontology
@@ -0,0 +1,112 @@
+# ----------------------------------------------------------------------------
+# test_fast_processing.py
+# Author: Antoine Beauchamp
+# Created: October 17th, 2026
+
+"""
+Tests of the fast probe selection and normalization methods.
+
+Description
+-----------
+The multi-threaded implementations in fast_processing.py are compared
+to the abagen implementations on small random data sets.
+"""
+
+
+# Packages -------------------------------------------------------------------
+
+import numpy as np
+import pandas as pd
+import pytest
+
+abagen = pytest.importorskip('abagen')
+fast_processing = pytest.importorskip('fast_processing')
+
+from abagen import correct, probes_
+
+#The released abagen calls pandas methods removed in pandas 2 and 3
+#when collapsing probes. Builds of the fork in python_reqs.txt carry a
+#local version
+abagen_fork_required = pytest.mark.skipif(
+    (int(pd.__version__.split('.')[0]) >= 2) and
+    ('+' not in abagen.__version__),
+    reason = ("abagen {} cannot collapse probes with pandas {}. Install "
+              "the abagen@dev fork pinned in python_reqs.txt "
+              "(git+https://github.com/abeaucha/abagen@dev)."
+              .format(abagen.__version__, pd.__version__))
+)
+
+
+# Fixtures -------------------------------------------------------------------
+
+@pytest.fixture
+def microarray():
+
+    """Probe-by-sample expression, annotation and probes of 3 donors"""
+
+    rng = np.random.default_rng(0)
+    nprobes, nsamples = 30, 40
+
+    #Several probes per gene, with tied expression for some of them
+    probes = pd.DataFrame(
+        {'gene_symbol': ['G{:02d}'.format(i // 3) for i in range(nprobes)]},
+        index = pd.Index(np.arange(100, 100+nprobes), name = 'probe_id')
+    )
+
+    micro, annotation = {}, {}
+    for donor in ['9861', '10021', '12876']:
+        wells = pd.Index(int(donor)*100 + np.arange(nsamples),
+                         name = 'well_id')
+        annotation[donor] = pd.DataFrame(
+            {'structure_id': rng.integers(1, 6, nsamples)},
+            index = wells
+        )
+        values = rng.normal(size = (nprobes, nsamples))
+        values[1] = values[0]
+        micro[donor] = pd.DataFrame(values, index = probes.index,
+                                    columns = wells)
+
+    return micro, annotation, probes
+
+
+# Tests ----------------------------------------------------------------------
+
+@abagen_fork_required
+def test_diff_stability_matches_abagen(microarray):
+
+    micro, annotation, probes = microarray
+
+    reference = probes_.collapse_probes(micro, annotation, probes,
+                                        method = 'diff_stability',
+                                        donor_probes = 'aggregate')
+    expression = fast_processing.diff_stability(micro, annotation, probes,
+                                                nthreads = 2)
+
+    assert reference.keys() == expression.keys()
+    for donor in reference:
+        pd.testing.assert_frame_equal(expression[donor], reference[donor])
+
+
+@pytest.mark.parametrize('axis', [0, 1])
+def test_scaled_robust_sigmoid_matches_abagen(axis):
+
+    rng = np.random.default_rng(1)
+    data = pd.DataFrame(rng.normal(size = (50, 20)))
+    data.iloc[3, 2] = np.nan
+    data[7] = np.nan
+
+    #abagen normalizes the columns of a data frame
+    if axis == 0:
+        reference = correct.normalize_expression(data, norm = 'srs',
+                                                 ignore_warn = True)
+    else:
+        reference = correct.normalize_expression(data.T, norm = 'srs',
+                                                 ignore_warn = True).T
+    normed = fast_processing.scaled_robust_sigmoid(data.to_numpy(),
+                                                   axis = axis,
+                                                   nthreads = 2,
+                                                   blocksize = 8)
+
+    reference = reference.to_numpy()
+    np.testing.assert_array_equal(np.isnan(normed), np.isnan(reference))
+    np.testing.assert_allclose(normed, reference, rtol = 0, atol = 1e-12)
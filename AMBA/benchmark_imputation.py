@@ -0,0 +1,214 @@
+# ----------------------------------------------------------------------------
+# benchmark_imputation.py
+# Author: Antoine Beauchamp
+# Created: October 17th, 2026
+
+"""
+Benchmark the K-nearest neighbours imputation of the voxel matrix.
+
+Description
+-----------
+This is a script to compare the blocked imputation engine in
+knn_imputation.py against sklearn.impute.KNNImputer, which it replaces
+in build_voxel_matrix.py. The input is a gene-by-voxel expression
+matrix written by build_voxel_matrix.py with --impute false. Voxels are
+imputed using genes as features, as in build_voxel_matrix.py. Since
+KNNImputer scales quadratically with the number of voxels, a random
+subset of voxels can be used. The run time of every method and the
+differences between the imputed values and those of KNNImputer are
+reported.
+"""
+
+
+# Packages -------------------------------------------------------------------
+
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from sklearn.impute import KNNImputer
+from knn_imputation import knn_impute
+
+
+# Command line arguments -----------------------------------------------------
+
+def parse_args():
+
+    """Parse command line arguments"""
+
+    parser = argparse.ArgumentParser(
+        formatter_class = argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        '--infile',
+        type = str,
+        required = True,
+        help = ("Path to a CSV file containing a gene-by-voxel expression "
+                "matrix with missing values.")
+    )
+
+    parser.add_argument(
+        '--nvoxels',
+        type = int,
+        default = 5000,
+        help = ("Number of randomly selected voxels to impute. If 0, all "
+                "voxels are used.")
+    )
+
+    parser.add_argument(
+        '--nthreads',
+        type = int,
+        help = ("Number of threads used by the imputation engine. Defaults "
+                "to the number of CPUs.")
+    )
+
+    parser.add_argument(
+        '--knn-components',
+        type = int,
+        default = 32,
+        help = ("Number of principal components used in approximate "
+                "mode.")
+    )
+
+    parser.add_argument(
+        '--tolerance',
+        type = float,
+        default = 1e-3,
+        help = ("Absolute difference above which an imputed value is "
+                "counted as different from KNNImputer.")
+    )
+
+    parser.add_argument(
+        '--seed',
+        type = int,
+        default = 0,
+        help = "Random seed for the selection of voxels."
+    )
+
+    parser.add_argument(
+        '--outfile',
+        type = str,
+        help = ("Optional .csv file in which to save the results.")
+    )
+
+    args = vars(parser.parse_args())
+
+    return args
+
+
+# Functions ------------------------------------------------------------------
+
+def time_function(func, **kwargs):
+
+    """
+    Time a function
+
+    Arguments
+    ---------
+    func: callable
+        Function to time.
+    **kwargs
+        Arguments passed to the function.
+
+    Returns
+    -------
+    result: object
+        Output of the function.
+    seconds: float
+        Run time in seconds.
+    """
+
+    start = time.perf_counter()
+    result = func(**kwargs)
+
+    return result, time.perf_counter() - start
+
+
+def compare_imputation(reference, imputed, missing, tolerance = 1e-3):
+
+    """
+    Compare imputed values to reference values
+
+    Arguments
+    ---------
+    reference: numpy.ndarray
+        Reference imputed array.
+    imputed: numpy.ndarray
+        Imputed array to compare.
+    missing: numpy.ndarray
+        Boolean array indicating the imputed values.
+    tolerance: float
+        Absolute difference above which values are counted as
+        different. (default 1e-3)
+
+    Returns
+    -------
+    comparison: dict
+        Maximal and mean absolute differences of the imputed values,
+        and fraction of imputed values that differ.
+    """
+
+    diff = np.abs(reference[missing] - imputed[missing].astype('float64'))
+
+    comparison = {'max_diff': float(diff.max()),
+                  'mean_diff': float(diff.mean()),
+                  'frac_different': float((diff > tolerance).mean())}
+
+    return comparison
+
+
+# Main -----------------------------------------------------------------------
+
+def main():
+
+    #Parse command line arguments
+    args = parse_args()
+    nthreads = args['nthreads']
+
+    #Voxels as samples and genes as features
+    data = pd.read_csv(args['infile'], index_col = 0).to_numpy().T
+    if 0 < args['nvoxels'] < len(data):
+        rng = np.random.default_rng(args['seed'])
+        voxels = rng.choice(len(data), size = args['nvoxels'],
+                            replace = False)
+        data = data[np.sort(voxels)]
+
+    #KNNImputer removes genes without any value
+    data = data[:, ~np.isnan(data).all(axis = 0)]
+    missing = np.isnan(data)
+    print("Imputing {} missing values in {} voxels and {} genes..."
+          .format(missing.sum(), *data.shape))
+
+    print("Timing KNNImputer...")
+    reference, seconds = time_function(KNNImputer().fit_transform,
+                                       X = data)
+    results = [{'method': 'KNNImputer', 'seconds': seconds}]
+
+    methods = {'knn_impute': None,
+               'knn_impute_approximate': args['knn_components']}
+    for method, n_components in methods.items():
+        print("Timing {}...".format(method))
+        imputed, seconds = time_function(knn_impute,
+                                         data = data,
+                                         nthreads = nthreads,
+                                         n_components = n_components)
+        result = {'method': method, 'seconds': seconds}
+        result.update(compare_imputation(reference = reference,
+                                         imputed = imputed,
+                                         missing = missing,
+                                         tolerance = args['tolerance']))
+        results.append(result)
+
+    results = pd.DataFrame(results)
+    results['speedup'] = results['seconds'].iloc[0] / results['seconds']
+    print(results.to_string(index = False))
+
+    if args['outfile'] is not None:
+        results.to_csv(args['outfile'], index = False)
+
+    return
+
+
+if __name__=='__main__':
+    main()
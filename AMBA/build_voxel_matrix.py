@@ -15,33 +15,52 @@ This matrix is written out to a CSV file.
 
 Pre-processing options include:
 1. log2 transformation
-2. Voxel-wise average of the expression from multiple experiments
-   that correspond to a single gene
+2. Aggregation of the expression from multiple experiments that
+   correspond to a single gene, using the voxel-wise mean or median,
+   or the experiment with the best coverage
 3. Filtering out genes or experiments that have too many empty voxels
-4. Imputing empty voxels using K-nearest neighbours
+4. Imputing empty voxels using K-nearest neighbours, exactly or with
+   an approximate neighbour search
 
 The script can import either the coronal or sagittal AMBA data sets,
 using either a (bilateral) coronal or (unilateral) sagittal mask. When
 importing the sagittal data set, the script will only import those
 genes that are also present in the coronal data set.
+
+In streaming mode, the experiments are downloaded directly from the 
+Allen Brain Atlas API and every volume is masked and written into the
+matrix as it arrives, while other downloads are still in flight. No 
+MINC files are written.
+
+If a memory budget is specified with --max-memory, experiments are 
+processed in chunks that fit in the budget. Every chunk is folded into
+running per-gene sums and the matrix is written to file as genes are
+completed, so that the full experiment-by-voxel matrix is never held
+in memory.
 """
 
 # Packages -------------------------------------------------------------------
 
 import argparse
 import os
+import tempfile
 import warnings
+import h5py
 import numpy                as np
 import pandas               as pd
 import multiprocessing      as mp
 from pyminc.volumes.factory import volumeFromFile
 from re                     import sub
 from glob                   import glob
+from scipy                  import sparse
 from tqdm                   import tqdm
 from functools              import partial
-from sklearn.impute         import KNNImputer
-from sklearn.preprocessing  import FunctionTransformer
-from sklearn.pipeline       import Pipeline
+from concurrent.futures     import ThreadPoolExecutor, as_completed
+from knn_imputation         import knn_impute
+from download_AMBA          import (read_genes, read_manifest, 
+                                    fetch_metadata, 
+                                    create_session, fetch_expression, 
+                                    reorient_to_standard)
 
 # Functions ------------------------------------------------------------------
 
@@ -62,6 +81,36 @@ def parse_args():
                 "contain expression MINC files.")
     )
     
+    parser.add_argument(
+        '--store',
+        type = str,
+        help = ("Name of the HDF5 expression store created by "
+                "download_AMBA.py in the 'coronal' and 'sagittal' "
+                "sub-directories of --datadir. If specified, expression "
+                "data are read from the store instead of MINC files.")
+    )
+    
+    parser.add_argument(
+        '--manifest',
+        type = str,
+        default = 'manifest.csv',
+        help = ("Index written by download_AMBA.py in the dataset "
+                "sub-directories of --datadir, from which MINC files and "
+                "genes are resolved. If not found, the dataset directory "
+                "is searched for MINC files instead.")
+    )
+    
+    parser.add_argument(
+        '--channel',
+        type = str,
+        default = 'energy',
+        choices = ['energy', 'density', 'intensity'],
+        help = ("ISH channel from which to build the matrix. Channels "
+                "other than 'energy' are read from the sub-directory of "
+                "the dataset directory named after the channel, or from "
+                "the corresponding data set in the store.")
+    )
+    
     parser.add_argument(
         '--imgdir',
         type = str,
@@ -93,6 +142,81 @@ def parse_args():
 
     )
     
+    parser.add_argument(
+        '--genes',
+        type = str,
+        help = ("Path to a file containing the mouse genes to include, "
+                "one per line. If not specified, all genes are included.")
+    )
+    
+    parser.add_argument(
+        '--homologs',
+        type = str,
+        help = ("Path to a CSV file containing mouse-human homologous "
+                "genes in columns 'Mouse' and 'Human'. If specified, only "
+                "genes with a human homologue are included.")
+    )
+    
+    parser.add_argument(
+        '--stream',
+        type = str,
+        default = 'false',
+        choices = ['true', 'false'],
+        help = ("Option to download the experiments from the AMBA API "
+                "and build the matrix as they arrive, instead of reading "
+                "MINC files or a store from --datadir.")
+    )
+    
+    parser.add_argument(
+        '--metadata',
+        type = str,
+        help = ("File in --datadir containing the AMBA metadata for "
+                "--dataset, used in streaming mode. Defaults to "
+                "'AMBA_metadata_<dataset>.csv'. Downloaded from the API if "
+                "not found.")
+    )
+    
+    parser.add_argument(
+        '--metadata-coronal',
+        type = str,
+        help = ("File in --datadir containing the AMBA metadata for the "
+                "coronal dataset, used in streaming mode to select the "
+                "genes of the sagittal dataset when no coronal data were "
+                "downloaded. Defaults to 'AMBA_metadata_coronal.csv'. "
+                "Downloaded from the API if not found.")
+    )
+    
+    parser.add_argument(
+        '--connections',
+        type = int,
+        default = 50,
+        help = ("Number of concurrent HTTP requests in streaming mode.")
+    )
+    
+    parser.add_argument(
+        '--api-url',
+        type = str,
+        default = 'http://api.brain-map.org',
+        help = "Base URL of the Allen Brain Atlas API."
+    )
+    
+    parser.add_argument(
+        '--retries',
+        type = int,
+        default = 3,
+        help = ("Number of times a failed or throttled request is retried "
+                "in streaming mode.")
+    )
+    
+    parser.add_argument(
+        '--timeout',
+        type = float,
+        default = 60.0,
+        help = ("Time in seconds to wait for a connection to be "
+                "established or for data to be received before a request "
+                "is failed in streaming mode.")
+    )
+    
     parser.add_argument(
         '--log2',
         type = str,
@@ -109,6 +233,17 @@ def parse_args():
         help = "Option to group multiple ISH experiments per gene."
     )
     
+    parser.add_argument(
+        '--aggregate',
+        type = str,
+        default = 'mean',
+        choices = ['mean', 'median', 'coverage'],
+        help = ("Method used to group multiple ISH experiments per gene: "
+                "the voxel-wise mean or median, or the experiment with "
+                "the fewest empty voxels. Only 'mean' is available with "
+                "--max-memory.")
+    )
+    
     parser.add_argument(
         '--threshold',
         type = float,
@@ -125,6 +260,22 @@ def parse_args():
                 "K-nearest neighbours imputation.")
     )
     
+    parser.add_argument(
+        '--nthreads',
+        type = int,
+        help = ("Number of threads used for imputation. Defaults to the "
+                "number of CPUs.")
+    )
+    
+    parser.add_argument(
+        '--knn-components',
+        type = int,
+        help = ("If specified, nearest neighbours are searched "
+                "approximately using this many principal components of "
+                "the expression data, which is much faster for large "
+                "matrices.")
+    )
+    
     parser.add_argument(
         '--parallel',
         type = str,
@@ -141,6 +292,24 @@ def parse_args():
                 "Ignored if --parallel set to false.")
     )
     
+    parser.add_argument(
+        '--tmpdir',
+        type = str,
+        help = ("Directory in which the memory-mapped expression matrix "
+                "shared by the parallel workers is created. Defaults to "
+                "the system temporary directory. Ignored if --parallel "
+                "set to false.")
+    )
+    
+    parser.add_argument(
+        '--max-memory',
+        type = float,
+        help = ("Memory budget in megabytes. If specified, experiments "
+                "are processed in chunks that fit in the budget and the "
+                "matrix is written to file as genes are completed. Not "
+                "available in streaming mode or with imputation.")
+    )
+    
     parser.add_argument(
         '--verbose',
         type = str,
@@ -154,6 +323,204 @@ def parse_args():
     return args
     
     
+def getChannelDir(datadir, dataset, channel = 'energy'):
+    
+    """
+    Get the directory containing the MINC files of an ISH channel
+    
+    Arguments
+    ---------
+    datadir: str
+        Directory containing AMBA data.
+    dataset: str
+        AMBA dataset.
+    channel: str, optional
+        ISH channel. Expression energy is stored in the dataset 
+        directory and other channels in sub-directories named after
+        the channel. (default 'energy')
+        
+    Returns
+    -------
+    channelDir: str
+        Path to the channel directory.
+    """
+    
+    if channel == 'energy':
+        return os.path.join(datadir, dataset, '')
+    
+    return os.path.join(datadir, dataset, channel, '')
+    
+
+def listExpressionFiles(datadir, dataset, channel = 'energy', 
+                        manifest = 'manifest.csv'):
+    
+    """
+    List the expression MINC files of a dataset and their genes
+    
+    Description
+    -----------
+    Files are resolved from the download index written by 
+    download_AMBA.py in the dataset directory, which records the 
+    experiment ID, gene, channel and relative path of every complete
+    download. Indexed files that are missing from the dataset directory
+    are skipped with a warning. If the index does not exist, the 
+    channel directory is searched for MINC files and genes are parsed
+    from the file names.
+    
+    Arguments
+    ---------
+    datadir: str
+        Directory containing AMBA data.
+    dataset: str
+        AMBA dataset.
+    channel: str, optional
+        ISH channel. (default 'energy')
+    manifest: str, optional
+        Name of the index file in the dataset directory. 
+        (default 'manifest.csv')
+        
+    Returns
+    -------
+    dfFiles: pandas.core.frame.DataFrame
+        A DataFrame with columns 'path' and 'gene'.
+    """
+    
+    pathDataset = os.path.join(datadir, dataset, '')
+    
+    if (manifest is not None) and os.path.isfile(pathDataset+manifest):
+        
+        dfIndex = read_manifest(pathDataset+manifest)
+        isFile = ((dfIndex['status'] == 'complete') &
+                  (dfIndex['channel'] == channel) &
+                  dfIndex['path'].str.endswith('.mnc'))
+        dfFiles = (dfIndex
+                   .loc[isFile, ['path', 'gene']]
+                   .reset_index(drop = True))
+        dfFiles['path'] = pathDataset+dfFiles['path']
+        
+        exists = dfFiles['path'].map(os.path.isfile)
+        if not exists.all():
+            warnings.warn("{} files in {} are missing from {}. Skipping "
+                          "them.".format((~exists).sum(), manifest, 
+                                         pathDataset))
+            dfFiles = dfFiles.loc[exists].reset_index(drop = True)
+        
+    else:
+        
+        pathGeneFiles = glob(getChannelDir(datadir, dataset, channel)+'*.mnc')
+        genes = [sub(r'_[0-9]+.mnc', '', os.path.basename(path)) 
+                 for path in pathGeneFiles]
+        dfFiles = pd.DataFrame({'path': pathGeneFiles, 'gene': genes})
+        
+    return dfFiles
+    
+
+def importMask(mask):
+    
+    """
+    Import a MINC mask as flat voxel indices
+    
+    Arguments
+    ---------
+    mask: str
+        Path to the MINC file containing the mask.
+        
+    Returns
+    -------
+    maskIndex: numpy.ndarray
+        Indices of the voxels in the mask in the flattened volume.
+    """
+    
+    maskVol = volumeFromFile(mask)
+    maskIndex = np.flatnonzero(np.ravel(maskVol.data) == 1)
+    maskVol.closeVolume()
+    
+    return maskIndex
+
+
+#Memory used per voxel of an experiment when building the expression
+#matrix in chunks, in the worst case where every experiment is a 
+#different gene: the float32 chunk of experiments, the float64 sums 
+#and int32 counts from aggregateChunk(), and the float64 copy of the 
+#sums and int32 counts of the genes kept by writeExpressionChunk(). The
+#boolean masks of aggregateChunk() are released before the chunk is 
+#written.
+CHUNK_INPUT_BYTES = 4
+CHUNK_AGGREGATE_BYTES = 8 + 4
+CHUNK_OUTPUT_BYTES = 8 + 4
+CHUNK_BYTES_PER_VOXEL = (CHUNK_INPUT_BYTES + CHUNK_AGGREGATE_BYTES + 
+                         CHUNK_OUTPUT_BYTES)
+
+
+#Mask indices and memory-mapped expression matrix of the current worker
+#process
+_maskIndex = None
+_matrix = None
+
+
+def initImportImage(mask, matrixfile = None, shape = None):
+    
+    """
+    Load the mask once in a worker process
+    
+    Description
+    -----------
+    If `matrixfile` is specified, the worker also maps the expression 
+    matrix file so that images can be written directly into its rows.
+    
+    Arguments
+    ---------
+    mask: str
+        Path to the MINC file containing the mask.
+    matrixfile: str, optional
+        Path to the float32 file backing the expression matrix. 
+        (default None)
+    shape: tuple of int, optional
+        Shape of the expression matrix. (default None)
+        
+    Returns
+    -------
+    None
+    """
+    
+    global _maskIndex, _matrix
+    _maskIndex = importMask(mask)
+    if matrixfile is not None:
+        _matrix = np.memmap(matrixfile, dtype = 'float32', mode = 'r+',
+                            shape = shape)
+    
+    return
+
+
+def importImageWorker(task):
+    
+    """
+    Import a MINC file into a row of the expression matrix
+    
+    Description
+    -----------
+    The image is masked using the mask of the current worker process
+    and written into the memory-mapped expression matrix, so that only
+    the row index is returned to the parent process.
+    
+    Arguments
+    ---------
+    task: tuple
+        Row index of the image in the matrix and path to the MINC file
+        to import.
+        
+    Returns
+    -------
+    i: int
+        Row index of the imported image.
+    """
+    
+    i, img = task
+    _matrix[i] = importImage(img = img, mask = _maskIndex)
+    
+    return i
+
+
 def importImage(img, mask):
     
     """
@@ -169,9 +536,9 @@ def importImage(img, mask):
     ---------
     img: str
         Path to the MINC file to import.
-    mask: str
-        Path to the the MINC file containing the mask. Must be in
-        the same space as `img`.
+    mask: str or numpy.ndarray
+        Path to the the MINC file containing the mask, or the mask 
+        indices from importMask(). Must be in the same space as `img`.
 
     Returns
     -------
@@ -180,166 +547,1120 @@ def importImage(img, mask):
         values.
     """
     
-    #Import mask mask and convert to numpy array
-    maskVol = volumeFromFile(mask)
-    maskArray = np.array(maskVol.data.flatten())
-    maskVol.closeVolume()
+    if isinstance(mask, str):
+        mask = importMask(mask)
     
-    #Read ISH data to numpy array
+    #Read ISH data and gather the masked voxels
     imageVol = volumeFromFile(img)
-    imageArray = np.array(imageVol.data.flatten())
+    imageArrayMasked = np.ravel(imageVol.data)[mask]
     imageVol.closeVolume()
     
-    #Apply mask and convert -1 to NaN
-    imageArrayMasked = imageArray[maskArray == 1]
+    #Convert -1 and 0 to NaN
     imageArrayMasked[imageArrayMasked == -1] = np.nan
     imageArrayMasked[imageArrayMasked == 0] = np.nan
     
     return imageArrayMasked
 
 
-def buildExpressionMatrix(files, mask, log_transform = True,
-                          group_experiments = True, threshold = None, 
-                          parallel = True, nproc = None, verbose = True):
+def importStore(storefile, mask, genes = None, channel = 'energy',
+                chunksize = 256):
+    
+    """
+    Import masked expression data from an expression store
+    
+    Description
+    -----------
+    This function imports the expression volumes from the HDF5 store
+    written by download_AMBA.py. Volumes are read in blocks of rows 
+    and masked using the mask provided. Experiments for which the 
+    channel was not downloaded are skipped. Values of -1 and 0 are 
+    replaced with NumPy NaNs.
     
-    """ 
-    Build gene-by-voxel expression matrix
-
     Arguments
     ---------
-    files: list of str
-        List containing paths to expression MINC files.
+    storefile: str
+        Path to the HDF5 expression store.
     mask: str
-        Path to mask MINC file.
-    log_transform: bool, optional
-        Option to apply a log2 transform to the expression values.
-        (default True)
-    group_experiments: bool, optional,
-        Option to compute the voxel-wise average of expression values 
-        for experiments that correspond to the same gene. (default True)
-    threshold: float, optional
-        Threshold value indicating the fraction of empty voxels in an 
-        image above which the image is discarded (default None)
-    parallel: bool, optional
-        Option to import MINC files in parallel. (default True)
-    nproc: int, optional
-        Number of CPUs to use in parallel. If `None`, all CPUs are
-        used. (default None)
-
+        Path to the the MINC file containing the mask. Must be in
+        the same space as the volumes in the store.
+    genes: array-like, optional
+        Genes to import. If None, all experiments in the store are 
+        imported. (default None)
+    channel: str, optional
+        Name of the channel data set to import. (default 'energy')
+    chunksize: int, optional
+        Number of experiments read from the store at a time. 
+        (default 256)
+        
     Returns
     -------
-    dfExpression: pandas.core.frame.DataFrame
-       A DataFrame containing the expression of experiments/genes in
-       the Allen Mouse Brain Atlas. If `group_experiments` is False,
-       every row corresponds to an experiment. If `group_experiments`
-       is True, every row corresponds to a gene.
+    arrays: numpy.ndarray
+        A 2-dimensional array containing the masked voxel values,
+        with experiments as rows.
+    storeGenes: numpy.ndarray
+        Gene acronyms for the rows of `arrays`.
     """
     
-    importImage_partial = partial(importImage, mask = mask)
-
-    if parallel:
-
-        if nproc is None:
-            nproc = mp.cpu_count()
-
-        pool = mp.Pool(nproc)
-
-        arrays = []
-        for array in tqdm(pool.imap(importImage_partial, files),
-                          total = len(files)):
-            arrays.append(array)
-
-        pool.close()
-        pool.join()
+    maskIndex = importMask(mask)
+    
+    with h5py.File(storefile, 'r') as store:
+        
+        storeGenes = store['gene'].asstr()[:]
+        rows = np.arange(len(storeGenes))
+        if genes is not None:
+            rows = rows[np.isin(storeGenes, genes)]
+        
+        arrays = np.empty((len(rows), len(maskIndex)), dtype = 'float32')
+        for i in tqdm(range(0, len(rows), chunksize)):
+            block = store[channel][rows[i:i+chunksize]]
+            arrays[i:i+chunksize] = block[:, maskIndex]
+            
+    #Rows of experiments without this channel are filled with NaN
+    present = ~np.all(np.isnan(arrays), axis = 1)
+    arrays = arrays[present]
+    rows = rows[present]
+            
+    arrays[arrays == -1] = np.nan
+    arrays[arrays == 0] = np.nan
+    
+    return arrays, storeGenes[rows]
 
-    else:
 
-        arrays = list(map(importImage_partial, tqdm(files)))
+def importMetadata(datadir, dataset, metadata = None, 
+                   api_url = 'http://api.brain-map.org', retries = 0, 
+                   timeout = 60.0, verbose = True):
     
-    dfExpression = pd.DataFrame(np.asarray(arrays), 
-                   index = [os.path.basename(file) for file in files])
-
-    #Transform to log2
-    if log_transform:
-        if verbose:
-            print("Applying log2 transform...")
-        dfExpression = np.log2(dfExpression)
+    """
+    Import the AMBA metadata for a dataset, downloading it if needed
     
-    dfExpression.index = (dfExpression.index
-                          .str.replace('.mnc', '', regex = True)
-                          .str.replace('_.*', '', regex = True))
+    Arguments
+    ---------
+    datadir: str
+        Directory containing AMBA data.
+    dataset: str
+        AMBA dataset.
+    metadata: str, optional
+        File in `datadir` containing the metadata. If None, 
+        'AMBA_metadata_<dataset>.csv' is used. (default None)
+    api_url: str, optional
+        Base URL of the Allen Brain Atlas API, used if the metadata 
+        are downloaded. (default 'http://api.brain-map.org')
+    retries: int, optional
+        Maximal number of retries of the metadata request. (default 0)
+    timeout: float, optional
+        Time in seconds to wait for the connection and for every read
+        from the server. (default 60.0)
+    verbose: bool, optional
+        Verbosity option. (default True)
         
-    dfExpression.index.name = 'Gene'
+    Returns
+    -------
+    dfMetadata: pandas.core.frame.DataFrame
+        A DataFrame containing the AMBA metadata.
+    """
     
-    #Aggregate experiments per gene if flag is set
-    if group_experiments:
-        if verbose:
-            print("Aggregating multiple experiments per gene...")
-        dfExpression = (dfExpression
-                        .groupby(dfExpression.index)
-                        .aggregate(np.mean))
+    if metadata is None:
+        metadata = 'AMBA_metadata_{}.csv'.format(dataset)
         
-    if threshold is not None:
-        #Remove genes where a threshold of voxels aren't expressing
-        fracVoxelsNA = dfExpression.isna().sum(axis=1)/len(dfExpression.columns)
-        dfExpression = dfExpression[fracVoxelsNA < threshold]
+    if not os.path.isfile(os.path.join(datadir, metadata)):
+        fetch_metadata(dataset = dataset,
+                       outdir = os.path.join(datadir, ''),
+                       outfile = metadata,
+                       api_url = api_url,
+                       retries = retries,
+                       timeout = timeout,
+                       verbose = verbose)
+        
+    dfMetadata = pd.read_csv(os.path.join(datadir, metadata))
     
-    return dfExpression
-
-# Main -----------------------------------------------------------------------
+    return dfMetadata
 
-def main():
 
-    #Load command line arguments
-    args = parse_args()
-    datadir = args['datadir']
-    imgdir = args['imgdir']
-    outdir = args['outdir']
-    dataset = args['dataset']
-    mask = args['mask']
-    verbose = True if args['verbose'] == 'true' else False
+def importCoronalGenes(datadir, channel = 'energy', store = None,
+                       manifest = 'manifest.csv', metadata = None,
+                       api_url = 'http://api.brain-map.org', retries = 0,
+                       timeout = 60.0, verbose = True):
     
-    if verbose:
-        print("Importing {} dataset using {} mask".format(dataset, mask))
+    """
+    Import the genes of the coronal dataset
     
-    if (dataset == 'sagittal') and (mask == 'coronal'):
-        raise Exception("Using the sagittal dataset with the coronal mask "
-                        "results in a lot of empty voxels. Choose another "
-                        "combination.")
+    Description
+    -----------
+    The genes are those of the downloaded coronal experiments, read 
+    from the store if it exists or from the download index or MINC 
+    files otherwise. If no coronal experiments were downloaded, the 
+    genes in the coronal metadata are used.
     
-    #If dataset is sagittal, use only those genes that are also in the
-    #coronal set
-    if dataset == 'sagittal':
+    Arguments
+    ---------
+    datadir: str
+        Directory containing AMBA data.
+    channel: str, optional
+        ISH channel. (default 'energy')
+    store: str, optional
+        Name of the store file in the coronal directory. (default None)
+    manifest: str, optional
+        Name of the index file in the coronal directory.
+        (default 'manifest.csv')
+    metadata: str, optional
+        File in `datadir` containing the coronal metadata. If None, 
+        'AMBA_metadata_coronal.csv' is used. (default None)
+    api_url: str, optional
+        Base URL of the Allen Brain Atlas API, used if the metadata 
+        are downloaded. (default 'http://api.brain-map.org')
+    retries: int, optional
+        Maximal number of retries of the metadata request. (default 0)
+    timeout: float, optional
+        Time in seconds to wait for the connection and for every read
+        from the server. (default 60.0)
+    verbose: bool, optional
+        Verbosity option. (default True)
         
-        #Paths to sagittal and coronal data set directories
-        pathGeneDir_Sagittal = os.path.join(datadir, dataset, '')
-        pathGeneDir_Coronal = os.path.join(datadir, 'coronal', '')
-
-        #Build paths to all files in the directories
-        pathGeneFiles_Sagittal = glob(pathGeneDir_Sagittal + '*.mnc')
-        pathGeneFiles_Coronal = glob(pathGeneDir_Coronal + '*.mnc')
-
-        #Extract gene names for coronal and sagittal data sets
-        genes_Sagittal = [sub(r'_[0-9]+.mnc', '', file) for file in 
-                [os.path.basename(path) for path in pathGeneFiles_Sagittal]]
-        genes_Coronal = [sub(r'_[0-9]+.mnc', "", file) for file in 
-                [os.path.basename(path) for path in pathGeneFiles_Coronal]]
-
-        #Identify genes from sagittal data in coronal data
-        isInCoronal = np.isin(np.array(genes_Sagittal),
-                              np.array(genes_Coronal))
-
-        #Extract subset of sagittal gene files
-        pathGeneFiles_Sagittal = np.array(pathGeneFiles_Sagittal)
-        pathGeneFiles = list(pathGeneFiles_Sagittal[isInCoronal])
+    Returns
+    -------
+    genes: numpy.ndarray
+        Array containing the coronal genes.
+    """
+    
+    if store is not None:
+        storefile = os.path.join(datadir, 'coronal', store)
+        if os.path.isfile(storefile):
+            with h5py.File(storefile, 'r') as f:
+                return f['gene'].asstr()[:]
+    
+    dfFiles = listExpressionFiles(datadir = datadir,
+                                  dataset = 'coronal',
+                                  channel = channel,
+                                  manifest = manifest)
+    if len(dfFiles) > 0:
+        return dfFiles['gene'].to_numpy()
+    
+    dfMetadata = importMetadata(datadir = datadir,
+                                dataset = 'coronal',
+                                metadata = metadata,
+                                api_url = api_url,
+                                retries = retries,
+                                timeout = timeout,
+                                verbose = verbose)
+    
+    return dfMetadata['gene'].to_numpy()
+
+
+def streamExpressionMatrix(experiments, mask, channel = 'energy', 
+                           connections = 50, 
+                           api_url = 'http://api.brain-map.org',
+                           retries = 3, timeout = 60.0):
+    
+    """
+    Download ISH experiments and mask them as they arrive
+    
+    Description
+    -----------
+    Experiments are downloaded from a pool of threads sharing a single
+    keep-alive HTTP session. As every download completes, the volume 
+    is decoded in memory, reoriented, masked and written into its row 
+    of the preallocated matrix, while the remaining downloads are 
+    still in flight. Values of -1 and 0 are replaced with NumPy NaNs.
+    Experiments that fail to download or have no data are skipped.
+    
+    Arguments
+    ---------
+    experiments: list of tuple
+        List of ISH experiments. Element 0 of every tuple must contain 
+        the experiment ID as `int`. Element 1 must contain the gene 
+        acronym as `str`.
+    mask: str
+        Path to the the MINC file containing the mask.
+    channel: str, optional
+        ISH channel to import. (default 'energy')
+    connections: int, optional
+        Number of concurrent HTTP requests. (default 50)
+    api_url: str, optional
+        Base URL of the Allen Brain Atlas API. 
+        (default 'http://api.brain-map.org')
+    retries: int, optional
+        Maximal number of retries for failed or throttled requests.
+        (default 3)
+    timeout: float, optional
+        Time in seconds to wait for the connection and for every read
+        from the server. (default 60.0)
+        
+    Returns
+    -------
+    arrays: numpy.ndarray
+        A 2-dimensional array containing the masked voxel values,
+        with experiments as rows.
+    genes: numpy.ndarray
+        Gene acronyms for the rows of `arrays`.
+    """
+    
+    maskIndex = importMask(mask)
+    
+    arrays = np.empty((len(experiments), len(maskIndex)), dtype = 'float32')
+    imported = np.zeros(len(experiments), dtype = bool)
+    
+    session = create_session(pool_size = connections)
+    fetchExpression_partial = partial(fetch_expression,
+                                      session = session,
+                                      api_url = api_url,
+                                      retries = retries,
+                                      timeout = timeout,
+                                      channels = [channel])
+    
+    with ThreadPoolExecutor(max_workers = connections) as executor:
+        
+        futures = {executor.submit(fetchExpression_partial, experiment[0]): i
+                   for i, experiment in enumerate(experiments)}
+        
+        for future in tqdm(as_completed(futures), total = len(futures)):
+            
+            #Drop the reference to the future to release its data
+            i = futures.pop(future)
+            
+            try:
+                data, success = future.result()
+            except Exception as err:
+                print("Error downloading experiment {}: {}. Ignoring."
+                      .format(experiments[i][0], err))
+                continue
+                
+            if success == 1:
+                volume = reorient_to_standard(np.reshape(data[channel], 
+                                                         (58, 41, 67)))
+                arrays[i] = volume.ravel()[maskIndex]
+                imported[i] = True
+                
+    session.close()
+    
+    #Move the imported rows to the top of the matrix in place and 
+    #shrink it, since indexing with `imported` would copy the matrix
+    rows = np.flatnonzero(imported)
+    for n, i in enumerate(rows):
+        if n != i:
+            arrays[n] = arrays[i]
+    arrays.resize((len(rows), len(maskIndex)), refcheck = False)
+    
+    arrays[arrays == -1] = np.nan
+    arrays[arrays == 0] = np.nan
+    
+    genes = np.array([experiment[1] for experiment in experiments])
+    
+    return arrays, genes[rows]
+
+
+def parseGenes(files):
+    
+    """
+    Parse gene acronyms from the names of expression MINC files
+    
+    Arguments
+    ---------
+    files: list of str
+        List containing paths to expression MINC files, named 
+        '<gene>_<experiment>.mnc' or '<gene>.mnc'.
+        
+    Returns
+    -------
+    genes: list of str
+        Gene acronyms for `files`.
+    """
+    
+    return [sub(r'_.*|\.mnc$', '', os.path.basename(file)) for file in files]
+
+
+def aggregateExperiments(arrays, genes, method = 'mean', blocksize = 4096):
+    
+    """
+    Aggregate the expression of experiments that correspond to the
+    same gene
+    
+    Description
+    -----------
+    Experiments are mapped to integer gene codes, with genes in 
+    alphabetical order. The following methods are available:
+    1. 'mean': Voxel-wise average of the non-missing values, computed
+       as the product of a sparse gene-by-experiment indicator matrix
+       with blocks of voxels.
+    2. 'median': Voxel-wise median of the non-missing values.
+    3. 'coverage': Experiment with the fewest missing voxels. Ties are
+       resolved in favour of the first experiment.
+    
+    Arguments
+    ---------
+    arrays: numpy.ndarray
+        A 2-dimensional array containing the masked voxel values,
+        with experiments as rows.
+    genes: array-like
+        Gene acronyms for the rows of `arrays`.
+    method: str, optional
+        Aggregation method. One of {'mean', 'median', 'coverage'}.
+        (default 'mean')
+    blocksize: int, optional
+        Number of voxels aggregated at a time with method 'mean'.
+        (default 4096)
+        
+    Returns
+    -------
+    aggregated: numpy.ndarray
+        A 2-dimensional float32 array containing the aggregated voxel
+        values, with genes as rows.
+    labels: numpy.ndarray
+        Gene acronyms for the rows of `aggregated`.
+    """
+    
+    codes, labels = pd.factorize(np.asarray(genes, dtype = 'object'), 
+                                 sort = True)
+    labels = np.asarray(labels)
+    
+    if method == 'mean':
+        
+        indicator = sparse.csr_matrix(
+            (np.ones(len(codes), dtype = 'float32'), 
+             (codes, np.arange(len(codes)))),
+            shape = (len(labels), len(codes))
+        )
+        
+        #Voxel blocks bound the size of the temporary arrays
+        aggregated = np.empty((len(labels), arrays.shape[1]), 
+                              dtype = 'float32')
+        for i in range(0, arrays.shape[1], blocksize):
+            block = arrays[:, i:i+blocksize]
+            valid = ~np.isnan(block)
+            sums = indicator @ np.where(valid, block, 0).astype('float32',
+                                                                copy = False)
+            counts = indicator @ valid.astype('float32')
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                aggregated[:, i:i+blocksize] = sums / counts
+    
+    elif method == 'median':
+        
+        order = np.argsort(codes, kind = 'stable')
+        starts = np.flatnonzero(np.r_[True, np.diff(codes[order]) != 0])
+        
+        aggregated = np.empty((len(labels), arrays.shape[1]), 
+                              dtype = 'float32')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category = RuntimeWarning)
+            for j, rows in enumerate(np.split(order, starts[1:])):
+                if len(rows) == 1:
+                    aggregated[j] = arrays[rows[0]]
+                else:
+                    aggregated[j] = np.nanmedian(arrays[rows], axis = 0)
+    
+    elif method == 'coverage':
+        
+        coverage = (~np.isnan(arrays)).sum(axis = 1)
+        order = np.lexsort((np.arange(len(codes)), -coverage, codes))
+        first = np.r_[True, np.diff(codes[order]) != 0]
+        aggregated = arrays[order[first]].astype('float32', copy = False)
+        
+    else:
+        raise ValueError("Argument method must be one of "
+                         "{{'mean', 'median', 'coverage'}}. Got {}."
+                         .format(method))
+    
+    return aggregated, labels
+
+
+def processExpressionMatrix(arrays, genes, log_transform = True, 
+                            group_experiments = True, aggregate = 'mean',
+                            threshold = None, verbose = True):
+    
+    """
+    Process an experiment-by-voxel expression matrix
+    
+    Arguments
+    ---------
+    arrays: numpy.ndarray
+        A 2-dimensional float array containing the masked voxel values,
+        with experiments as rows. The array is transformed in place 
+        and used as the data of the returned DataFrame.
+    genes: array-like
+        Gene acronyms for the rows of `arrays`.
+    log_transform: bool, optional
+        Option to apply a log2 transform to the expression values.
+        (default True)
+    group_experiments: bool, optional,
+        Option to aggregate the expression values of experiments that
+        correspond to the same gene. (default True)
+    aggregate: str, optional
+        Method used to aggregate experiments per gene. See 
+        aggregateExperiments(). (default 'mean')
+    threshold: float, optional
+        Threshold value indicating the fraction of empty voxels in an 
+        image above which the image is discarded (default None)
+        
+    Returns
+    -------
+    dfExpression: pandas.core.frame.DataFrame
+       A DataFrame containing the expression of experiments/genes.
+    """
+    
+    #Transform to log2 in place
+    if log_transform:
+        if verbose:
+            print("Applying log2 transform...")
+        np.log2(arrays, out = arrays)
+    
+    #Aggregate experiments per gene if flag is set
+    if group_experiments:
+        if verbose:
+            print("Aggregating multiple experiments per gene...")
+        arrays, genes = aggregateExperiments(arrays = arrays, 
+                                             genes = genes,
+                                             method = aggregate)
+        
+    dfExpression = pd.DataFrame(arrays, 
+                                index = pd.Index(genes, name = 'Gene'), 
+                                copy = False)
+        
+    if threshold is not None:
+        #Remove genes where a threshold of voxels aren't expressing
+        fracVoxelsNA = dfExpression.isna().sum(axis=1)/len(dfExpression.columns)
+        dfExpression = dfExpression[fracVoxelsNA < threshold]
+    
+    return dfExpression
+
+
+def buildExpressionMatrix(files, mask, genes = None, log_transform = True,
+                          group_experiments = True, aggregate = 'mean',
+                          threshold = None, parallel = True, nproc = None, 
+                          tmpdir = None,
+                          verbose = True):
+    
+    """ 
+    Build gene-by-voxel expression matrix
+    
+    Description
+    -----------
+    The masked images are imported into the rows of a preallocated
+    float32 matrix. In parallel mode, the matrix is backed by a 
+    temporary memory-mapped file that the worker processes write into
+    directly, so that only row indices are sent between processes and
+    a single copy of the matrix is held in memory.
+
+    Arguments
+    ---------
+    files: list of str
+        List containing paths to expression MINC files.
+    mask: str
+        Path to mask MINC file.
+    genes: list of str, optional
+        Gene acronyms for `files`. If None, genes are parsed from the
+        file names. (default None)
+    log_transform: bool, optional
+        Option to apply a log2 transform to the expression values.
+        (default True)
+    group_experiments: bool, optional,
+        Option to aggregate the expression values of experiments that
+        correspond to the same gene. (default True)
+    aggregate: str, optional
+        Method used to aggregate experiments per gene. See 
+        aggregateExperiments(). (default 'mean')
+    threshold: float, optional
+        Threshold value indicating the fraction of empty voxels in an 
+        image above which the image is discarded (default None)
+    parallel: bool, optional
+        Option to import MINC files in parallel. (default True)
+    nproc: int, optional
+        Number of CPUs to use in parallel. If `None`, all CPUs are
+        used. (default None)
+    tmpdir: str, optional
+        Directory in which to create the memory-mapped matrix file in
+        parallel mode. If `None`, the system temporary directory is 
+        used. (default None)
+
+    Returns
+    -------
+    dfExpression: pandas.core.frame.DataFrame
+       A DataFrame containing the expression of experiments/genes in
+       the Allen Mouse Brain Atlas. If `group_experiments` is False,
+       every row corresponds to an experiment. If `group_experiments`
+       is True, every row corresponds to a gene.
+    """
+    
+    maskIndex = importMask(mask)
+    shape = (len(files), len(maskIndex))
+    
+    if parallel:
+
+        if nproc is None:
+            nproc = mp.cpu_count()
+        
+        #Preallocate the matrix in a memory-mapped file shared with the
+        #workers, which write their images into it directly
+        fd, matrixfile = tempfile.mkstemp(suffix = '.dat', dir = tmpdir)
+        os.close(fd)
+        try:
+            arrays = np.memmap(matrixfile, dtype = 'float32', mode = 'w+',
+                               shape = shape)
+            
+            #Every worker loads the mask once
+            pool = mp.Pool(nproc, initializer = initImportImage, 
+                           initargs = (mask, matrixfile, shape))
+            
+            tasks = pool.imap_unordered(importImageWorker, enumerate(files))
+            for i in tqdm(tasks, total = len(files)):
+                pass
+            
+            pool.close()
+            pool.join()
+        finally:
+            #The parent mapping remains valid once the file is removed
+            os.remove(matrixfile)
+
+    else:
+
+        arrays = np.empty(shape, dtype = 'float32')
+        for i, file in enumerate(tqdm(files)):
+            arrays[i] = importImage(img = file, mask = maskIndex)
+    
+    if genes is None:
+        genes = parseGenes(files)
+    
+    dfExpression = processExpressionMatrix(arrays = arrays,
+                                           genes = genes,
+                                           log_transform = log_transform,
+                                           group_experiments = group_experiments,
+                                           aggregate = aggregate,
+                                           threshold = threshold,
+                                           verbose = verbose)
+    
+    return dfExpression
+
+def importImageChunk(rows, files, arrays, mask = None, pool = None):
+    
+    """
+    Import a chunk of MINC files into the rows of a preallocated matrix
+    
+    Arguments
+    ---------
+    rows: numpy.ndarray
+        Indices of the files to import.
+    files: list of str
+        List containing paths to expression MINC files.
+    arrays: numpy.ndarray
+        Matrix into which the images are written. If `pool` is 
+        specified, this must be the memory-mapped matrix of the 
+        workers.
+    mask: numpy.ndarray, optional
+        Mask indices from importMask(). Required if `pool` is None.
+        (default None)
+    pool: multiprocessing.pool.Pool, optional
+        Pool of workers initialized with initImportImage(). If None,
+        the files are imported serially. (default None)
         
+    Returns
+    -------
+    arrays: numpy.ndarray
+        View of the rows of the matrix containing the chunk.
+    present: numpy.ndarray
+        Boolean array indicating which rows contain data.
+    """
+    
+    if pool is None:
+        for i, row in enumerate(rows):
+            arrays[i] = importImage(img = files[row], mask = mask)
     else:
-        pathGeneDir = os.path.join(datadir, dataset, '')
-        pathGeneFiles = glob(pathGeneDir+'*.mnc')
+        tasks = [(i, files[row]) for i, row in enumerate(rows)]
+        for i in pool.imap_unordered(importImageWorker, tasks):
+            pass
+    
+    return arrays[:len(rows)], np.ones(len(rows), dtype = bool)
+
+
+def importStoreChunk(rows, store, mask, channel = 'energy'):
+    
+    """
+    Import a chunk of experiments from an expression store
+    
+    Arguments
+    ---------
+    rows: numpy.ndarray
+        Indices of the experiments in the store.
+    store: h5py.File
+        Open HDF5 expression store.
+    mask: numpy.ndarray
+        Mask indices from importMask().
+    channel: str, optional
+        Name of the channel data set to import. (default 'energy')
+        
+    Returns
+    -------
+    arrays: numpy.ndarray
+        A 2-dimensional array containing the masked voxel values,
+        with experiments as rows.
+    present: numpy.ndarray
+        Boolean array indicating which experiments have data for the
+        channel.
+    """
+    
+    #Rows must be read from the store in increasing order
+    order = np.argsort(rows)
+    arrays = np.empty((len(rows), len(mask)), dtype = 'float32')
+    arrays[order] = store[channel][rows[order]][:, mask]
+    
+    present = ~np.all(np.isnan(arrays), axis = 1)
+    arrays[arrays == -1] = np.nan
+    arrays[arrays == 0] = np.nan
+    
+    return arrays, present
+
+
+def getChunkSize(nvoxels, max_memory):
+    
+    """
+    Number of experiments that fit in a memory budget
+    
+    Arguments
+    ---------
+    nvoxels: int
+        Number of voxels in the mask.
+    max_memory: float
+        Memory budget in megabytes.
+        
+    Returns
+    -------
+    chunksize: int
+        Number of experiments processed at a time.
+    """
+    
+    chunksize = int(max_memory * 2**20 // (nvoxels * CHUNK_BYTES_PER_VOXEL))
+    
+    return max(chunksize, 1)
+
+
+def aggregateChunk(arrays, codes, present):
+    
+    """
+    Compute the voxel-wise sums and counts of groups of experiments
+    
+    Description
+    -----------
+    Missing values in `arrays` are set to 0 in place.
+    
+    Arguments
+    ---------
+    arrays: numpy.ndarray
+        A 2-dimensional array containing the masked voxel values,
+        with experiments as rows.
+    codes: numpy.ndarray
+        Group codes for the rows of `arrays`, sorted so that the rows
+        of every group are contiguous.
+    present: numpy.ndarray
+        Boolean array indicating which rows contain data.
+        
+    Returns
+    -------
+    groups: numpy.ndarray
+        Codes of the groups in `arrays`.
+    sums: numpy.ndarray
+        Voxel-wise sums of the non-missing values of every group.
+    counts: numpy.ndarray
+        Voxel-wise numbers of non-missing values of every group.
+    npresent: numpy.ndarray
+        Number of rows containing data in every group.
+    """
+    
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    ends = np.r_[starts[1:], len(codes)]
+    
+    #Groups are reduced one at a time, since reduceat() would first 
+    #cast the whole chunk to float64
+    valid = ~np.isnan(arrays)
+    np.copyto(arrays, 0, where = ~valid)
+    sums = np.empty((len(starts), arrays.shape[1]), dtype = 'float64')
+    counts = np.empty((len(starts), arrays.shape[1]), dtype = 'int32')
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        np.add.reduce(arrays[start:end], axis = 0, dtype = 'float64',
+                      out = sums[i])
+        np.add.reduce(valid[start:end], axis = 0, dtype = 'int32',
+                      out = counts[i])
+    npresent = np.add.reduceat(present, starts, dtype = 'int32')
+    
+    return codes[starts], sums, counts, npresent
+
+
+def writeExpressionChunk(outfile, genes, sums, counts, npresent, 
+                         threshold = None):
+    
+    """
+    Append the average expression of complete genes to a CSV file
+    
+    Arguments
+    ---------
+    outfile: str
+        Path to the CSV file.
+    genes: numpy.ndarray
+        Gene acronyms for the rows of `sums`.
+    sums: numpy.ndarray
+        Voxel-wise sums of the non-missing values of every gene.
+    counts: numpy.ndarray
+        Voxel-wise numbers of non-missing values of every gene.
+    npresent: numpy.ndarray
+        Number of experiments containing data for every gene. Genes
+        without data are discarded.
+    threshold: float, optional
+        Threshold value indicating the fraction of empty voxels above
+        which a gene is discarded (default None)
+        
+    Returns
+    -------
+    nrows: int
+        Number of rows written.
+    """
+    
+    keep = npresent > 0
+    if threshold is not None:
+        fracVoxelsNA = (counts == 0).sum(axis = 1)/counts.shape[1]
+        keep &= fracVoxelsNA < threshold
+    
+    #Boolean indexing copies the sums, which are then divided in place
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        means = sums[keep]
+        means /= counts[keep]
+    means = means.astype('float32')
+    
+    dfExpression = pd.DataFrame(means, 
+                                index = pd.Index(genes[keep], name = 'Gene'))
+    dfExpression.to_csv(outfile, mode = 'a', header = False)
+    
+    return len(dfExpression)
+
 
+def buildExpressionMatrixChunked(importChunk, genes, nvoxels, outfile,
+                                 log_transform = True, 
+                                 group_experiments = True, threshold = None,
+                                 chunksize = 256, verbose = True):
+    
+    """
+    Build a gene-by-voxel expression matrix in chunks of experiments
+    
+    Description
+    -----------
+    Experiments are imported and processed in chunks of `chunksize`,
+    typically from getChunkSize(). Every chunk is log-transformed in place and
+    folded into voxel-wise running sums and counts per gene. Experiments
+    are ordered by gene, so that a gene is complete once the chunk 
+    containing its last experiment has been processed. The average 
+    expression of complete genes is then filtered using the fraction
+    of empty voxels and appended to the output CSV file. Peak memory
+    is therefore independent of the number of experiments.
+    
+    Arguments
+    ---------
+    importChunk: callable
+        Function that imports the experiments with the given row 
+        indices. Must return a 2-dimensional float32 array of masked
+        voxel values with experiments as rows, and a boolean array 
+        indicating which rows contain data.
+    genes: array-like
+        Gene acronyms for all experiments.
+    nvoxels: int
+        Number of voxels in the mask.
+    outfile: str
+        Path to the CSV file in which to write the expression matrix.
+    log_transform: bool, optional
+        Option to apply a log2 transform to the expression values.
+        (default True)
+    group_experiments: bool, optional,
+        Option to compute the voxel-wise average of expression values 
+        for experiments that correspond to the same gene. (default True)
+    threshold: float, optional
+        Threshold value indicating the fraction of empty voxels in an 
+        image above which the image is discarded (default None)
+    chunksize: int, optional
+        Number of experiments processed at a time. (default 256)
+        
+    Returns
+    -------
+    nrows: int
+        Number of rows written to `outfile`.
+    """
+    
+    #Order experiments so that the rows of every gene are contiguous
+    genes = np.asarray(genes, dtype = 'object')
+    if group_experiments:
+        codes, labels = pd.factorize(genes, sort = True)
+        order = np.argsort(codes, kind = 'stable')
+        codes = codes[order]
+    else:
+        order = np.arange(len(genes))
+        codes = order
+        labels = genes
+    
     if verbose:
-        print("Building voxel expression matrix...")
+        print("Processing {} experiments in chunks of {}..."
+              .format(len(genes), chunksize))
+    
+    #Header of the output matrix
+    (pd.DataFrame(columns = range(nvoxels), 
+                  index = pd.Index([], name = 'Gene'))
+     .to_csv(outfile))
+    
+    nrows = 0
+    carry = None
+    for start in tqdm(range(0, len(order), chunksize)):
+        
+        arrays, present = importChunk(order[start:start+chunksize])
+        
+        #Transform to log2 in place
+        if log_transform:
+            np.log2(arrays, out = arrays)
+        
+        groups, sums, counts, npresent = aggregateChunk(
+            arrays = arrays, 
+            codes = codes[start:start+chunksize],
+            present = present
+        )
+        del arrays
+        
+        #Fold in the running totals of the gene continued from the 
+        #previous chunk, or write them if that gene is complete
+        if carry is not None:
+            if groups[0] == carry[0]:
+                sums[0] += carry[1]
+                counts[0] += carry[2]
+                npresent[0] += carry[3]
+            else:
+                nrows += writeExpressionChunk(outfile = outfile,
+                                              genes = labels[[carry[0]]],
+                                              sums = carry[1][np.newaxis],
+                                              counts = carry[2][np.newaxis],
+                                              npresent = np.r_[carry[3]],
+                                              threshold = threshold)
+        
+        #The last gene may continue in the next chunk. Its totals are 
+        #copied so that the arrays of this chunk can be released
+        if start + chunksize < len(order):
+            carry = (groups[-1], sums[-1].copy(), counts[-1].copy(), 
+                     npresent[-1])
+            groups = groups[:-1]
+            sums = sums[:-1]
+            counts = counts[:-1]
+            npresent = npresent[:-1]
+        
+        nrows += writeExpressionChunk(outfile = outfile, 
+                                      genes = labels[groups], 
+                                      sums = sums, 
+                                      counts = counts,
+                                      npresent = npresent,
+                                      threshold = threshold)
+        del sums, counts
+        
+    return nrows
+
+
+def writeExpressionMatrix(files, mask, outfile, genes = None, 
+                          log_transform = True, group_experiments = True,
+                          threshold = None, parallel = True, nproc = None, 
+                          tmpdir = None, max_memory = 1024, verbose = True):
+    
+    """
+    Build a gene-by-voxel expression matrix from MINC files in chunks
+    
+    Description
+    -----------
+    Bounded-memory alternative to buildExpressionMatrix(). The MINC 
+    files are imported in chunks into a buffer whose size is set by
+    `max_memory` and the expression matrix is written directly to 
+    `outfile`. See buildExpressionMatrixChunked() for details.
+    
+    Arguments
+    ---------
+    files: list of str
+        List containing paths to expression MINC files.
+    mask: str
+        Path to mask MINC file.
+    outfile: str
+        Path to the CSV file in which to write the expression matrix.
+    genes: list of str, optional
+        Gene acronyms for `files`. If None, genes are parsed from the
+        file names. (default None)
+    log_transform: bool, optional
+        Option to apply a log2 transform to the expression values.
+        (default True)
+    group_experiments: bool, optional,
+        Option to compute the voxel-wise average of expression values 
+        for experiments that correspond to the same gene. (default True)
+    threshold: float, optional
+        Threshold value indicating the fraction of empty voxels in an 
+        image above which the image is discarded (default None)
+    parallel: bool, optional
+        Option to import MINC files in parallel. (default True)
+    nproc: int, optional
+        Number of CPUs to use in parallel. If `None`, all CPUs are
+        used. (default None)
+    tmpdir: str, optional
+        Directory in which to create the memory-mapped chunk file in
+        parallel mode. If `None`, the system temporary directory is 
+        used. (default None)
+    max_memory: float, optional
+        Memory budget in megabytes. (default 1024)
+        
+    Returns
+    -------
+    nrows: int
+        Number of rows written to `outfile`.
+    """
+    
+    if genes is None:
+        genes = parseGenes(files)
+    
+    maskIndex = importMask(mask)
+    chunksize = getChunkSize(nvoxels = len(maskIndex), 
+                             max_memory = max_memory)
+    shape = (min(chunksize, len(files)), len(maskIndex))
+    
+    buildExpressionMatrix_partial = partial(buildExpressionMatrixChunked,
+                                            genes = genes,
+                                            nvoxels = len(maskIndex),
+                                            outfile = outfile,
+                                            log_transform = log_transform,
+                                            group_experiments = group_experiments,
+                                            threshold = threshold,
+                                            chunksize = chunksize,
+                                            verbose = verbose)
+    
+    if parallel:
+        
+        if nproc is None:
+            nproc = mp.cpu_count()
+        
+        #Chunks are written by the workers into a memory-mapped buffer
+        fd, matrixfile = tempfile.mkstemp(suffix = '.dat', dir = tmpdir)
+        os.close(fd)
+        try:
+            arrays = np.memmap(matrixfile, dtype = 'float32', mode = 'w+',
+                               shape = shape)
+            
+            pool = mp.Pool(nproc, initializer = initImportImage, 
+                           initargs = (mask, matrixfile, shape))
+            
+            nrows = buildExpressionMatrix_partial(
+                importChunk = partial(importImageChunk, 
+                                      files = files, 
+                                      arrays = arrays,
+                                      pool = pool)
+            )
+            
+            pool.close()
+            pool.join()
+        finally:
+            os.remove(matrixfile)
+            
+    else:
+        
+        arrays = np.empty(shape, dtype = 'float32')
+        nrows = buildExpressionMatrix_partial(
+            importChunk = partial(importImageChunk,
+                                  files = files,
+                                  arrays = arrays,
+                                  mask = maskIndex)
+        )
+    
+    return nrows
 
+
+def writeStoreExpressionMatrix(storefile, mask, outfile, genes = None, 
+                               channel = 'energy', log_transform = True, 
+                               group_experiments = True, threshold = None,
+                               max_memory = 1024, verbose = True):
+    
+    """
+    Build a gene-by-voxel expression matrix from a store in chunks
+    
+    Description
+    -----------
+    Bounded-memory alternative to importStore() and 
+    processExpressionMatrix(). Experiments are read from the store in
+    chunks whose size is set by `max_memory` and the expression matrix
+    is written directly to `outfile`. See 
+    buildExpressionMatrixChunked() for details.
+    
+    Arguments
+    ---------
+    storefile: str
+        Path to the HDF5 expression store.
+    mask: str
+        Path to the the MINC file containing the mask. Must be in
+        the same space as the volumes in the store.
+    outfile: str
+        Path to the CSV file in which to write the expression matrix.
+    genes: array-like, optional
+        Genes to import. If None, all experiments in the store are 
+        imported. (default None)
+    channel: str, optional
+        Name of the channel data set to import. (default 'energy')
+    log_transform: bool, optional
+        Option to apply a log2 transform to the expression values.
+        (default True)
+    group_experiments: bool, optional,
+        Option to compute the voxel-wise average of expression values 
+        for experiments that correspond to the same gene. (default True)
+    threshold: float, optional
+        Threshold value indicating the fraction of empty voxels in an 
+        image above which the image is discarded (default None)
+    max_memory: float, optional
+        Memory budget in megabytes. (default 1024)
+        
+    Returns
+    -------
+    nrows: int
+        Number of rows written to `outfile`.
+    """
+    
+    maskIndex = importMask(mask)
+    
+    with h5py.File(storefile, 'r') as store:
+        
+        storeGenes = store['gene'].asstr()[:]
+        rows = np.arange(len(storeGenes))
+        if genes is not None:
+            rows = rows[np.isin(storeGenes, genes)]
+            
+        nrows = buildExpressionMatrixChunked(
+            importChunk = lambda chunk: importStoreChunk(rows = rows[chunk],
+                                                         store = store,
+                                                         mask = maskIndex,
+                                                         channel = channel),
+            genes = storeGenes[rows],
+            nvoxels = len(maskIndex),
+            outfile = outfile,
+            log_transform = log_transform,
+            group_experiments = group_experiments,
+            threshold = threshold,
+            chunksize = getChunkSize(nvoxels = len(maskIndex),
+                                     max_memory = max_memory),
+            verbose = verbose
+        )
+        
+    return nrows
+
+# Main -----------------------------------------------------------------------
+
+def main():
+
+    #Load command line arguments
+    args = parse_args()
+    datadir = args['datadir']
+    imgdir = args['imgdir']
+    outdir = args['outdir']
+    dataset = args['dataset']
+    mask = args['mask']
+    channel = args['channel']
+    verbose = True if args['verbose'] == 'true' else False
+    
+    if verbose:
+        print("Importing {} dataset using {} mask".format(dataset, mask))
+        if channel != 'energy':
+            print("Using ISH channel: {}".format(channel))
+    
+    if (dataset == 'sagittal') and (mask == 'coronal'):
+        raise Exception("Using the sagittal dataset with the coronal mask "
+                        "results in a lot of empty voxels. Choose another "
+                        "combination.")
+    
     #Mask files
     if mask == 'sagittal':
         maskfile = os.path.join(imgdir, 'sagittal_200um_coverage_bin0.8.mnc')
@@ -349,59 +1670,218 @@ def main():
     #Build expression data frame
     log_transform = True if args['log2'] == 'true' else False
     groupexp = True if args['groupexp'] == 'true' else False
+    aggregate = args['aggregate']
     parallel = True if args['parallel'] == 'true' else False
     threshold = args['threshold']
+    impute = True if args['impute'] == 'true' else False
+    stream = True if args['stream'] == 'true' else False
     
-    dfExpression = buildExpressionMatrix(files = pathGeneFiles, 
-                                         mask = maskfile,
-                                         log_transform = log_transform,
-                                         group_experiments = groupexp, 
-                                         threshold = threshold, 
-                                         parallel = parallel, 
-                                         nproc = args['nproc'],
-                                         verbose = verbose)
+    #Memory budget for building the matrix in chunks
+    max_memory = args['max_memory']
+    if max_memory is not None:
+        if stream:
+            raise Exception("--max-memory is not available in streaming "
+                            "mode.")
+        if impute:
+            raise Exception("Imputation requires the full matrix in "
+                            "memory. Set --impute to false when using "
+                            "--max-memory.")
+        if groupexp and (aggregate != 'mean'):
+            raise Exception("Only the 'mean' aggregation is available "
+                            "with --max-memory.")
     
-    #Impute missing values
-    impute = True if args['impute'] == 'true' else False
+    #Output file
+    outfile = 'MouseExpressionMatrix_voxel_{}_mask{}'.format(dataset, mask)
+    
+    if log_transform:
+        outfile = outfile+'_log2'
+        
+    if groupexp:
+        outfile = outfile+'_grouped'
+        if aggregate != 'mean':
+            outfile = outfile+'_'+aggregate
+        
     if impute:
+        outfile = outfile+'_imputed'
+        
+    if channel != 'energy':
+        outfile = outfile+'_'+channel
+    
+    outfile = outfile+'.csv'
+    
+    #Genes to include
+    keep = read_genes(genes = args['genes'], homologs = args['homologs'])
+    
+    #Download and import expression data in streaming mode. If dataset
+    #is sagittal, use only those genes that are also in the coronal set
+    if stream:
+        
+        dfMetadata = importMetadata(datadir = datadir,
+                                    dataset = dataset,
+                                    metadata = args['metadata'],
+                                    api_url = args['api_url'],
+                                    retries = args['retries'],
+                                    timeout = args['timeout'],
+                                    verbose = verbose)
+        
+        if keep is not None:
+            dfMetadata = dfMetadata.loc[dfMetadata['gene'].isin(keep)]
+            
+        if dataset == 'sagittal':
+            genes_Coronal = importCoronalGenes(
+                datadir = datadir,
+                channel = channel,
+                store = args['store'],
+                manifest = args['manifest'],
+                metadata = args['metadata_coronal'],
+                api_url = args['api_url'],
+                retries = args['retries'],
+                timeout = args['timeout'],
+                verbose = verbose
+            )
+            isInCoronal = dfMetadata['gene'].isin(genes_Coronal)
+            dfMetadata = dfMetadata.loc[isInCoronal]
+            
+        experiments = list(zip(dfMetadata['experiment_id'], 
+                               dfMetadata['gene']))
         
         if verbose:
-            print("Imputing missing values using K-nearest neighbours...")
+            print("Streaming {} experiments into voxel expression matrix..."
+                  .format(len(experiments)))
+            
+        arrays, genes = streamExpressionMatrix(experiments = experiments,
+                                               mask = maskfile,
+                                               channel = channel,
+                                               connections = args['connections'],
+                                               api_url = args['api_url'],
+                                               retries = args['retries'],
+                                               timeout = args['timeout'])
+        
+        dfExpression = processExpressionMatrix(arrays = arrays,
+                                               genes = genes,
+                                               log_transform = log_transform,
+                                               group_experiments = groupexp,
+                                               aggregate = aggregate,
+                                               threshold = threshold,
+                                               verbose = verbose)
+    
+    #Import expression data from the store if specified. If dataset is 
+    #sagittal, use only those genes that are also in the coronal set
+    elif args['store'] is not None:
+        
+        storefile = os.path.join(datadir, dataset, args['store'])
+        
+        genes = None if keep is None else np.array(sorted(keep))
+        if dataset == 'sagittal':
+            with h5py.File(os.path.join(datadir, 'coronal', args['store']),
+                           'r') as store:
+                genes_Coronal = store['gene'].asstr()[:]
+            if genes is None:
+                genes = genes_Coronal
+            else:
+                genes = genes[np.isin(genes, genes_Coronal)]
+        
+        if verbose:
+            print("Building voxel expression matrix from store {}..."
+                  .format(storefile))
+        
+        if max_memory is not None:
+            writeStoreExpressionMatrix(storefile = storefile,
+                                       mask = maskfile,
+                                       outfile = os.path.join(outdir, outfile),
+                                       genes = genes,
+                                       channel = channel,
+                                       log_transform = log_transform,
+                                       group_experiments = groupexp,
+                                       threshold = threshold,
+                                       max_memory = max_memory,
+                                       verbose = verbose)
+            return
+            
+        arrays, genes = importStore(storefile = storefile,
+                                    mask = maskfile,
+                                    genes = genes,
+                                    channel = channel)
+        
+        dfExpression = processExpressionMatrix(arrays = arrays,
+                                               genes = genes,
+                                               log_transform = log_transform,
+                                               group_experiments = groupexp,
+                                               aggregate = aggregate,
+                                               threshold = threshold,
+                                               verbose = verbose)
+    
+    else:
+        
+        #Resolve MINC files and genes from the download index
+        dfFiles = listExpressionFiles(datadir = datadir,
+                                      dataset = dataset,
+                                      channel = channel,
+                                      manifest = args['manifest'])
+        
+        #If dataset is sagittal, use only those genes that are also in 
+        #the coronal set
+        if dataset == 'sagittal':
+            dfFiles_Coronal = listExpressionFiles(datadir = datadir,
+                                                  dataset = 'coronal',
+                                                  channel = channel,
+                                                  manifest = args['manifest'])
+            dfFiles = dfFiles.loc[dfFiles['gene'].isin(dfFiles_Coronal['gene'])]
         
-        #Initialize imputer and transposer
-        imputer = KNNImputer(missing_values = np.nan)
-        transposer = FunctionTransformer(np.transpose)
+        #Filter files for genes of interest
+        if keep is not None:
+            dfFiles = dfFiles.loc[dfFiles['gene'].isin(keep)]
         
-        #Build pipeline
-        imputing_pipeline = Pipeline([('transpose1', transposer),
-                                     ('impute', imputer),
-                                     ('transpose2', transposer)])
+        if verbose:
+            print("Building voxel expression matrix...")
+        
+        if max_memory is not None:
+            writeExpressionMatrix(files = list(dfFiles['path']),
+                                  mask = maskfile,
+                                  outfile = os.path.join(outdir, outfile),
+                                  genes = list(dfFiles['gene']),
+                                  log_transform = log_transform,
+                                  group_experiments = groupexp,
+                                  threshold = threshold,
+                                  parallel = parallel,
+                                  nproc = args['nproc'],
+                                  tmpdir = args['tmpdir'],
+                                  max_memory = max_memory,
+                                  verbose = verbose)
+            return
+    
+        dfExpression = buildExpressionMatrix(files = list(dfFiles['path']), 
+                                             mask = maskfile,
+                                             genes = list(dfFiles['gene']),
+                                             log_transform = log_transform,
+                                             group_experiments = groupexp, 
+                                             aggregate = aggregate,
+                                             threshold = threshold, 
+                                             parallel = parallel, 
+                                             nproc = args['nproc'],
+                                             tmpdir = args['tmpdir'],
+                                             verbose = verbose)
+    
+    #Impute missing values
+    if impute:
+        
+        if verbose:
+            print("Imputing missing values using K-nearest neighbours...")
         
         #Store gene names
         genes = dfExpression.index
         
-        #Impute missing values and assign as data frame
-        dfExpression = pd.DataFrame(imputing_pipeline.fit_transform(
-                                                  dfExpression.to_numpy()
-                                    ), index = genes)
+        #Impute missing values of voxels using genes as features and 
+        #assign as data frame
+        imputed = knn_impute(data = dfExpression.to_numpy().T,
+                             nthreads = args['nthreads'],
+                             n_components = args['knn_components'])
+        dfExpression = pd.DataFrame(imputed.T, index = genes)
         
     #Write to file
     if verbose:
         print("Writing to file...")
     
-    outfile = 'MouseExpressionMatrix_voxel_{}_mask{}'.format(dataset, mask)
-    
-    if log_transform:
-        outfile = outfile+'_log2'
-        
-    if groupexp:
-        outfile = outfile+'_grouped'
-        
-    if impute:
-        outfile = outfile+'_imputed'
-    
-    outfile = outfile+'.csv'
-    
     dfExpression.to_csv(os.path.join(outdir, outfile))
 
     return
@@ -9,14 +9,28 @@ Download in-situ hybridization data sets from the Allen Mouse Brain Atlas
 # Packages --------------------------------------------------------------------
 
 import os
+import io
 import argparse
+import json
+import hashlib
+import shutil
+import subprocess
+import threading
+import time
+import random
+import re
+import tarfile
 import requests
+import h5py
 import numpy                as np
 import pandas               as pd
 import multiprocessing      as mp
 from pyminc.volumes.factory import volumeFromFile, volumeFromDescription
+from requests.adapters      import HTTPAdapter
+from concurrent.futures     import ThreadPoolExecutor, as_completed
 from zipfile                import ZipFile
 from functools              import partial
+from datetime               import datetime
 from tqdm                   import tqdm
 
 # Functions -------------------------------------------------------------------
@@ -32,9 +46,12 @@ def parse_args():
     parser.add_argument(
         '--dataset',
         type = str,
-        default = 'coronal',
+        nargs = '+',
+        default = ['coronal'],
         choices = ['coronal', 'sagittal'],
-        help = 'AMBA dataset to import.'
+        help = ('AMBA dataset(s) to import. Experiments from all datasets '
+                'are downloaded together, each into its own '
+                'sub-directory of --outdir.')
     )
 
     parser.add_argument(
@@ -47,8 +64,76 @@ def parse_args():
     parser.add_argument(
         '--metadata',
         type = str,
-        default = 'metadata.csv',
-        help = 'File in --outdir containing AMBA metadata.'
+        nargs = '+',
+        help = ("File(s) in --outdir containing AMBA metadata, one per "
+                "dataset passed to --dataset. Defaults to "
+                "'AMBA_metadata_<dataset>.csv'.")
+    )
+    
+    parser.add_argument(
+        '--genes',
+        type = str,
+        help = ('Path to a file containing the mouse genes to download, '
+                'one per line. If not specified, all genes are downloaded.')
+    )
+    
+    parser.add_argument(
+        '--homologs',
+        type = str,
+        help = ('Path to a CSV file containing mouse-human homologous genes '
+                "in columns 'Mouse' and 'Human'. If specified, only genes "
+                'with a human homologue are downloaded.')
+    )
+    
+    parser.add_argument(
+        '--manifest',
+        type = str,
+        default = 'manifest.csv',
+        help = ('File in the dataset sub-directory of --outdir in which to '
+                'record the status of every downloaded experiment. '
+                'Experiments already recorded as complete are skipped.')
+    )
+    
+    parser.add_argument(
+        '--store',
+        type = str,
+        help = ('HDF5 file in the dataset sub-directory of --outdir in '
+                'which to consolidate all expression volumes. If not '
+                'specified, one MINC file is written per experiment.')
+    )
+
+    parser.add_argument(
+        '--channels',
+        type = str,
+        nargs = '+',
+        default = ['energy'],
+        choices = ['energy', 'density', 'intensity'],
+        help = ('Channel(s) to extract from every grid data archive. '
+                'Expression energy is written to the dataset '
+                'sub-directory of --outdir and other channels to a '
+                'sub-directory named after the channel. When using '
+                '--store, every channel is a separate data set in the '
+                'store.')
+    )
+
+    parser.add_argument(
+        '--verify',
+        type = str,
+        default = 'false',
+        choices = ['true', 'false'],
+        help = ('Option to verify the checksums of previously downloaded '
+                'files before skipping them. If false, only file sizes '
+                'are verified.')
+    )
+    
+    parser.add_argument(
+        '--debug',
+        type = str,
+        default = 'false',
+        choices = ['true', 'false'],
+        help = ('Option to write the downloaded zip archives to disk and '
+                'keep the extracted RAW files in the output directory. '
+                'If false, the archives are decoded in memory.')
     )
     
     parser.add_argument(
@@ -66,6 +151,81 @@ def parse_args():
         help = 'Number of CPUs to use in parallel.'
     )
     
+    parser.add_argument(
+        '--connections',
+        type = int,
+        help = ('Number of concurrent HTTP requests to keep in flight over '
+                'a shared keep-alive connection pool. If specified, '
+                'downloads run in threads and --nproc processes are used '
+                'only to convert the downloaded files.')
+    )
+    
+    parser.add_argument(
+        '--adaptive',
+        type = str,
+        default = 'false',
+        choices = ['true', 'false'],
+        help = ('Option to adapt the number of concurrent HTTP requests to '
+                'the observed latency and error responses. If true, '
+                '--connections is the maximal number of requests in '
+                'flight. Ignored if --connections is not specified.')
+    )
+    
+    parser.add_argument(
+        '--retries',
+        type = int,
+        default = 3,
+        help = ('Number of times a failed or throttled request is retried '
+                'for an experiment before it is recorded as failed.')
+    )
+    
+    parser.add_argument(
+        '--backoff',
+        type = float,
+        default = 1.0,
+        help = ('Delay in seconds before the first retry of a request. '
+                'The delay doubles with every subsequent retry.')
+    )
+    
+    parser.add_argument(
+        '--timeout',
+        type = float,
+        default = 60.0,
+        help = ('Time in seconds to wait for a connection to be established '
+                'or for data to be received before a request is failed.')
+    )
+    
+    parser.add_argument(
+        '--archive',
+        type = str,
+        help = ('Path to a directory or tar archive containing AMBA grid '
+                "data zip files named '<experiment_id>.zip'. If specified, "
+                'experiments are imported from the archive instead of '
+                'being downloaded from the API.')
+    )
+    
+    parser.add_argument(
+        '--api-url',
+        type = str,
+        default = 'http://api.brain-map.org',
+        help = 'Base URL of the Allen Brain Atlas API.'
+    )
+    
+    parser.add_argument(
+        '--stats',
+        type = str,
+        help = ('Path to a JSON file in which to write a summary of the '
+                'download throughput and per-stage latencies.')
+    )
+    
+    parser.add_argument(
+        '--log-interval',
+        type = float,
+        help = ('Interval in seconds at which to print download progress '
+                'and throughput. If not specified, only the progress bar '
+                'is shown.')
+    )
+    
     parser.add_argument(
         '--verbose',
         type = str,
@@ -80,7 +240,9 @@ def parse_args():
 
 
 def fetch_metadata(dataset = 'coronal', outdir='./', 
-                   outfile = 'metadata.csv', verbose = True):
+                   outfile = 'AMBA_metadata.csv', 
+                   api_url = 'http://api.brain-map.org', retries = 0,
+                   timeout = 60.0, verbose = True):
 
     """
     Download metadata for in-situ hybridization data sets
@@ -95,14 +257,23 @@ def fetch_metadata(dataset = 'coronal', outdir='./',
         (default './')
     outfile: str, optional
         Name of csv file in which to save the metadata. 
-        (default 'metadata.csv')
+        (default 'AMBA_metadata.csv')
+    api_url: str, optional
+        Base URL of the Allen Brain Atlas API.
+        (default 'http://api.brain-map.org')
+    retries: int, optional
+        Maximal number of retries of a failed or throttled request.
+        (default 0)
+    timeout: float, optional
+        Time in seconds to wait for the connection and for every read
+        from the server. (default 60.0)
         
     Returns
     -------
     None 
     """        
 
-    abi_query_metadata = ("http://api.brain-map.org/api/v2/data/SectionDataSet/"
+    abi_query_metadata = ("{}/api/v2/data/SectionDataSet/"
                           "query.csv?criteria="
                           "[failed$eqfalse],"
                           "plane_of_section[name$eq{}],"
@@ -122,9 +293,13 @@ def fetch_metadata(dataset = 'coronal', outdir='./',
                           "genes.homologene_id,"
                           "genes.organism_id"
                           "&start_row=0"
-                          "&num_rows=all".format(dataset))
+                          "&num_rows=all".format(api_url, dataset))
+    
+    amba_request = request_url(abi_query_metadata, 
+                               retries = retries,
+                               timeout = timeout)
 
-    (pd.read_csv(abi_query_metadata)
+    (pd.read_csv(io.StringIO(amba_request.text))
         .drop_duplicates()
         .to_csv(outdir+outfile, index=False))
 
@@ -134,168 +309,869 @@ def fetch_metadata(dataset = 'coronal', outdir='./',
     return 
 
 
-def fetch_expression(experiment_id, outdir = './tmp/'):
-
+def read_genes(genes = None, homologs = None):
+    
     """
-    Download the expression energy for an ISH experiment
-
-    Description
-    -----------
-    This function downloads the gridded expression energy for a single
-    in-situ hybridization experiment in the Allen Mouse Brain Atlas.
-    The downloaded data is in RAW format and is stored in a file named
-    according to the experiment ID. 
-
+    Import the set of mouse genes to keep
+    
     Arguments
     ---------
-    experiment_id: int
-        The ID of the in-situ hybridization experiment to download.
-    outdir: str, optional
-        Directory in which to download the expression energy file.
-        (default './tmp/')   
-
+    genes: str, optional
+        Path to a file containing mouse genes, one per line.
+        (default None)
+    homologs: str, optional
+        Path to a CSV file containing mouse-human homologous genes in
+        columns 'Mouse' and 'Human'.
+        (default None)
+        
     Returns
     -------
-    outfile: str
-        The name of the file containing the expression energy.
-    success: int
-        Integer indicating whether the download was successful.
+    keep: set of str
+        Mouse genes present in all of the files specified, or None if
+        no file was specified.
     """
     
-    if not os.path.exists(outdir):
-        os.mkdir(outdir)
+    keep = None
+    
+    if genes is not None:
+        with open(genes, 'r') as file:
+            keep = {line.strip() for line in file if line.strip() != ''}
+            
+    if homologs is not None:
+        homologs = set(pd.read_csv(homologs)['Mouse'])
+        keep = homologs if keep is None else keep & homologs
+        
+    return keep
 
-    tmpdir = outdir+str(experiment_id)+'/' 
-    os.mkdir(tmpdir)
+
+def create_session(pool_size = 10):
+
+    """
+    Create an HTTP session with a keep-alive connection pool
+    
+    Arguments
+    ---------
+    pool_size: int, optional
+        Maximal number of connections kept open in the pool. Should be
+        at least the number of threads sharing the session.
+        (default 10)
         
-    abi_query_expr = ('http://api.brain-map.org/grid_data/download/{}'
-                      .format(experiment_id))
-    amba_request = requests.get(abi_query_expr)
+    Returns
+    -------
+    session: requests.Session
+        HTTP session whose connections are reused across requests.
+    """
+    
+    adapter = HTTPAdapter(pool_connections = 1,
+                          pool_maxsize = pool_size,
+                          pool_block = True)
+    
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    
+    return session
 
-    tmpfile = tmpdir+str(experiment_id)+'.zip'
-    with open(tmpfile, 'wb') as file:
-        file.write(amba_request.content)
 
-    outfile = outdir+str(experiment_id)+'.raw'
-    with ZipFile(tmpfile, 'r') as file:
-        try:
-            file.extract('energy.raw', path = tmpdir)
-            os.rename(tmpdir+'energy.raw', outfile)
-            success = 1
-        except KeyError as err:
-            print('Error for experiment {}: {}. Ignoring.'
-                  .format(experiment_id, err))
-            success = 0
+class DownloadStats:
+    
+    """
+    Timers and counters for the stages of the download
+    
+    Description
+    -----------
+    Durations are recorded per stage (e.g. 'request', 'decode', 
+    'convert', 'store', 'checksum') along with the number of bytes 
+    processed. Counters track outcomes such as completed, failed and 
+    retried requests. The number of requests in flight is tracked 
+    within a process. Instances can be updated from multiple threads, 
+    pickled to be returned from worker processes, and merged.
+    """
+    
+    def __init__(self):
+        
+        self.start = time.time()
+        self.durations = {}
+        self.nbytes = {}
+        self.counters = {}
+        self.inflight = 0
+        self.max_inflight = 0
+        self._lock = threading.Lock()
+        
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        
+    def add(self, stage, duration, nbytes = 0):
+        
+        """Record the duration in seconds and bytes of a stage"""
+        
+        with self._lock:
+            self.durations.setdefault(stage, []).append(duration)
+            self.nbytes[stage] = self.nbytes.get(stage, 0) + nbytes
             
-    os.remove(tmpfile)
-    os.rmdir(tmpdir)
- 
-    return outfile, success
+        return
+    
+    def count(self, name, n = 1):
+        
+        """Increment a counter"""
+        
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+            
+        return
+    
+    def begin_request(self):
+        
+        """Mark the start of a request"""
+        
+        with self._lock:
+            self.inflight += 1
+            self.max_inflight = max(self.max_inflight, self.inflight)
+            
+        return
+    
+    def end_request(self):
+        
+        """Mark the end of a request"""
+        
+        with self._lock:
+            self.inflight -= 1
+            
+        return
+    
+    def merge(self, other):
+        
+        """Add the timings and counters of another instance"""
+        
+        with self._lock:
+            for stage, durations in other.durations.items():
+                self.durations.setdefault(stage, []).extend(durations)
+            for stage, nbytes in other.nbytes.items():
+                self.nbytes[stage] = self.nbytes.get(stage, 0) + nbytes
+            for name, n in other.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            self.max_inflight = max(self.max_inflight, other.max_inflight)
+            
+        return
+    
+    def summary(self):
+        
+        """
+        Summarise the timings and counters
+        
+        Returns
+        -------
+        summary: dict
+            Dictionary containing the elapsed time, overall download 
+            throughput, requests in flight, counters and, for every 
+            stage, the number of calls, total time, p50 and p95 
+            latencies, bytes processed and throughput.
+        """
+        
+        with self._lock:
+            
+            elapsed = time.time() - self.start
+            
+            stages = {}
+            for stage, durations in self.durations.items():
+                durations = np.array(durations)
+                total = float(np.sum(durations))
+                nbytes = self.nbytes.get(stage, 0)
+                stages[stage] = {
+                    'count': len(durations),
+                    'total_s': total,
+                    'mean_s': float(np.mean(durations)),
+                    'p50_s': float(np.percentile(durations, 50)),
+                    'p95_s': float(np.percentile(durations, 95)),
+                    'bytes': int(nbytes),
+                    'bytes_per_s': nbytes/total if total > 0 else 0.0
+                }
+                
+            nbytes = self.nbytes.get('request', 0)
+            summary = {'elapsed_s': elapsed,
+                       'bytes': int(nbytes),
+                       'bytes_per_s': nbytes/elapsed if elapsed > 0 else 0.0,
+                       'inflight': self.inflight,
+                       'max_inflight': self.max_inflight,
+                       'counters': dict(self.counters),
+                       'stages': stages}
+            
+        return summary
+    
+    def write(self, outfile):
+        
+        """Write the summary to a JSON file"""
+        
+        with open(outfile, 'w') as file:
+            json.dump(self.summary(), file, indent = 2)
+            
+        return
 
 
-def rawtominc_wrapper(infile, outfile = None, keep_raw = False):
+def log_progress(stats, interval, stop):
     
     """
-    Convert a RAW file to MINC format
-
+    Print download progress at regular intervals
+    
     Arguments
     ---------
-    infile: str
-    outfile: str, optional
-        Name of output MINC file. If None, will use the same name as
-        the RAW file.
-        (default None)
-    keep_raw: bool, optional
-        Option to keep RAW file. If False, the input file will be
-        deleted.
-        (default False)
-
+    stats: DownloadStats
+        Download statistics to report.
+    interval: float
+        Interval in seconds between reports.
+    stop: threading.Event
+        Event signalling the end of the download.
+        
     Returns
     -------
-    outfile: str
-        Name of output MINC file.
-    success: int
-        Integer indicating whether conversion was a success.
+    None
     """
     
-    if outfile is None:
-        outfile = infile.replace('.raw', '.mnc')
-    
-    try: 
-        rawtominc = ('cat {} '
-                     '| rawtominc {} '
-                     '-signed -float '
-                     '-ounsigned '
-                     '-oshort '
-                     '-xstep 0.2 '
-                     '-ystep 0.2 '
-                     '-zstep 0.2 '
-                     '-clobber 58 41 67'.format(infile, outfile))
-        success = 1
-    except: 
-        success = 0
-    
-    os.system(rawtominc)
-    
-    if keep_raw is not True:
-        os.remove(infile)
+    while not stop.wait(interval):
+        summary = stats.summary()
+        latency = summary['stages'].get('request', {})
+        tqdm.write('[{:.0f} s] {} complete, {} failed, {} in flight, '
+                   '{:.2f} MB/s, request p50 {:.3f} s, p95 {:.3f} s'
+                   .format(summary['elapsed_s'],
+                           summary['counters'].get('complete', 0),
+                           summary['counters'].get('failed', 0),
+                           summary['inflight'],
+                           summary['bytes_per_s']/1e6,
+                           latency.get('p50_s', 0.0),
+                           latency.get('p95_s', 0.0)))
         
-    return outfile, success
-
+    return
 
-def transform_space(infile, outfile = None, voxel_orientation = 'RAS', 
-                    world_space = 'MICe', expansion_factor = 1.0, 
-                    volume_type = None, data_type = None, labels = False):
 
-    """ 
-    Transform the coordinate space of a MINC file
+class AdaptiveLimiter:
+    
+    """
+    Adaptive limit on the number of concurrent HTTP requests
+    
+    Description
+    -----------
+    The limit follows an additive-increase/multiplicative-decrease 
+    rule. It grows by one request after a full window of successful 
+    requests whose latency stays close to the fastest latency 
+    observed. It shrinks by `backoff_factor` when the latency rises 
+    above `latency_factor` times that baseline, and is halved when 
+    the server throttles or fails a request. The limit is decreased at
+    most once per window: responses to requests sent before the last
+    decrease do not decrease it again, so that a burst of concurrent
+    failures counts as a single congestion event.
+    
+    Arguments
+    ---------
+    initial: int, optional
+        Initial number of concurrent requests. (default 8)
+    minimum: int, optional
+        Minimal number of concurrent requests. (default 1)
+    maximum: int, optional
+        Maximal number of concurrent requests. (default 64)
+    latency_factor: float, optional
+        Ratio of request latency to baseline latency above which the
+        server is considered congested. (default 2.0)
+    backoff_factor: float, optional
+        Factor by which the limit is reduced on congestion. 
+        (default 0.75)
+    """
+    
+    def __init__(self, initial = 8, minimum = 1, maximum = 64, 
+                 latency_factor = 2.0, backoff_factor = 0.75):
+        
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_factor = latency_factor
+        self.backoff_factor = backoff_factor
+        self.baseline = None
+        self.inflight = 0
+        self._epoch = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+        
+    def acquire(self):
+        
+        """
+        Wait until a request slot is available and take it
+        
+        Returns
+        -------
+        epoch: int
+            Number of decreases of the limit before the slot was taken,
+            to be passed to release().
+        """
+        
+        with self._condition:
+            while self.inflight >= int(self.limit):
+                self._condition.wait()
+            self.inflight += 1
+            epoch = self._epoch
+            
+        return epoch
+    
+    def release(self, latency = None, throttled = False, epoch = None):
+        
+        """
+        Release a request slot and update the limit
+        
+        Arguments
+        ---------
+        latency: float, optional
+            Duration of the request in seconds. (default None)
+        throttled: bool, optional
+            Whether the request failed or was throttled by the server.
+            (default False)
+        epoch: int, optional
+            Value returned by acquire() for the request. If older than
+            the last decrease, the limit is not decreased. 
+            (default None)
+        """
+        
+        with self._condition:
+            
+            self.inflight -= 1
+            current = (epoch is None) or (epoch >= self._epoch)
+            
+            if throttled:
+                if current:
+                    self.limit = max(self.minimum, self.limit/2)
+                    self._epoch += 1
+                self._successes = 0
+            elif latency is not None:
+                #Let the baseline creep up so that it tracks lasting 
+                #changes in server latency
+                if self.baseline is None:
+                    self.baseline = latency
+                else:
+                    self.baseline = min(self.baseline*1.01, latency)
+                    
+                if latency > self.latency_factor*self.baseline:
+                    if current:
+                        self.limit = max(self.minimum, 
+                                         self.limit*self.backoff_factor)
+                        self._epoch += 1
+                    self._successes = 0
+                else:
+                    self._successes += 1
+                    if self._successes >= int(self.limit):
+                        self.limit = min(self.maximum, self.limit+1)
+                        self._successes = 0
+                        
+            self._condition.notify_all()
+            
+        return
 
-    Author: Yohan Yee
 
+def request_url(url, session = None, limiter = None, retries = 0, 
+                backoff = 1.0, timeout = 60.0, stats = None):
+    
+    """
+    Send a GET request with retries and exponential backoff
+    
+    Description
+    -----------
+    Connection errors, timeouts and responses indicating that the 
+    server is throttling or failing (429 and 5xx) are retried up to
+    `retries` times. The delay before retry `n` is `backoff*2**n` 
+    seconds with random jitter, or the delay requested by the server 
+    in a Retry-After header. Other error responses are raised
+    immediately.
+    
     Arguments
     ---------
-    infile: str
-        Name of the MINC file to transform.
-    outfile: str, optional
-        Name of the output MINC file. If None, the input file will be
-        overwritten. 
-        (default None)
-    voxel_orientation: str, optional
-        (default 'RAS')
-    world_space: str, optional
-        (default 'MICe')
-    expansion_factor: float, optional
-        (default 1.0)
-    volume_type: 
-        (default None)
-    data_type: 
+    url: str
+        URL to request.
+    session: requests.Session, optional
+        HTTP session used to send the request. If None, a new 
+        connection is opened for the request.
         (default None)
-    labels: bool, optional
+    limiter: AdaptiveLimiter, optional
+        Limiter controlling the number of concurrent requests. 
         (default None)
-
+    retries: int, optional
+        Maximal number of retries. (default 0)
+    backoff: float, optional
+        Delay in seconds before the first retry. (default 1.0)
+    timeout: float, optional
+        Time in seconds to wait for the connection and for every read
+        from the server. (default 60.0)
+    stats: DownloadStats, optional
+        Statistics in which to record request latencies, bytes and 
+        retries. (default None)
+        
     Returns
     -------
-    outfile: str
-        Name of the transformed file.
+    response: requests.Response
+        The successful response.
     """
     
-    def reorient_to_standard(dat):
-        dat = np.rot90(dat, k=1, axes=(0, 2))
-        dat = np.rot90(dat, k=1, axes=(0, 1))
+    get = requests.get if session is None else session.get
+    stats = DownloadStats() if stats is None else stats
+    
+    for attempt in range(retries+1):
+        
+        if limiter is not None:
+            epoch = limiter.acquire()
+            
+        stats.begin_request()
+        start = time.monotonic()
+        try:
+            response = get(url, timeout = timeout)
+            error = None
+            throttled = ((response.status_code == 429) or 
+                         (response.status_code >= 500))
+        except (requests.ConnectionError, requests.Timeout) as err:
+            response = None
+            error = err
+            throttled = True
+        except Exception:
+            stats.end_request()
+            if limiter is not None:
+                limiter.release()
+            raise
+        latency = time.monotonic() - start
+        stats.end_request()
+        stats.add('request', latency, 
+                  0 if response is None else len(response.content))
+        
+        if limiter is not None:
+            limiter.release(latency = latency, throttled = throttled,
+                            epoch = epoch)
+            
+        if not throttled:
+            response.raise_for_status()
+            return response
+        
+        if attempt == retries:
+            if error is not None:
+                raise error
+            response.raise_for_status()
+        
+        stats.count('retries')
+        delay = backoff*2**attempt*random.uniform(0.5, 1.5)
+        if (response is not None) and ('Retry-After' in response.headers):
+            try:
+                delay = float(response.headers['Retry-After'])
+            except ValueError:
+                pass
+        time.sleep(delay)
+    
+    return response
 
-        shape = dat.shape
-        dat = np.ravel(dat)
-        dat = np.reshape(dat, shape)
 
-        return(dat)
+def get_channel_dir(outdir, channel = 'energy'):
+    
+    """
+    Get the directory in which the files of an ISH channel are written
+    
+    Arguments
+    ---------
+    outdir: str
+        Download directory of the dataset.
+    channel: str, optional
+        Name of the channel. Expression energy is written to the 
+        download directory itself and other channels to a 
+        sub-directory named after the channel.
+        (default 'energy')
+        
+    Returns
+    -------
+    channel_dir: str
+        Path to the channel directory.
+    """
+    
+    if channel == 'energy':
+        return outdir
+    
+    return os.path.join(outdir, channel, '')
 
-    def do_nothing(dat):
-        return(dat)
 
-    # %% Coordinate definitions
+def fetch_expression(experiment_id, outdir = './tmp/', session = None,
+                     api_url = 'http://api.brain-map.org', debug = False,
+                     limiter = None, retries = 0, backoff = 1.0, 
+                     timeout = 60.0, stats = None, channels = None):
 
-    # Centers are listed as x,y,z; reverse these when writing out
-    # Centers listed in um in CCFv3 coordinates
+    """
+    Download the expression data for an ISH experiment
+
+    Description
+    -----------
+    This function downloads the gridded expression data for a single
+    in-situ hybridization experiment in the Allen Mouse Brain Atlas.
+    The downloaded zip archive is held in memory and the volumes of 
+    all requested channels are decoded directly from it. In debug 
+    mode, the archive is written to disk and the extracted RAW files 
+    are kept in files named according to the experiment ID.
+
+    Arguments
+    ---------
+    experiment_id: int
+        The ID of the in-situ hybridization experiment to download.
+    outdir: str, optional
+        Directory in which to write the RAW files in debug mode.
+        (default './tmp/')   
+    session: requests.Session, optional
+        HTTP session used to send the request. If None, a new 
+        connection is opened for the request.
+        (default None)
+    api_url: str, optional
+        Base URL of the Allen Brain Atlas API.
+        (default 'http://api.brain-map.org')
+    debug: bool, optional
+        Option to write the archive to disk and keep the RAW files.
+        (default False)
+    limiter: AdaptiveLimiter, optional
+        Limiter controlling the number of concurrent requests.
+        (default None)
+    retries: int, optional
+        Maximal number of retries for failed or throttled requests.
+        (default 0)
+    backoff: float, optional
+        Delay in seconds before the first retry.
+        (default 1.0)
+    timeout: float, optional
+        Time in seconds to wait for the connection and for every read
+        from the server.
+        (default 60.0)
+    stats: DownloadStats, optional
+        Statistics in which to record the request and decoding times.
+        (default None)
+    channels: list of str, optional
+        Channels to extract from the archive, among 'energy', 
+        'density' and 'intensity'. If None, only the expression 
+        energy is extracted.
+        (default None)
+
+    Returns
+    -------
+    data: dict
+        Dictionary with channel names as keys and 1-dimensional arrays
+        containing the channel values as values. Channels missing from
+        the archive are omitted.
+    success: int
+        Integer indicating whether the download was successful.
+    """
+        
+    abi_query_expr = ('{}/grid_data/download/{}'
+                      .format(api_url, experiment_id))
+    stats = DownloadStats() if stats is None else stats
+    amba_request = request_url(abi_query_expr, 
+                               session = session,
+                               limiter = limiter,
+                               retries = retries,
+                               backoff = backoff,
+                               timeout = timeout,
+                               stats = stats)
+    
+    data, success = extract_expression(experiment_id = experiment_id,
+                                       content = amba_request.content,
+                                       outdir = outdir,
+                                       debug = debug,
+                                       stats = stats,
+                                       channels = channels)
+            
+    return data, success
+
+
+def extract_expression(experiment_id, content, outdir = './tmp/', 
+                       debug = False, stats = None, channels = None):
+    
+    """
+    Extract expression data from an AMBA grid data zip archive
+    
+    Description
+    -----------
+    Every requested channel is read from the archive in the same 
+    pass. The extraction is successful if at least one of the 
+    channels is present.
+    
+    Arguments
+    ---------
+    experiment_id: int
+        The ID of the in-situ hybridization experiment.
+    content: bytes
+        Content of the zip archive.
+    outdir: str, optional
+        Directory in which to write the RAW files in debug mode.
+        (default './tmp/')
+    debug: bool, optional
+        Option to write the archive to disk and keep the RAW files.
+        (default False)
+    stats: DownloadStats, optional
+        Statistics in which to record the decoding time.
+        (default None)
+    channels: list of str, optional
+        Channels to extract. If None, only the expression energy is 
+        extracted.
+        (default None)
+        
+    Returns
+    -------
+    data: dict
+        Dictionary with channel names as keys and 1-dimensional arrays
+        containing the channel values as values. Channels missing from
+        the archive are omitted.
+    success: int
+        Integer indicating whether the extraction was successful.
+    """
+    
+    stats = DownloadStats() if stats is None else stats
+    channels = ['energy'] if channels is None else channels
+    
+    start = time.monotonic()
+    
+    if debug:
+        data = fetch_expression_to_disk(experiment_id = experiment_id,
+                                        content = content,
+                                        outdir = outdir,
+                                        channels = channels)
+    else:
+        data = {}
+        with ZipFile(io.BytesIO(content), 'r') as file:
+            for channel in channels:
+                try:
+                    data[channel] = np.frombuffer(file.read(channel+'.raw'),
+                                                  dtype = '<f4')
+                except KeyError as err:
+                    print('Error for experiment {}: {}. Ignoring.'
+                          .format(experiment_id, err))
+    
+    success = 1 if len(data) > 0 else 0
+                
+    stats.add('decode', time.monotonic() - start, 
+              sum(array.nbytes for array in data.values()))
+            
+    return data, success
+
+
+def fetch_expression_to_disk(experiment_id, content, outdir = './tmp/',
+                             channels = None):
+    
+    """
+    Extract the expression data for an ISH experiment via the disk
+    
+    Description
+    -----------
+    This function writes the zip archive downloaded for an ISH 
+    experiment to disk and extracts every requested channel to a RAW
+    file named according to the experiment ID, in the directory of 
+    the channel. The RAW files are kept for inspection.
+    
+    Arguments
+    ---------
+    experiment_id: int
+        The ID of the in-situ hybridization experiment.
+    content: bytes
+        Content of the downloaded zip archive.
+    outdir: str, optional
+        Directory in which to write the expression energy file.
+        (default './tmp/')
+    channels: list of str, optional
+        Channels to extract. If None, only the expression energy is 
+        extracted.
+        (default None)
+        
+    Returns
+    -------
+    data: dict
+        Dictionary with channel names as keys and 1-dimensional arrays
+        containing the channel values as values. Channels missing from
+        the archive are omitted.
+    """
+    
+    channels = ['energy'] if channels is None else channels
+    
+    if not os.path.exists(outdir):
+        os.makedirs(outdir, exist_ok = True)
+
+    #Remove temporary files left over from an interrupted download
+    tmpdir = outdir+str(experiment_id)+'/' 
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.mkdir(tmpdir)
+
+    tmpfile = tmpdir+str(experiment_id)+'.zip'
+    with open(tmpfile, 'wb') as file:
+        file.write(content)
+
+    data = {}
+    with ZipFile(tmpfile, 'r') as file:
+        for channel in channels:
+            channel_dir = get_channel_dir(outdir, channel)
+            os.makedirs(channel_dir, exist_ok = True)
+            outfile = channel_dir+str(experiment_id)+'.raw'
+            try:
+                file.extract(channel+'.raw', path = tmpdir)
+                os.rename(tmpdir+channel+'.raw', outfile)
+                data[channel] = np.fromfile(outfile, dtype = '<f4')
+            except KeyError as err:
+                print('Error for experiment {}: {}. Ignoring.'
+                      .format(experiment_id, err))
+            
+    shutil.rmtree(tmpdir)
+ 
+    return data
+
+
+def rawtominc_wrapper(infile, outfile = None, keep_raw = False):
+    
+    """
+    Convert a RAW file to MINC format
+
+    Arguments
+    ---------
+    infile: str or numpy.ndarray
+        Path to the RAW file, or array containing the RAW voxel values.
+        Arrays are piped to rawtominc without being written to disk.
+    outfile: str, optional
+        Name of output MINC file. If None, will use the same name as
+        the RAW file. Required if `infile` is an array.
+        (default None)
+    keep_raw: bool, optional
+        Option to keep RAW file. If False, the input file will be
+        deleted.
+        (default False)
+
+    Returns
+    -------
+    outfile: str
+        Name of output MINC file.
+    success: int
+        Integer indicating whether conversion was a success.
+    """
+    
+    if isinstance(infile, np.ndarray):
+        if outfile is None:
+            raise ValueError("outfile must be specified when converting "
+                             "an array.")
+        content = infile.astype('<f4').tobytes()
+    else:
+        if outfile is None:
+            outfile = infile.replace('.raw', '.mnc')
+        with open(infile, 'rb') as file:
+            content = file.read()
+    
+    rawtominc = ['rawtominc', outfile,
+                 '-signed', '-float', 
+                 '-ounsigned', '-oshort', 
+                 '-xstep', '0.2', 
+                 '-ystep', '0.2', 
+                 '-zstep', '0.2', 
+                 '-clobber', '58', '41', '67']
+    
+    process = subprocess.run(rawtominc, input = content)
+    success = 1 if process.returncode == 0 else 0
+    
+    if (not isinstance(infile, np.ndarray)) and (keep_raw is not True):
+        os.remove(infile)
+        
+    return outfile, success
+
+
+def reorient_to_standard(dat):
+    
+    """
+    Reorient a volume from the AMBA PIR voxel orientation to RAS
+    
+    Arguments
+    ---------
+    dat: numpy.ndarray
+        3-dimensional array in PIR voxel orientation.
+        
+    Returns
+    -------
+    dat: numpy.ndarray
+        3-dimensional array in RAS voxel orientation.
+    """
+    
+    dat = np.rot90(dat, k=1, axes=(0, 2))
+    dat = np.rot90(dat, k=1, axes=(0, 1))
+
+    shape = dat.shape
+    dat = np.ravel(dat)
+    dat = np.reshape(dat, shape)
+
+    return(dat)
+
+
+def do_nothing(dat):
+    return(dat)
+
+
+def reorient_stack(stack, voxel_orientation = 'RAS'):
+    
+    """
+    Reorient a stack of AMBA volumes in a single pass
+    
+    Description
+    -----------
+    This is the batched equivalent of `reorient_to_standard()`. The 
+    rotations are applied to all volumes at once and the result is a 
+    view of the input stack, without copying the voxel data.
+    
+    Arguments
+    ---------
+    stack: numpy.ndarray
+        4-dimensional array of volumes in PIR voxel orientation, with
+        volumes along the first axis.
+    voxel_orientation: str, optional
+        Target voxel orientation. One of 'RAS' or 'PIR'.
+        (default 'RAS')
+        
+    Returns
+    -------
+    stack: numpy.ndarray
+        View of the stack in the target voxel orientation.
+    """
+    
+    if voxel_orientation == 'RAS':
+        stack = np.rot90(stack, k=1, axes=(1, 3))
+        stack = np.rot90(stack, k=1, axes=(1, 2))
+    elif voxel_orientation != 'PIR':
+        raise ValueError("Invalid voxel orientation: {}"
+                         .format(voxel_orientation))
+        
+    return stack
+
+
+def get_world_geometry(size, voxel_orientation = 'RAS', world_space = 'MICe',
+                       expansion_factor = 1.0):
+    
+    """
+    Get the world coordinate geometry of an AMBA volume
+    
+    Author: Yohan Yee
+    
+    Arguments
+    ---------
+    size: int
+        Number of voxels in the volume. Used to identify the 
+        resolution of the volume.
+    voxel_orientation: str, optional
+        (default 'RAS')
+    world_space: str, optional
+        (default 'MICe')
+    expansion_factor: float, optional
+        (default 1.0)
+        
+    Returns
+    -------
+    geometry: dict
+        Dictionary containing the starts, steps and direction cosines
+        of the volume, in the form expected by `volumeFromDescription`.
+    """
+
+    # %% Coordinate definitions
+
+    # Centers are listed as x,y,z; reverse these when writing out
+    # Centers listed in um in CCFv3 coordinates
     centers_RAS = {"MICe"   :   [5700, 7900, 2700],
                    "CCFv3"  :   [0, 13200, 8000]}
     centers_PIR = {"MICe"   :   [5300, 5300, 5700],
@@ -308,10 +1184,7 @@ def transform_space(infile, outfile = None, voxel_orientation = 'RAS',
     direction_cosines_PIR = {"MICe" :[[0, -1, 0], [0, 0, -1], [1, 0, 0]],
                              "CCFv3":[[1, 0, 0], [0, 1, 0], [0, 0, 1]]}
 
-    # Map arguments to functions/dicts/values
-    map_voxel_orientations = {"RAS":reorient_to_standard,
-                              "PIR":do_nothing}
-
+    # Map arguments to dicts/values
     map_centers = {"RAS":centers_RAS,
                    "PIR":centers_PIR}
 
@@ -330,16 +1203,11 @@ def transform_space(infile, outfile = None, voxel_orientation = 'RAS',
                        size_100: 100,
                        size_200: 200}
     
-    vol = volumeFromFile(infile)
-
-    res = map_resolutions[vol.data.size]
-
-    # Voxel orientation
-    if voxel_orientation in map_voxel_orientations:
-        new_data = map_voxel_orientations[voxel_orientation](vol.data)
-    else:
-        print("Invalid voxel orientation")
-        sys.exit(1)
+    if voxel_orientation not in map_centers:
+        raise ValueError("Invalid voxel orientation: {}"
+                         .format(voxel_orientation))
+    
+    res = map_resolutions[size]
 
     # World coordinate system
     centers = [expansion_factor*c/(1000) 
@@ -348,6 +1216,65 @@ def transform_space(infile, outfile = None, voxel_orientation = 'RAS',
     xdc = map_dir_cosines[voxel_orientation][world_space][0]
     ydc = map_dir_cosines[voxel_orientation][world_space][1]
     zdc = map_dir_cosines[voxel_orientation][world_space][2]
+    
+    geometry = {'starts': [-c for c in reversed(centers)],
+                'steps': [s for s in reversed(steps)],
+                'x_dir_cosines': xdc,
+                'y_dir_cosines': ydc,
+                'z_dir_cosines': zdc}
+    
+    return geometry
+
+
+def transform_space(infile, outfile = None, voxel_orientation = 'RAS', 
+                    world_space = 'MICe', expansion_factor = 1.0, 
+                    volume_type = None, data_type = None, labels = False):
+
+    """ 
+    Transform the coordinate space of a MINC file
+
+    Author: Yohan Yee
+
+    Arguments
+    ---------
+    infile: str
+        Name of the MINC file to transform.
+    outfile: str, optional
+        Name of the output MINC file. If None, the input file will be
+        overwritten. 
+        (default None)
+    voxel_orientation: str, optional
+        (default 'RAS')
+    world_space: str, optional
+        (default 'MICe')
+    expansion_factor: float, optional
+        (default 1.0)
+    volume_type: 
+        (default None)
+    data_type: 
+        (default None)
+    labels: bool, optional
+        (default None)
+
+    Returns
+    -------
+    outfile: str
+        Name of the transformed file.
+    """
+    
+    # Map arguments to functions
+    map_voxel_orientations = {"RAS":reorient_to_standard,
+                              "PIR":do_nothing}
+    
+    vol = volumeFromFile(infile)
+
+    geometry = get_world_geometry(size = vol.data.size,
+                                  voxel_orientation = voxel_orientation,
+                                  world_space = world_space,
+                                  expansion_factor = expansion_factor)
+
+    # Voxel orientation
+    new_data = map_voxel_orientations[voxel_orientation](vol.data)
 
     # Types
     vtype = vol.volumeType if volume_type is None else volume_type
@@ -363,14 +1290,10 @@ def transform_space(infile, outfile = None, voxel_orientation = 'RAS',
     outvol = volumeFromDescription(outputFilename=tmpfile,
                                    dimnames=["zspace", "yspace", "xspace"],
                                    sizes=new_data.shape,
-                                   starts=[-c for c in reversed(centers)],
-                                   steps=[s for s in reversed(steps)],
-                                   x_dir_cosines=xdc,
-                                   y_dir_cosines=ydc,
-                                   z_dir_cosines=zdc,
                                    volumeType=vtype,
                                    dtype=dtype,
-                                   labels=labels)
+                                   labels=labels,
+                                   **geometry)
 
     outvol.data = new_data
     outvol.writeFile()
@@ -380,50 +1303,1617 @@ def transform_space(infile, outfile = None, voxel_orientation = 'RAS',
         os.rename(tmpfile, infile)
         
     return outfile
-    
 
-def download_data(experiment, outdir):
+
+def transform_space_batch(infiles, outfiles = None, voxel_orientation = 'RAS', 
+                          world_space = 'MICe', expansion_factor = 1.0, 
+                          volume_type = None, data_type = None, 
+                          labels = False):
     
-    """
-    Download and transform the data from an ISH experiment
+    """ 
+    Transform the coordinate space of several MINC files at once
+    
+    Description
+    -----------
+    This is the batched equivalent of `transform_space()` for MINC 
+    files of the same size, e.g. expression images or atlas and 
+    template volumes. The volumes are stacked, reoriented in a 
+    single pass and written with a single geometry computation.
+    Volume and data types are taken from the first file unless 
+    specified.
 
     Arguments
     ---------
-    experiment: list
-        List containing ISH experiment information. Element 0 must
-        contain the experiment ID as `int`. Element 1 must contain
-        the gene acronym as `str`.
-    outdir: str
-        Directory in which to download the ISH image.
+    infiles: list of str
+        Names of the MINC files to transform.
+    outfiles: list of str, optional
+        Names of the output MINC files. If None, the input files will 
+        be overwritten. 
+        (default None)
+    voxel_orientation: str, optional
+        (default 'RAS')
+    world_space: str, optional
+        (default 'MICe')
+    expansion_factor: float, optional
+        (default 1.0)
+    volume_type: 
+        (default None)
+    data_type: 
+        (default None)
+    labels: bool, optional
+        (default None)
 
     Returns
     -------
-    None
+    outfiles: list of str
+        Names of the transformed files.
     """
     
-    experiment_id = experiment[0]
-    gene = experiment[1]
+    vols = [volumeFromFile(infile) for infile in infiles]
+    stack = np.stack([vol.data for vol in vols])
     
-    rawfile, success = fetch_expression(experiment_id, outdir = outdir)
-
-    if success == 1:
-        mincfile, success = rawtominc_wrapper(infile = rawfile)
+    vtype = vols[0].volumeType if volume_type is None else volume_type
+    dtype = vols[0].dtype if data_type is None else data_type
+    labels = vols[0].labels if labels is None else labels
     
-        outfile = transform_space(infile = mincfile, voxel_orientation = 'RAS',
-                                  world_space = 'MICe', expansion_factor = 1.0)
+    for vol in vols:
+        vol.closeVolume()
     
-        os.rename(outfile, outdir+'{}_{}.mnc'.format(gene, experiment_id))
+    if outfiles is None:
+        outfiles = infiles
+        
+    tmpfiles = [outfile.replace('.mnc', '')+'_tmp.mnc' 
+                if outfile in infiles else outfile 
+                for outfile in outfiles]
+    
+    write_minc_stack(stack = stack,
+                     outfiles = tmpfiles,
+                     voxel_orientation = voxel_orientation,
+                     world_space = world_space,
+                     expansion_factor = expansion_factor,
+                     volume_type = vtype,
+                     data_type = dtype,
+                     labels = labels)
+    
+    for tmpfile, outfile in zip(tmpfiles, outfiles):
+        if tmpfile != outfile:
+            os.rename(tmpfile, outfile)
+            
+    return outfiles
+
+
+def write_minc_stack(stack, outfiles, voxel_orientation = 'RAS',
+                     world_space = 'MICe', expansion_factor = 1.0,
+                     volume_type = 'ushort', data_type = 'double',
+                     labels = False):
+    
+    """
+    Reorient a stack of AMBA volumes and write them to MINC files
+    
+    Description
+    -----------
+    The stack is reoriented as a view using `reorient_stack()` and the
+    world geometry is computed once for all volumes. Each volume is 
+    only made contiguous in memory as it is written.
+    
+    Arguments
+    ---------
+    stack: numpy.ndarray
+        4-dimensional array of volumes in PIR voxel orientation, with
+        volumes along the first axis.
+    outfiles: list of str
+        Names of the output MINC files, one per volume.
+    voxel_orientation: str, optional
+        (default 'RAS')
+    world_space: str, optional
+        (default 'MICe')
+    expansion_factor: float, optional
+        (default 1.0)
+    volume_type: str, optional
+        Data type of the voxels stored on disk.
+        (default 'ushort')
+    data_type: str, optional
+        Data type of the voxel values in memory.
+        (default 'double')
+    labels: bool, optional
+        (default False)
+        
+    Returns
+    -------
+    outfiles: list of str
+        Names of the MINC files.
+    """
+    
+    if len(stack) != len(outfiles):
+        raise ValueError("Number of volumes ({}) and output files ({}) "
+                         "differ.".format(len(stack), len(outfiles)))
+    
+    geometry = get_world_geometry(size = stack[0].size,
+                                  voxel_orientation = voxel_orientation,
+                                  world_space = world_space,
+                                  expansion_factor = expansion_factor)
+    
+    new_stack = reorient_stack(stack, voxel_orientation = voxel_orientation)
+    
+    for new_data, outfile in zip(new_stack, outfiles):
+        
+        outvol = volumeFromDescription(outputFilename=outfile,
+                                       dimnames=["zspace", "yspace", "xspace"],
+                                       sizes=new_data.shape,
+                                       volumeType=volume_type,
+                                       dtype=data_type,
+                                       labels=labels,
+                                       **geometry)
+        
+        outvol.data = np.ascontiguousarray(new_data)
+        outvol.writeFile()
+        outvol.closeVolume()
+        
+    return outfiles
+
+
+def write_expression_minc(data, outfile, voxel_orientation = 'RAS',
+                          world_space = 'MICe', expansion_factor = 1.0,
+                          volume_type = 'ushort', data_type = 'double'):
+    
+    """
+    Write RAW expression energy to a MINC file in a single pass
+    
+    Description
+    -----------
+    This function fuses the RAW-to-MINC conversion and the change of
+    coordinate space performed by `rawtominc_wrapper()` and 
+    `transform_space()`. The RAW voxel values are reoriented in memory
+    and written once to the output file with the target world 
+    geometry, without calling rawtominc.
+    
+    Arguments
+    ---------
+    data: numpy.ndarray
+        1-dimensional array containing the RAW voxel values of a 
+        58x41x67 AMBA grid volume in PIR orientation.
+    outfile: str
+        Name of the output MINC file.
+    voxel_orientation: str, optional
+        (default 'RAS')
+    world_space: str, optional
+        (default 'MICe')
+    expansion_factor: float, optional
+        (default 1.0)
+    volume_type: str, optional
+        Data type of the voxels stored on disk. The default matches
+        the output of rawtominc with -oshort -ounsigned.
+        (default 'ushort')
+    data_type: str, optional
+        Data type of the voxel values in memory.
+        (default 'double')
+        
+    Returns
+    -------
+    outfile: str
+        Name of the MINC file.
+    """
+    
+    write_minc_stack(stack = np.reshape(data, (1, 58, 41, 67)),
+                     outfiles = [outfile],
+                     voxel_orientation = voxel_orientation,
+                     world_space = world_space,
+                     expansion_factor = expansion_factor,
+                     volume_type = volume_type,
+                     data_type = data_type)
+    
+    return outfile
+    
+
+def checksum_file(infile, blocksize = 2**20):
+    
+    """
+    Compute the MD5 checksum of a file
+    
+    Description
+    -----------
+    AHBA/download_AHBA.py keeps an identical copy of this function, 
+    because the AHBA pipeline does not depend on the MINC tools needed
+    to import this module. Keep both copies in sync.
+    
+    Arguments
+    ---------
+    infile: str
+        Path to the file.
+    blocksize: int, optional
+        Number of bytes read at a time.
+        (default 2**20)
+        
+    Returns
+    -------
+    checksum: str
+        Hexadecimal MD5 digest of the file.
+    """
+    
+    md5 = hashlib.md5()
+    with open(infile, 'rb') as file:
+        for block in iter(lambda: file.read(blocksize), b''):
+            md5.update(block)
+            
+    return md5.hexdigest()
+
+
+def checksum_array(data):
+    
+    """
+    Compute the MD5 checksum of the contents of an array
+    
+    Arguments
+    ---------
+    data: numpy.ndarray
+        Array to checksum.
+        
+    Returns
+    -------
+    checksum: str
+        Hexadecimal MD5 digest of the array buffer.
+    """
+    
+    return hashlib.md5(np.ascontiguousarray(data).tobytes()).hexdigest()
+
+
+def open_store(storefile, channels = None):
+    
+    """
+    Open the consolidated expression store, creating it if needed
+    
+    Description
+    -----------
+    The store is an HDF5 file containing the expression data of every
+    experiment in chunked, compressed, resizable data sets named after
+    the channels ('energy', 'density', 'intensity'), with experiments 
+    as rows and voxels as columns (float32). Every row is a volume 
+    reoriented to RAS and flattened in the same order as the voxels
+    of the MINC files written by `write_expression_minc()`. The data 
+    sets 'experiment_id' and 'gene' index the rows of all channels, 
+    and the volume sizes and MICe world geometry are stored as file 
+    attributes. Rows of a channel that were not downloaded for an 
+    experiment are filled with NaN.
+    
+    Arguments
+    ---------
+    storefile: str
+        Path to the HDF5 file.
+    channels: list of str, optional
+        Channels to create in the store if they do not exist. If None,
+        only the expression energy is created.
+        (default None)
+        
+    Returns
+    -------
+    store: h5py.File
+        Open store, in append mode.
+    """
+    
+    nvoxels = 58*41*67
+    channels = ['energy'] if channels is None else channels
+    
+    store = h5py.File(storefile, 'a')
+    
+    if 'experiment_id' not in store:
+        
+        store.create_dataset('experiment_id', shape = (0,), 
+                             maxshape = (None,), dtype = 'int64', 
+                             chunks = (1024,))
+        store.create_dataset('gene', shape = (0,), 
+                             maxshape = (None,), 
+                             dtype = h5py.string_dtype(),
+                             chunks = (1024,))
+        
+        sizes = reorient_to_standard(np.empty((58, 41, 67))).shape
+        geometry = get_world_geometry(size = nvoxels,
+                                      voxel_orientation = 'RAS',
+                                      world_space = 'MICe')
+        store.attrs['sizes'] = sizes
+        store.attrs['dimnames'] = ['zspace', 'yspace', 'xspace']
+        store.attrs['voxel_orientation'] = 'RAS'
+        store.attrs['world_space'] = 'MICe'
+        for key, value in geometry.items():
+            store.attrs[key] = value
+            
+    nrows = store['experiment_id'].shape[0]
+    for channel in channels:
+        if channel not in store:
+            store.create_dataset(channel, shape = (nrows, nvoxels),
+                                 maxshape = (None, nvoxels), 
+                                 dtype = 'float32',
+                                 chunks = (1, nvoxels),
+                                 compression = 'gzip',
+                                 compression_opts = 4,
+                                 shuffle = True,
+                                 fillvalue = np.nan)
+    
+    return store
+
+
+def get_store_channels(store):
+    
+    """
+    Get the channels present in the expression store
+    
+    Arguments
+    ---------
+    store: h5py.File
+        Open expression store.
+        
+    Returns
+    -------
+    channels: list of str
+        Names of the channel data sets.
+    """
+    
+    return [name for name in store if store[name].ndim == 2]
+
+
+def get_store_index(store):
+    
+    """
+    Map the experiment IDs in the expression store to rows
+    
+    Arguments
+    ---------
+    store: h5py.File
+        Open expression store.
+        
+    Returns
+    -------
+    index: dict
+        Dictionary with experiment IDs as keys and row indices as 
+        values.
+    """
+    
+    return {experiment_id: i for i, experiment_id in 
+            enumerate(store['experiment_id'][:].tolist())}
+
+
+def write_store(store, index, experiment_id, gene, data):
+    
+    """
+    Write the expression data of an experiment to the store
+    
+    Description
+    -----------
+    The volumes are appended to the store, unless the experiment is 
+    already present, in which case its row is overwritten in the 
+    channels provided.
+    
+    Arguments
+    ---------
+    store: h5py.File
+        Open expression store, containing all channels in `data`.
+    index: dict
+        Row index of the store, as returned by `get_store_index()`.
+        Updated in place.
+    experiment_id: int
+        The ID of the ISH experiment.
+    gene: str
+        Gene acronym for the ISH experiment.
+    data: dict
+        Dictionary with channel names as keys and 1-dimensional 
+        arrays containing the RAW channel values in PIR orientation 
+        as values.
+        
+    Returns
+    -------
+    rows: dict
+        Dictionary with channel names as keys and the reoriented, 
+        flattened float32 volumes written to the store as values.
+    """
+    
+    if experiment_id in index:
+        i = index[experiment_id]
+    else:
+        i = store['experiment_id'].shape[0]
+        for name in ['experiment_id', 'gene'] + get_store_channels(store):
+            store[name].resize(i+1, axis = 0)
+        store['experiment_id'][i] = experiment_id
+        index[experiment_id] = i
+        
+    store['gene'][i] = gene
+    
+    rows = {}
+    for channel, array in data.items():
+        rows[channel] = (reorient_to_standard(np.reshape(array, (58, 41, 67)))
+                         .ravel()
+                         .astype('float32'))
+        store[channel][i] = rows[channel]
+    
+    return rows
+
+
+def manifest_record(experiment_id, gene, status, outfile = None,
+                    data = None, channel = 'energy', path = None):
+    
+    """
+    Create a download manifest record for an ISH experiment channel
+    
+    Arguments
+    ---------
+    experiment_id: int
+        The ID of the ISH experiment.
+    gene: str
+        Gene acronym for the ISH experiment.
+    status: str
+        Download status. One of 'complete', 'no_data' or 'failed'.
+    outfile: str, optional
+        Path to the downloaded file. Required to record the size and 
+        checksum of complete downloads written to MINC files.
+        (default None)
+    data: numpy.ndarray, optional
+        Array written to the expression store. Required to record the
+        size and checksum of complete downloads written to the store.
+        (default None)
+    channel: str, optional
+        Name of the channel.
+        (default 'energy')
+    path: str, optional
+        Path to the file containing the data, if different from 
+        `outfile`, e.g. the expression store.
+        (default None)
+        
+    Returns
+    -------
+    record: dict
+        Dictionary with keys corresponding to the manifest columns. 
+        The plane of section is filled in by `update_manifest()`.
+    """
+    
+    if outfile is not None:
+        size = os.path.getsize(outfile)
+        checksum = checksum_file(outfile)
+    elif data is not None:
+        size = data.nbytes
+        checksum = checksum_array(data)
+    else:
+        size = 0
+        checksum = ''
+    
+    if path is None:
+        path = '' if outfile is None else outfile
+    
+    record = {'experiment_id': experiment_id,
+              'gene': gene,
+              'plane': None,
+              'channel': channel,
+              'path': path,
+              'bytes': size,
+              'checksum': checksum,
+              'status': status,
+              'timestamp': datetime.now().isoformat(timespec = 'seconds')}
+    
+    return record
+
+
+def status_records(experiment_id, gene, status, channels = None):
+    
+    """
+    Create manifest records with the same status for several channels
+    
+    Arguments
+    ---------
+    experiment_id: int
+        The ID of the ISH experiment.
+    gene: str
+        Gene acronym for the ISH experiment.
+    status: str
+        Download status. One of 'no_data' or 'failed'.
+    channels: list of str, optional
+        Names of the channels. If None, a record is created for the 
+        expression energy only.
+        (default None)
+        
+    Returns
+    -------
+    records: list of dict
+        Manifest records for every channel.
+    """
+    
+    channels = ['energy'] if channels is None else channels
+    
+    return [manifest_record(experiment_id, gene, status, channel = channel)
+            for channel in channels]
+
+
+_manifest_lock = threading.Lock()
+
+def update_manifest(manifest, records):
+    
+    """
+    Append records to the download manifest
+    
+    Description
+    -----------
+    The manifest is the index of a dataset directory. File paths are 
+    recorded relative to the directory containing the manifest, whose 
+    name is recorded as the plane of section. Manifests written by 
+    earlier versions of this script, with fewer columns, are rewritten
+    with the current columns before the records are appended.
+    
+    Arguments
+    ---------
+    manifest: str
+        Path to the manifest CSV file. If None, nothing is written.
+    records: dict or list of dict
+        Manifest record(s), as returned by `manifest_record()`.
+        
+    Returns
+    -------
+    None
+    """
+    
+    if manifest is None:
+        return
+    
+    if isinstance(records, dict):
+        records = [records]
+    if len(records) == 0:
+        return
+    
+    root = os.path.dirname(os.path.abspath(manifest))
+    plane = os.path.basename(root)
+    
+    records = [dict(record) for record in records]
+    for record in records:
+        if record.get('plane') is None:
+            record['plane'] = plane
+        if record.get('path'):
+            record['path'] = os.path.relpath(record['path'], root)
+    
+    columns = list(records[0].keys())
+    
+    with _manifest_lock:
+        header = not os.path.isfile(manifest)
+        if not header:
+            with open(manifest, 'r') as file:
+                existing = file.readline().strip().split(',')
+            if existing != columns:
+                (read_manifest(manifest, latest = False)
+                 .reindex(columns = columns)
+                 .to_csv(manifest, index = False))
+        (pd.DataFrame(records, columns = columns)
+         .to_csv(manifest, mode = 'a', header = header, index = False))
+        
+    return
+
+
+def read_manifest(manifest, latest = True):
+    
+    """
+    Import the download manifest
+    
+    Description
+    -----------
+    Records are appended to the manifest every time an experiment is
+    downloaded, so by default only the most recent record for every 
+    experiment and channel is kept. Records written before channels 
+    were recorded refer to the expression energy. Complete records 
+    written before paths were recorded are assigned the path of their
+    MINC file if it exists. Otherwise their storage is unknown, e.g. 
+    for experiments downloaded to an expression store, and their path
+    is left empty.
+    
+    Arguments
+    ---------
+    manifest: str
+        Path to the manifest CSV file.
+    latest: bool, optional
+        Option to keep only the most recent record for every 
+        experiment and channel.
+        (default True)
+        
+    Returns
+    -------
+    dfManifest: pandas.core.frame.DataFrame
+        Data frame containing the manifest records.
+    """
+    
+    columns = ['experiment_id', 'gene', 'plane', 'channel', 'path', 
+               'bytes', 'checksum', 'status', 'timestamp']
+    
+    if not os.path.isfile(manifest):
+        return pd.DataFrame(columns = columns)
+    
+    dfManifest = (pd.read_csv(manifest, dtype = {'checksum': str, 
+                                                 'path': str})
+                  .reindex(columns = columns))
+    
+    #Fill in the columns of records written by earlier versions
+    root = os.path.dirname(os.path.abspath(manifest))
+    for column in ['plane', 'channel', 'path']:
+        dfManifest[column] = dfManifest[column].astype('object')
+    dfManifest['plane'] = dfManifest['plane'].fillna(os.path.basename(root))
+    dfManifest['channel'] = dfManifest['channel'].fillna('energy')
+    missing = (dfManifest['path'].isna() & 
+               (dfManifest['status'] == 'complete'))
+    paths = [
+        get_channel_dir('', channel)+'{}_{}.mnc'.format(gene, experiment_id)
+        for experiment_id, gene, channel in 
+        dfManifest.loc[missing, ['experiment_id', 'gene', 'channel']]
+        .itertuples(index = False)
+    ]
+    dfManifest.loc[missing, 'path'] = [
+        path if os.path.isfile(os.path.join(root, path)) else ''
+        for path in paths
+    ]
+    dfManifest['path'] = dfManifest['path'].fillna('')
+    
+    if latest:
+        dfManifest = (dfManifest
+                      .drop_duplicates(subset = ['experiment_id', 'channel'], 
+                                       keep = 'last')
+                      .reset_index(drop = True))
+    
+    return dfManifest
+
+
+def get_pending_experiments(experiments, manifest, outdir, verify = False,
+                            storefile = None, channels = None):
+    
+    """
+    Identify ISH experiments that still need to be downloaded
+    
+    Description
+    -----------
+    A channel of an experiment is considered done if the manifest 
+    records it as complete and the downloaded file exists with the 
+    recorded size (and checksum, if `verify` is True), or if the 
+    manifest records that the channel has no data. When downloading 
+    to an expression store, the experiment must be present in the 
+    store instead. An experiment is pending if any of the requested
+    channels is not done.
+    
+    Arguments
+    ---------
+    experiments: list of tuple
+        List of ISH experiments. Element 0 of every tuple must contain 
+        the experiment ID as `int`. Element 1 must contain the gene 
+        acronym as `str`.
+    manifest: str
+        Path to the manifest CSV file.
+    outdir: str
+        Directory containing the downloaded ISH images.
+    verify: bool, optional
+        Option to verify file checksums.
+        (default False)
+    storefile: str, optional
+        Path to the expression store, if the data are downloaded to a
+        store rather than to MINC files.
+        (default None)
+    channels: list of str, optional
+        Channels to download. If None, only the expression energy is
+        considered.
+        (default None)
+        
+    Returns
+    -------
+    pending: list of tuple
+        Subset of `experiments` that are missing or corrupt.
+    """
+    
+    channels = ['energy'] if channels is None else channels
+    
+    dfManifest = (read_manifest(manifest)
+                  .set_index(['experiment_id', 'channel'])
+                  .sort_index())
+    
+    if storefile is not None:
+        store = open_store(storefile, channels = channels)
+        index = get_store_index(store)
+    
+    def is_done(experiment_id, gene, channel):
+        
+        if (experiment_id, channel) not in dfManifest.index:
+            return False
+            
+        record = dfManifest.loc[(experiment_id, channel)]
+        if record['status'] == 'no_data':
+            return True
+        
+        if storefile is not None:
+            done = ((record['status'] == 'complete') and 
+                    (experiment_id in index))
+            if done and verify:
+                row = store[channel][index[experiment_id]]
+                done = checksum_array(row) == record['checksum']
+        else:
+            outfile = (get_channel_dir(outdir, channel)+
+                       '{}_{}.mnc'.format(gene, experiment_id))
+            done = ((record['status'] == 'complete') and 
+                    os.path.isfile(outfile) and 
+                    (os.path.getsize(outfile) == record['bytes']))
+            if done and verify:
+                done = checksum_file(outfile) == record['checksum']
+                
+        return done
+    
+    pending = []
+    for experiment_id, gene in experiments:
+        if not all(is_done(experiment_id, gene, channel) 
+                   for channel in channels):
+            pending.append((experiment_id, gene))
+            
+    if storefile is not None:
+        store.close()
+        
+    return pending
+
+
+def convert_expression(data, gene, experiment_id, outdir):
+    
+    """
+    Convert downloaded expression energy to a MINC file in MICe space
+    
+    Arguments
+    ---------
+    data: numpy.ndarray
+        Array containing the RAW expression energy values.
+    gene: str
+        Gene acronym for the ISH experiment.
+    experiment_id: int
+        The ID of the ISH experiment.
+    outdir: str
+        Directory in which to save the MINC file.
+        
+    Returns
+    -------
+    outfile: str
+        Path to the MINC file.
+    """
+    
+    outfile = outdir+'{}_{}.mnc'.format(gene, experiment_id)
+    outfile = write_expression_minc(data = data, outfile = outfile,
+                                    voxel_orientation = 'RAS',
+                                    world_space = 'MICe', 
+                                    expansion_factor = 1.0)
+    
+    return outfile
+
+
+def convert_data(experiment, data, channels = None):
+    
+    """
+    Convert a downloaded ISH experiment and create its manifest records
+    
+    Description
+    -----------
+    Every channel in `data` is written to a MINC file in the directory
+    of the channel. Requested channels that are missing from `data` 
+    are recorded as having no data.
+    
+    Arguments
+    ---------
+    experiment: tuple
+        Tuple containing ISH experiment information. Element 0 must
+        contain the experiment ID as `int`. Element 1 must contain
+        the gene acronym as `str`. Element 2 must contain the directory
+        in which to save the MINC file as `str`.
+    data: dict
+        Dictionary with channel names as keys and arrays containing 
+        the RAW channel values as values.
+    channels: list of str, optional
+        Channels requested for the experiment. If None, the channels 
+        in `data` are used.
+        (default None)
+        
+    Returns
+    -------
+    records: list of dict
+        Manifest records for every channel of the experiment.
+    stats: DownloadStats
+        Conversion and checksum times for the experiment.
+    """
+    
+    experiment_id, gene, outdir = experiment
+    channels = list(data.keys()) if channels is None else channels
+    
+    stats = DownloadStats()
+    
+    records = []
+    for channel in channels:
+        
+        if channel not in data:
+            records.append(manifest_record(experiment_id, gene, 'no_data',
+                                           channel = channel))
+            continue
+        
+        try:
+            channel_dir = get_channel_dir(outdir, channel)
+            os.makedirs(channel_dir, exist_ok = True)
+            start = time.monotonic()
+            outfile = convert_expression(data = data[channel], gene = gene,
+                                         experiment_id = experiment_id, 
+                                         outdir = channel_dir)
+            stats.add('convert', time.monotonic() - start, 
+                      data[channel].nbytes)
+            start = time.monotonic()
+            record = manifest_record(experiment_id, gene, 'complete', 
+                                     outfile, channel = channel)
+            stats.add('checksum', time.monotonic() - start, record['bytes'])
+        except Exception as err:
+            print('Error converting experiment {}: {}. Ignoring.'
+                  .format(experiment_id, err))
+            record = manifest_record(experiment_id, gene, 'failed',
+                                     channel = channel)
+        records.append(record)
+        
+    stats.count(get_status(records))
+        
+    return records, stats
+
+
+def get_status(records):
+    
+    """
+    Summarize the status of the manifest records of an experiment
+    
+    Arguments
+    ---------
+    records: list of dict
+        Manifest records for the channels of an experiment.
+        
+    Returns
+    -------
+    status: str
+        'failed' if any channel failed, 'complete' if any channel was
+        written, and 'no_data' otherwise.
+    """
+    
+    statuses = {record['status'] for record in records}
+    
+    if 'failed' in statuses:
+        return 'failed'
+    elif 'complete' in statuses:
+        return 'complete'
+    else:
+        return 'no_data'
+
+
+def download_data(experiment, api_url = 'http://api.brain-map.org',
+                  debug = False, retries = 0, backoff = 1.0, 
+                  timeout = 60.0, channels = None):
+    
+    """
+    Download and transform the data from an ISH experiment
+
+    Arguments
+    ---------
+    experiment: tuple
+        Tuple containing ISH experiment information. Element 0 must
+        contain the experiment ID as `int`. Element 1 must contain
+        the gene acronym as `str`. Element 2 must contain the directory
+        in which to download the ISH image as `str`.
+    api_url: str, optional
+        Base URL of the Allen Brain Atlas API.
+        (default 'http://api.brain-map.org')
+    debug: bool, optional
+        Option to write the downloaded archive to disk and keep the
+        RAW files.
+        (default False)
+    retries: int, optional
+        Maximal number of retries for failed or throttled requests.
+        (default 0)
+    backoff: float, optional
+        Delay in seconds before the first retry.
+        (default 1.0)
+    timeout: float, optional
+        Time in seconds to wait for the connection and for every read
+        from the server.
+        (default 60.0)
+    channels: list of str, optional
+        Channels to extract. If None, only the expression energy is 
+        extracted.
+        (default None)
+
+    Returns
+    -------
+    records: list of dict
+        Manifest records for every channel of the experiment.
+    stats: DownloadStats
+        Timings and counters for the experiment.
+    """
+    
+    experiment_id, gene, outdir = experiment
+    channels = ['energy'] if channels is None else channels
+    
+    stats = DownloadStats()
+    
+    try:
+        data, success = fetch_expression(experiment_id, outdir = outdir,
+                                         api_url = api_url, debug = debug,
+                                         retries = retries, 
+                                         backoff = backoff,
+                                         timeout = timeout,
+                                         stats = stats,
+                                         channels = channels)
+    except Exception as err:
+        print('Error downloading experiment {}: {}. Ignoring.'
+              .format(experiment_id, err))
+        stats.count('failed')
+        return status_records(experiment_id, gene, 'failed', channels), stats
+
+    if success == 1:
+        records, convert_stats = convert_data(experiment, data, channels)
+        stats.merge(convert_stats)
+    else:
+        records = status_records(experiment_id, gene, 'no_data', channels)
+        stats.count('no_data')
+    
+    return records, stats
+
+
+def get_manifest_path(experiment, manifest):
+    
+    """
+    Get the path to the manifest of an experiment's dataset
+    
+    Arguments
+    ---------
+    experiment: tuple
+        Tuple containing ISH experiment information. Element 2 must 
+        contain the directory in which the experiment is downloaded.
+    manifest: str
+        Name of the manifest file in the download directory. If None,
+        no manifest is used.
+        
+    Returns
+    -------
+    manifest: str
+        Path to the manifest CSV file, or None.
+    """
+    
+    return None if manifest is None else experiment[2]+manifest
+
+
+def download_data_threaded(experiments, connections = 50, nproc = 1, 
+                           api_url = 'http://api.brain-map.org',
+                           manifest = None, debug = False, 
+                           adaptive = False, retries = 0, backoff = 1.0,
+                           timeout = 60.0, stats = None, channels = None):
+    
+    """
+    Download and transform ISH experiments using a shared connection pool
+    
+    Description
+    -----------
+    Network requests are issued from a pool of threads sharing a single
+    keep-alive HTTP session, so that the number of requests in flight
+    is independent of the number of CPUs. Downloaded files are handed
+    off to a pool of processes for conversion to MINC as they arrive.
+    At most `connections` + 4*`nproc` downloaded experiments are held
+    in memory: requests wait while the conversions fall behind. 
+    Experiments from several datasets can be scheduled together.
+    
+    Arguments
+    ---------
+    experiments: list of tuple
+        List of ISH experiments. Element 0 of every tuple must contain 
+        the experiment ID as `int`. Element 1 must contain the gene 
+        acronym as `str`. Element 2 must contain the directory in 
+        which to download the ISH image as `str`.
+    connections: int, optional
+        Number of concurrent HTTP requests. If `adaptive` is True, the
+        maximal number of concurrent requests.
+        (default 50)
+    nproc: int, optional
+        Number of processes used to convert the downloaded files.
+        (default 1)
+    api_url: str, optional
+        Base URL of the Allen Brain Atlas API.
+        (default 'http://api.brain-map.org')
+    manifest: str, optional
+        Name of the manifest CSV file, in the download directory of 
+        every experiment, in which to record its status.
+        (default None)
+    debug: bool, optional
+        Option to write the downloaded archives to disk and keep the
+        RAW files.
+        (default False)
+    adaptive: bool, optional
+        Option to adapt the number of concurrent requests to the 
+        latency and error responses of the server.
+        (default False)
+    retries: int, optional
+        Maximal number of retries for failed or throttled requests.
+        (default 0)
+    backoff: float, optional
+        Delay in seconds before the first retry.
+        (default 1.0)
+    timeout: float, optional
+        Time in seconds to wait for the connection and for every read
+        from the server.
+        (default 60.0)
+    stats: DownloadStats, optional
+        Statistics in which to record timings and counters.
+        (default None)
+    channels: list of str, optional
+        Channels to extract. If None, only the expression energy is 
+        extracted.
+        (default None)
+        
+    Returns
+    -------
+    None
+    """
+    
+    stats = DownloadStats() if stats is None else stats
+    channels = ['energy'] if channels is None else channels
+    
+    if adaptive:
+        limiter = AdaptiveLimiter(initial = min(8, connections),
+                                  maximum = connections)
+    else:
+        limiter = None
+    
+    session = create_session(pool_size = connections)
+    fetch_expression_partial = partial(fetch_expression, 
+                                       session = session,
+                                       api_url = api_url,
+                                       debug = debug,
+                                       limiter = limiter,
+                                       retries = retries,
+                                       backoff = backoff,
+                                       timeout = timeout,
+                                       stats = stats,
+                                       channels = channels)
+    
+    #Bound the number of downloaded experiments held in memory. A slot
+    #is taken before every request and released once the experiment 
+    #is converted, so that downloads wait for slow conversions.
+    slots = threading.BoundedSemaphore(connections + 4*nproc)
+    
+    def fetch_experiment(experiment):
+        slots.acquire()
+        try:
+            return fetch_expression_partial(experiment[0], 
+                                            outdir = experiment[2])
+        except Exception:
+            slots.release()
+            raise
+    
+    def release_conversion(manifest_path, result):
+        slots.release()
+        collect_conversion(manifest_path, stats, result)
+    
+    #Start the conversion processes before any download threads exist
+    pool = mp.Pool(nproc)
+    
+    with ThreadPoolExecutor(max_workers = connections) as executor:
+        
+        futures = {executor.submit(fetch_experiment, experiment):
+                   experiment for experiment in experiments}
+        
+        conversions = []
+        for future in tqdm(as_completed(futures), total = len(futures)):
+            
+            experiment = futures.pop(future)
+            experiment_id, gene, outdir = experiment
+            manifest_path = get_manifest_path(experiment, manifest)
+            
+            try:
+                data, success = future.result()
+            except Exception as err:
+                print('Error downloading experiment {}: {}. Ignoring.'
+                      .format(experiment_id, err))
+                update_manifest(manifest_path, 
+                                status_records(experiment_id, gene, 
+                                               'failed', channels))
+                stats.count('failed')
+                continue
+                
+            if success == 1:
+                conversions.append(
+                    pool.apply_async(convert_data, 
+                                     (experiment, data, channels),
+                                     callback = partial(release_conversion,
+                                                        manifest_path),
+                                     error_callback = (lambda err: 
+                                                       slots.release()))
+                )
+            else:
+                slots.release()
+                update_manifest(manifest_path, 
+                                status_records(experiment_id, gene, 
+                                               'no_data', channels))
+                stats.count('no_data')
+            del data
+    
+    for conversion in conversions:
+        conversion.get()
+        
+    pool.close()
+    pool.join()
+    session.close()
+    
+    return
+
+
+def collect_conversion(manifest, stats, result):
+    
+    """
+    Record the result of a conversion in the manifest and statistics
+    
+    Arguments
+    ---------
+    manifest: str
+        Path to the manifest CSV file. If None, nothing is written.
+    stats: DownloadStats
+        Statistics in which to merge the conversion statistics.
+    result: tuple
+        Manifest records and statistics returned by `convert_data()`.
+        
+    Returns
+    -------
+    None
+    """
+    
+    records, convert_stats = result
+    update_manifest(manifest, records)
+    stats.merge(convert_stats)
+    
+    return
+    
+    
+def store_data(store, index, experiment, data, channels = None):
+    
+    """
+    Write a downloaded ISH experiment to the store and create its records
+    
+    Arguments
+    ---------
+    store: h5py.File
+        Open expression store, containing all channels in `data`.
+    index: dict
+        Row index of the store, as returned by `get_store_index()`.
+        Updated in place.
+    experiment: tuple
+        Tuple containing ISH experiment information. Element 0 must
+        contain the experiment ID as `int`. Element 1 must contain
+        the gene acronym as `str`.
+    data: dict
+        Dictionary with channel names as keys and arrays containing 
+        the RAW channel values as values.
+    channels: list of str, optional
+        Channels requested for the experiment. If None, the channels 
+        in `data` are used.
+        (default None)
+        
+    Returns
+    -------
+    records: list of dict
+        Manifest records for every channel of the experiment.
+    stats: DownloadStats
+        Store and checksum times for the experiment.
+    """
+    
+    experiment_id, gene = experiment[:2]
+    channels = list(data.keys()) if channels is None else channels
+    
+    stats = DownloadStats()
+    
+    start = time.monotonic()
+    rows = write_store(store, index, experiment_id, gene, data)
+    stats.add('store', time.monotonic() - start, 
+              sum(row.nbytes for row in rows.values()))
+    
+    records = []
+    for channel in channels:
+        if channel in rows:
+            start = time.monotonic()
+            records.append(manifest_record(experiment_id, gene, 'complete', 
+                                           data = rows[channel],
+                                           channel = channel,
+                                           path = store.filename))
+            stats.add('checksum', time.monotonic() - start, 
+                      rows[channel].nbytes)
+        else:
+            records.append(manifest_record(experiment_id, gene, 'no_data',
+                                           channel = channel))
+    stats.count(get_status(records))
+    
+    return records, stats
+    
+    
+def download_data_store(experiments, storefile, connections = 50, 
+                        api_url = 'http://api.brain-map.org',
+                        manifest = None, debug = False, 
+                        adaptive = False, retries = 0, backoff = 1.0,
+                        timeout = 60.0, stats = None, channels = None):
+    
+    """
+    Download ISH experiments into the consolidated expression store
+    
+    Description
+    -----------
+    Network requests are issued from a pool of threads sharing a single
+    keep-alive HTTP session. Downloaded volumes are reoriented and 
+    appended to the expression store of their download directory by 
+    the calling process as they arrive. Experiments from several 
+    datasets can be scheduled together.
+    
+    Arguments
+    ---------
+    experiments: list of tuple
+        List of ISH experiments. Element 0 of every tuple must contain 
+        the experiment ID as `int`. Element 1 must contain the gene 
+        acronym as `str`. Element 2 must contain the download 
+        directory as `str`.
+    storefile: str
+        Name of the HDF5 expression store in every download directory.
+        Created if it does not exist.
+    connections: int, optional
+        Number of concurrent HTTP requests. If `adaptive` is True, the
+        maximal number of concurrent requests.
+        (default 50)
+    api_url: str, optional
+        Base URL of the Allen Brain Atlas API.
+        (default 'http://api.brain-map.org')
+    manifest: str, optional
+        Name of the manifest CSV file, in the download directory of 
+        every experiment, in which to record its status.
+        (default None)
+    debug: bool, optional
+        Option to write the downloaded archives to disk and keep the
+        RAW files.
+        (default False)
+    adaptive: bool, optional
+        Option to adapt the number of concurrent requests to the 
+        latency and error responses of the server.
+        (default False)
+    retries: int, optional
+        Maximal number of retries for failed or throttled requests.
+        (default 0)
+    backoff: float, optional
+        Delay in seconds before the first retry.
+        (default 1.0)
+    timeout: float, optional
+        Time in seconds to wait for the connection and for every read
+        from the server.
+        (default 60.0)
+    stats: DownloadStats, optional
+        Statistics in which to record timings and counters.
+        (default None)
+    channels: list of str, optional
+        Channels to extract. If None, only the expression energy is 
+        extracted.
+        (default None)
+        
+    Returns
+    -------
+    None
+    """
+    
+    stats = DownloadStats() if stats is None else stats
+    channels = ['energy'] if channels is None else channels
+    
+    if adaptive:
+        limiter = AdaptiveLimiter(initial = min(8, connections),
+                                  maximum = connections)
+    else:
+        limiter = None
+    
+    session = create_session(pool_size = connections)
+    fetch_expression_partial = partial(fetch_expression, 
+                                       session = session,
+                                       api_url = api_url,
+                                       debug = debug,
+                                       limiter = limiter,
+                                       retries = retries,
+                                       backoff = backoff,
+                                       timeout = timeout,
+                                       stats = stats,
+                                       channels = channels)
+    
+    #Open one store per download directory
+    stores = {}
+    for outdir in {experiment[2] for experiment in experiments}:
+        store = open_store(outdir+storefile, channels = channels)
+        stores[outdir] = (store, get_store_index(store))
+    
+    with ThreadPoolExecutor(max_workers = connections) as executor:
+        
+        futures = {executor.submit(fetch_expression_partial, experiment[0],
+                                   outdir = experiment[2]):
+                   experiment for experiment in experiments}
+        
+        for future in tqdm(as_completed(futures), total = len(futures)):
+            
+            experiment = futures.pop(future)
+            experiment_id, gene, outdir = experiment
+            manifest_path = get_manifest_path(experiment, manifest)
+            
+            try:
+                data, success = future.result()
+            except Exception as err:
+                print('Error downloading experiment {}: {}. Ignoring.'
+                      .format(experiment_id, err))
+                update_manifest(manifest_path, 
+                                status_records(experiment_id, gene, 
+                                               'failed', channels))
+                stats.count('failed')
+                continue
+                
+            if success == 1:
+                store, index = stores[outdir]
+                records, store_stats = store_data(store, index, experiment, 
+                                                  data, channels)
+                stats.merge(store_stats)
+            else:
+                records = status_records(experiment_id, gene, 'no_data', 
+                                         channels)
+                stats.count('no_data')
+            update_manifest(manifest_path, records)
+            
+    for store, index in stores.values():
+        store.close()
+    session.close()
+    
+    return
+
+
+def iter_archive(archive, experiment_ids = None, stats = None):
+    
+    """
+    Iterate over the AMBA grid data zip files in an archive
+    
+    Description
+    -----------
+    The archive can be a directory or a (possibly compressed) tar 
+    file. Files are identified by names of the form 
+    '<experiment_id>.zip' and are read sequentially, without being 
+    unpacked to disk.
+    
+    Arguments
+    ---------
+    archive: str
+        Path to the directory or tar file.
+    experiment_ids: set of int, optional
+        IDs of the experiments to read. If None, all zip files in the
+        archive are read.
+        (default None)
+    stats: DownloadStats, optional
+        Statistics in which to record read times and bytes.
+        (default None)
+        
+    Yields
+    ------
+    experiment_id: int
+        The ID of the ISH experiment.
+    content: bytes
+        Content of the zip file.
+    """
     
+    stats = DownloadStats() if stats is None else stats
+    pattern = re.compile(r'^([0-9]+)\.zip$')
+    
+    def wanted(name):
+        match = pattern.match(os.path.basename(name))
+        if match is None:
+            return None
+        experiment_id = int(match.group(1))
+        if (experiment_ids is not None) and (experiment_id not in experiment_ids):
+            return None
+        return experiment_id
+    
+    if os.path.isdir(archive):
+        for name in sorted(os.listdir(archive)):
+            experiment_id = wanted(name)
+            if experiment_id is None:
+                continue
+            start = time.monotonic()
+            with open(os.path.join(archive, name), 'rb') as file:
+                content = file.read()
+            stats.add('read', time.monotonic() - start, len(content))
+            yield experiment_id, content
+    else:
+        with tarfile.open(archive, 'r:*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                experiment_id = wanted(member.name)
+                if experiment_id is None:
+                    continue
+                start = time.monotonic()
+                content = tar.extractfile(member).read()
+                stats.add('read', time.monotonic() - start, len(content))
+                yield experiment_id, content
+                
     return
+
+
+def import_data(task, debug = False, convert = True, channels = None):
+    
+    """
+    Extract and transform an ISH experiment read from an archive
+    
+    Arguments
+    ---------
+    task: tuple
+        Tuple containing the ISH experiment tuple (experiment ID, 
+        gene acronym, output directory) and the content of its zip 
+        file.
+    debug: bool, optional
+        Option to write the zip file to disk and keep the RAW file.
+        (default False)
+    convert: bool, optional
+        Option to convert the expression data to MINC files. If False,
+        the decoded arrays are returned instead.
+        (default True)
+    channels: list of str, optional
+        Channels to extract. If None, only the expression energy is 
+        extracted.
+        (default None)
+        
+    Returns
+    -------
+    experiment: tuple
+        The ISH experiment tuple.
+    records: list of dict
+        Manifest records for the experiment, or None if the decoded 
+        arrays were returned without being converted.
+    data: dict
+        The decoded channels, if they were not converted.
+    stats: DownloadStats
+        Timings and counters for the experiment.
+    """
+    
+    experiment, content = task
+    experiment_id, gene, outdir = experiment
+    channels = ['energy'] if channels is None else channels
+    
+    stats = DownloadStats()
+    
+    try:
+        data, success = extract_expression(experiment_id = experiment_id,
+                                           content = content,
+                                           outdir = outdir,
+                                           debug = debug,
+                                           stats = stats,
+                                           channels = channels)
+    except Exception as err:
+        print('Error reading experiment {}: {}. Ignoring.'
+              .format(experiment_id, err))
+        stats.count('failed')
+        records = status_records(experiment_id, gene, 'failed', channels)
+        return experiment, records, None, stats
+    
+    if success == 0:
+        stats.count('no_data')
+        records = status_records(experiment_id, gene, 'no_data', channels)
+        return experiment, records, None, stats
+    
+    if convert:
+        records, convert_stats = convert_data(experiment, data, channels)
+        stats.merge(convert_stats)
+        data = None
+    else:
+        records = None
+        
+    return experiment, records, data, stats
+
+
+def import_archive(archive, experiments, nproc = 1, storefile = None, 
+                   manifest = None, debug = False, stats = None,
+                   channels = None):
+    
+    """
+    Import ISH experiments from an archive of AMBA grid data zip files
+    
+    Description
+    -----------
+    Zip files are read sequentially from the archive and handed to a 
+    pool of processes, which extract the expression data in memory 
+    and convert it using the same path as downloaded experiments. The 
+    number of zip files held in memory is bounded. Experiments that 
+    are not in the archive are left pending.
+    
+    Arguments
+    ---------
+    archive: str
+        Path to a directory or tar file containing zip files named
+        '<experiment_id>.zip'.
+    experiments: list of tuple
+        List of ISH experiments. Element 0 of every tuple must contain 
+        the experiment ID as `int`. Element 1 must contain the gene 
+        acronym as `str`. Element 2 must contain the output directory 
+        as `str`.
+    nproc: int, optional
+        Number of processes used to extract and convert the data.
+        (default 1)
+    storefile: str, optional
+        Name of the HDF5 expression store in every output directory. 
+        If None, one MINC file is written per experiment.
+        (default None)
+    manifest: str, optional
+        Name of the manifest CSV file, in the output directory of 
+        every experiment, in which to record its status.
+        (default None)
+    debug: bool, optional
+        Option to write the zip files to disk and keep the RAW files.
+        (default False)
+    stats: DownloadStats, optional
+        Statistics in which to record timings and counters.
+        (default None)
+    channels: list of str, optional
+        Channels to extract. If None, only the expression energy is 
+        extracted.
+        (default None)
+        
+    Returns
+    -------
+    missing: list of tuple
+        Experiments that were not found in the archive.
+    """
+    
+    stats = DownloadStats() if stats is None else stats
+    
+    lookup = {experiment[0]: experiment for experiment in experiments}
+    found = set()
     
+    if storefile is not None:
+        stores = {}
+        for outdir in {experiment[2] for experiment in experiments}:
+            store = open_store(outdir+storefile, channels = channels)
+            stores[outdir] = (store, get_store_index(store))
+            
+    #Bound the number of zip files read ahead of the workers
+    slots = threading.BoundedSemaphore(4*nproc)
+    
+    def tasks():
+        for experiment_id, content in iter_archive(archive, 
+                                                   set(lookup.keys()),
+                                                   stats):
+            slots.acquire()
+            found.add(experiment_id)
+            yield lookup[experiment_id], content
+    
+    import_data_partial = partial(import_data, debug = debug,
+                                  convert = storefile is None,
+                                  channels = channels)
+    
+    pool = mp.Pool(nproc)
+    
+    for result in tqdm(pool.imap_unordered(import_data_partial, tasks()),
+                       total = len(lookup)):
+        
+        slots.release()
+        
+        experiment, records, data, import_stats = result
+        experiment_id, gene, outdir = experiment
+        stats.merge(import_stats)
+        
+        if records is None:
+            store, index = stores[outdir]
+            records, store_stats = store_data(store, index, experiment, 
+                                              data, channels)
+            stats.merge(store_stats)
+            
+        update_manifest(get_manifest_path(experiment, manifest), records)
+        
+    pool.close()
+    pool.join()
+    
+    if storefile is not None:
+        for store, index in stores.values():
+            store.close()
+        
+    missing = [experiment for experiment in experiments 
+               if experiment[0] not in found]
     
+    return missing
+
+
 # Main -----------------------------------------------------------------------    
 
 def main():
 
     #Get command line arguments
     args = parse_args()
-    dataset = args['dataset']
+    datasets = args['dataset']
     outdir = args['outdir']
     metadata = args['metadata']
     parallel = True if args['parallel'] == 'true' else False
@@ -439,36 +2929,187 @@ def main():
                   .format(outdir))
         os.mkdir(outdir)
         
-    #If AMBA metadata file not found, download it from the web
-    if os.path.isfile(outdir+metadata) == False:
+    #Metadata files for every dataset
+    if metadata is None:
+        metadata = ['AMBA_metadata_{}.csv'.format(dataset) 
+                    for dataset in datasets]
+    elif len(metadata) != len(datasets):
+        raise Exception("Number of metadata files passed to --metadata "
+                        "must match the number of datasets passed to "
+                        "--dataset.")
+        
+    #Genes of interest
+    genes = read_genes(genes = args['genes'], homologs = args['homologs'])
+    
+    verify = True if args['verify'] == 'true' else False
+    channels = args['channels']
+    
+    experiments = []
+    experiment_ids = set()
+    for dataset, metadatafile in zip(datasets, metadata):
+        
+        #If AMBA metadata file not found, download it from the web
+        if os.path.isfile(outdir+metadatafile) == False:
+            if verbose:
+                print('Metadata file {} not found in {}. Fetching from API...'
+                      .format(metadatafile, outdir))
+            fetch_metadata(dataset = dataset,
+                           outdir = outdir,
+                           outfile = metadatafile,
+                           api_url = args['api_url'],
+                           retries = args['retries'],
+                           timeout = args['timeout'],
+                           verbose = verbose)
+            
+        #Import AMBA metadata
+        dfMetadata = pd.read_csv(outdir+metadatafile, index_col = None)
+        
+        #Filter metadata for genes of interest
+        if genes is not None:
+            nrows = dfMetadata.shape[0]
+            dfMetadata = (dfMetadata
+                          .loc[dfMetadata['gene'].isin(genes)]
+                          .reset_index(drop = True))
+            if verbose:
+                print('Keeping {} of {} {} experiments for the genes '
+                      'specified...'.format(dfMetadata.shape[0], nrows, 
+                                            dataset))
+        
+        #Remove experiments already listed in another dataset
+        dfMetadata = (dfMetadata
+                      .loc[~dfMetadata['experiment_id'].isin(experiment_ids)]
+                      .reset_index(drop = True))
+        experiment_ids.update(dfMetadata['experiment_id'])
+        
+        #Extract experiment IDs and gene names from metadata
+        nrows = dfMetadata.shape[0]
+        dataset_experiments = [(dfMetadata.loc[i, 'experiment_id'], 
+                                dfMetadata.loc[i, 'gene']) 
+                               for i in range(0, nrows)]
+        
+        #Create output sub-directory based on data set specified
+        dataset_outdir = os.path.join(outdir, dataset, '')
+        if os.path.exists(dataset_outdir) == False:
+            os.mkdir(dataset_outdir)
+    
+        #Skip experiments that were downloaded in a previous run
+        if args['store'] is None:
+            storefile = None
+        else:
+            storefile = dataset_outdir+args['store']
+        nexperiments = len(dataset_experiments)
+        dataset_experiments = get_pending_experiments(
+            experiments = dataset_experiments,
+            manifest = dataset_outdir+args['manifest'],
+            outdir = dataset_outdir,
+            verify = verify,
+            storefile = storefile,
+            channels = channels
+        )
+        
         if verbose:
-            print('Metadata file {} not found in {}. Fetching from API...'
-                  .format(metadata, outdir))
-        fetch_metadata(dataset = dataset,
-                       outdir = outdir,
-                       outfile = metadata,
-                       verbose = verbose)
-        
-    #Import AMBA metadata
-    dfMetadata = pd.read_csv(outdir+metadata, index_col = None)
-    
-    #Extract experiment IDs and gene names from metadata
-    nrows = dfMetadata.shape[0]
-    experiments = [(dfMetadata.loc[i, 'experiment_id'], dfMetadata.loc[i, 'gene']) 
-                   for i in range(0, nrows)]
-    
-    #Create output sub-directory based on data set specified
-    outdir = os.path.join(outdir, dataset, '')
-    if os.path.exists(outdir) == False:
-        os.mkdir(outdir)
+            print('{} of {} {} experiments already downloaded. '
+                  'Skipping them...'
+                  .format(nexperiments - len(dataset_experiments), 
+                          nexperiments, dataset))
+            
+        experiments.extend([(experiment_id, gene, dataset_outdir) 
+                            for experiment_id, gene in dataset_experiments])
 
     #Partial version of function for iteration
-    download_data_partial = partial(download_data, outdir = outdir)
+    manifest = args['manifest']
+    debug = True if args['debug'] == 'true' else False
+    adaptive = True if args['adaptive'] == 'true' else False
+    download_data_partial = partial(download_data, 
+                                    api_url = args['api_url'],
+                                    debug = debug,
+                                    retries = args['retries'],
+                                    backoff = args['backoff'],
+                                    timeout = args['timeout'],
+                                    channels = channels)
     
     if verbose:
-        print('Downloading {} AMBA dataset to: {}'.format(dataset, outdir))
+        print('Downloading {} AMBA dataset(s) to: {}'
+              .format(', '.join(datasets), outdir))
+        
+    #Start reporting progress periodically if requested
+    stats = DownloadStats()
+    if args['log_interval'] is not None:
+        stop = threading.Event()
+        logger = threading.Thread(target = log_progress,
+                                  args = (stats, args['log_interval'], stop),
+                                  daemon = True)
+        logger.start()
+        
+    if args['archive'] is not None:
+        
+        nproc = args['nproc'] if parallel else 1
+        
+        if verbose:
+            print('Importing experiments from archive {} on {} CPUs...'
+                  .format(args['archive'], nproc))
+            
+        missing = import_archive(archive = args['archive'],
+                                 experiments = experiments,
+                                 nproc = nproc,
+                                 storefile = args['store'],
+                                 manifest = manifest,
+                                 debug = debug,
+                                 stats = stats,
+                                 channels = channels)
+        
+        if verbose and (len(missing) > 0):
+            print('{} experiments not found in archive {}.'
+                  .format(len(missing), args['archive']))
+        
+    elif args['store'] is not None:
+        
+        if args['connections'] is not None:
+            connections = args['connections']
+        else:
+            connections = args['nproc'] if parallel else 1
+            adaptive = False
+            
+        if verbose:
+            print('Running {} concurrent downloads into store {}...'
+                  .format(connections, args['store']))
+            
+        download_data_store(experiments = experiments,
+                            storefile = args['store'],
+                            connections = connections,
+                            api_url = args['api_url'],
+                            manifest = manifest,
+                            debug = debug,
+                            adaptive = adaptive,
+                            retries = args['retries'],
+                            backoff = args['backoff'],
+                            timeout = args['timeout'],
+                            stats = stats,
+                            channels = channels)
         
-    if parallel:
+    elif args['connections'] is not None:
+        
+        connections = args['connections']
+        nproc = args['nproc'] if parallel else 1
+        
+        if verbose:
+            print('Running {} concurrent downloads with {} conversion '
+                  'processes...'.format(connections, nproc))
+            
+        download_data_threaded(experiments = experiments,
+                               connections = connections,
+                               nproc = nproc,
+                               api_url = args['api_url'],
+                               manifest = manifest,
+                               debug = debug,
+                               adaptive = adaptive,
+                               retries = args['retries'],
+                               backoff = args['backoff'],
+                               timeout = args['timeout'],
+                               stats = stats,
+                               channels = channels)
+        
+    elif parallel:
         
         nproc = args['nproc']
         pool = mp.Pool(nproc)
@@ -477,20 +3118,32 @@ def main():
             print('Running in parallel on {} CPUs...'.format(nproc))
         
         #Download data in parallel. Show progress bar.
-        results_tqdm = []
-        for result in tqdm(pool.imap(download_data_partial, experiments),
-                           total = len(experiments)):
-            results_tqdm.append(result)
+        results = pool.imap(download_data_partial, experiments)
+        for experiment in tqdm(experiments):
+            records, experiment_stats = next(results)
+            update_manifest(get_manifest_path(experiment, manifest), records)
+            stats.merge(experiment_stats)
             
         pool.close()
         pool.join()
         
     else:
         
-        experiments_tqdm = tqdm(experiments)
-        results = list(map(download_data_partial, experiments_tqdm))
+        for experiment in tqdm(experiments):
+            records, experiment_stats = download_data_partial(experiment)
+            update_manifest(get_manifest_path(experiment, manifest), records)
+            stats.merge(experiment_stats)
+            
+    if args['log_interval'] is not None:
+        stop.set()
+        logger.join()
+        
+    if args['stats'] is not None:
+        stats.write(args['stats'])
+        if verbose:
+            print('Download statistics written to: {}'.format(args['stats']))
         
     return
     
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,359 @@
+# ----------------------------------------------------------------------------
+# knn_imputation.py
+# Author: Antoine Beauchamp
+# Created: October 17th, 2026
+
+"""
+Blocked K-nearest neighbours imputation of expression data.
+
+Description
+-----------
+This module contains a multi-threaded float32 implementation of the
+K-nearest neighbours imputation of sklearn.impute.KNNImputer, with
+uniform weights and the NaN-aware Euclidean distance. Only the rows
+that contain missing values are imputed. These rows are processed in
+blocks, in parallel. For every block, the distances to all rows are
+computed as a tile of matrix products and every row is imputed from
+its nearest candidate donors. The candidate pool of a row is extended
+until it contains enough donors for every missing feature, so that the
+result matches KNNImputer up to floating point rounding and the order
+of tied neighbours.
+
+In approximate mode, the candidate donors are selected using the
+distances between the projections of the mean-imputed rows onto their
+leading principal components, rescaled by the fraction of present
+features. The candidates are then ranked by their NaN-aware Euclidean
+distance, and the pool is not extended.
+"""
+
+
+# Packages -------------------------------------------------------------------
+
+import numpy                as np
+from concurrent.futures     import ThreadPoolExecutor
+
+
+# Functions ------------------------------------------------------------------
+
+def get_principal_components(data, n_components, max_rows = 10000):
+
+    """
+    Compute the leading principal axes of a centred data set
+
+    Arguments
+    ---------
+    data: numpy.ndarray
+        Centred array of shape (samples, features).
+    n_components: int
+        Number of principal axes.
+    max_rows: int
+        Maximal number of evenly spaced rows used to estimate the
+        covariance. (default 10000)
+
+    Returns
+    -------
+    components: numpy.ndarray
+        Array of shape (features, n_components) containing the
+        principal axes.
+    """
+
+    step = max(1, int(np.ceil(len(data) / max_rows)))
+    sample = data[::step]
+    _, vectors = np.linalg.eigh(sample.T @ sample)
+    components = vectors[:, ::-1][:, :n_components]
+
+    return np.ascontiguousarray(components, dtype = 'float32')
+
+
+def nan_euclidean_tile(rows, features, nfeatures):
+
+    """
+    Compute squared NaN-aware Euclidean distances for a block of rows
+
+    Description
+    -----------
+    Equivalent to the square of
+    sklearn.metrics.pairwise.nan_euclidean_distances(). Missing values
+    are ignored and the sum of squares over the features present in
+    both rows is scaled up by the fraction of present features. The
+    distance between rows without common features is infinite.
+
+    Arguments
+    ---------
+    rows: numpy.ndarray
+        Indices of the rows in the block.
+    features: tuple of numpy.ndarray
+        Centred data with missing values set to 0, indicator of the
+        present values and squared centred data, as float32 arrays of
+        shape (samples, features).
+    nfeatures: int
+        Total number of features.
+
+    Returns
+    -------
+    dist: numpy.ndarray
+        Array of shape (len(rows), samples) containing the squared
+        distances.
+    """
+
+    data, present, squared = features
+
+    dist = squared[rows] @ present.T
+    dist += present[rows] @ squared.T
+    dist -= 2 * (data[rows] @ data.T)
+    np.maximum(dist, 0, out = dist)
+
+    common = present[rows] @ present.T
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        dist *= nfeatures / common
+    dist[common == 0] = np.inf
+
+    return dist
+
+
+def pool_nan_euclidean(rows, pool, data, observed):
+
+    """
+    Compute squared NaN-aware Euclidean distances to candidate donors
+
+    Arguments
+    ---------
+    rows: numpy.ndarray
+        Indices of the rows.
+    pool: numpy.ndarray
+        Array of shape (len(rows), candidates) containing the indices
+        of the candidate donors of every row.
+    data: numpy.ndarray
+        Centred data with missing values set to 0.
+    observed: numpy.ndarray
+        Boolean array indicating the present values of the data.
+
+    Returns
+    -------
+    dist: numpy.ndarray
+        Array of the same shape as `pool` containing the squared
+        distances.
+    """
+
+    common = observed[rows, np.newaxis] & observed[pool]
+    diff = np.where(common, data[rows, np.newaxis] - data[pool], 0)
+    sumsq = np.einsum('ijk,ijk->ij', diff, diff)
+
+    ncommon = common.sum(axis = 2)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        dist = sumsq * data.shape[1] / ncommon
+    dist[ncommon == 0] = np.inf
+
+    return dist
+
+
+def impute_rows(rows, dist, data, observed, missing, col_mean,
+                n_neighbors = 5, candidates = 32, exact = True,
+                max_gather = 2**26):
+
+    """
+    Impute the missing values of a block of rows from their neighbours
+
+    Description
+    -----------
+    Every row is imputed from its pool of nearest candidate donors. For
+    every missing feature, the `n_neighbors` nearest candidates in which
+    the feature is present are averaged. If `exact` is True and fewer
+    neighbours are found while other donors exist beyond the pool, the
+    pool is extended four-fold and the remaining features are imputed
+    again. Otherwise, the distances to the candidates are recomputed
+    with the NaN-aware Euclidean distance before they are ranked.
+    Features without any donor at a finite distance are imputed with
+    their mean.
+
+    Arguments
+    ---------
+    rows: numpy.ndarray
+        Indices of the rows to impute.
+    dist: numpy.ndarray
+        Array of shape (len(rows), samples) containing the distances
+        from the rows to all samples.
+    data: numpy.ndarray
+        Centred data with missing values set to 0.
+    observed: numpy.ndarray
+        Boolean array indicating the present values of the data.
+    missing: numpy.ndarray
+        Boolean array indicating the values to impute.
+    col_mean: numpy.ndarray
+        Mean of every feature.
+    n_neighbors: int
+        Number of neighbours. (default 5)
+    candidates: int
+        Initial size of the candidate pool. (default 32)
+    exact: bool
+        Option to extend the pool until all neighbours are found. If
+        False, `dist` is only used to select the candidates.
+        (default True)
+    max_gather: int
+        Maximal number of candidate values gathered at a time.
+        (default 2**26)
+
+    Returns
+    -------
+    values: list of tuple
+        Row index, feature indices and imputed values for every row.
+    """
+
+    nsamples = dist.shape[1]
+
+    #The row itself cannot donate its own missing values
+    dist[np.arange(len(rows)), rows] = np.inf
+
+    values = []
+    todo = np.arange(len(rows))
+    unresolved = missing[rows]
+    size = min(candidates, nsamples)
+    while len(todo) > 0:
+
+        #Pool of nearest candidates, sorted by distance
+        if size < nsamples:
+            pool = np.argpartition(dist[todo], size - 1, axis = 1)[:, :size]
+        else:
+            pool = np.broadcast_to(np.arange(nsamples), (len(todo), nsamples))
+        nrows = max(1, max_gather // (size * data.shape[1]))
+        if exact:
+            pool_dist = np.take_along_axis(dist[todo], pool, axis = 1)
+        else:
+            pool_dist = np.concatenate([
+                pool_nan_euclidean(rows[todo[i:i+nrows]], pool[i:i+nrows],
+                                   data, observed)
+                for i in range(0, len(todo), nrows)
+            ])
+        order = np.argsort(pool_dist, axis = 1, kind = 'stable')
+        pool = np.take_along_axis(pool, order, axis = 1)
+        pool_dist = np.take_along_axis(pool_dist, order, axis = 1)
+
+        #All donors at a finite distance are in an exhausted pool
+        exhausted = (~np.isfinite(pool_dist[:, -1]) | (size >= nsamples) |
+                     (not exact))
+
+        retry = []
+        for start in range(0, len(todo), nrows):
+
+            chunk = slice(start, start + nrows)
+            cols = np.flatnonzero(unresolved[todo[chunk]].any(axis = 0))
+            cand = pool[chunk]
+
+            #The first n_neighbors candidates with each feature present
+            present = (observed[cand[..., np.newaxis], cols] &
+                       np.isfinite(pool_dist[chunk])[..., np.newaxis])
+            selected = present & (np.cumsum(present, axis = 1,
+                                            dtype = 'int32') <= n_neighbors)
+            count = selected.sum(axis = 1)
+            total = np.where(selected, data[cand[..., np.newaxis], cols],
+                             0).sum(axis = 1, dtype = 'float64')
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                imputed = np.where(count > 0, total / count, 0) + col_mean[cols]
+
+            for i, j in enumerate(todo[chunk]):
+                need = unresolved[j, cols]
+                done = need & ((count[i] >= n_neighbors) |
+                               exhausted[start + i])
+                values.append((rows[j], cols[done], imputed[i, done]))
+                unresolved[j, cols[done]] = False
+                if (need & ~done).any():
+                    retry.append(j)
+
+        todo = np.array(retry, dtype = int)
+        size = min(size * 4, nsamples)
+
+    return values
+
+
+def knn_impute(data, n_neighbors = 5, nthreads = None, n_components = None,
+               candidates = 32, blocksize = 256):
+
+    """
+    Impute missing values using K-nearest neighbours
+
+    Description
+    -----------
+    Equivalent to sklearn.impute.KNNImputer with weights = 'uniform'
+    and metric = 'nan_euclidean', computed in float32. Rows with
+    missing values are processed in blocks of `blocksize` rows by a
+    pool of threads. Features that are missing in every row are left
+    missing, rather than being removed.
+
+    Arguments
+    ---------
+    data: numpy.ndarray
+        Array of shape (samples, features) containing missing values
+        as NaN.
+    n_neighbors: int
+        Number of neighbours. (default 5)
+    nthreads: int
+        Number of threads. (default None)
+    n_components: int
+        If specified, neighbours are searched approximately among the
+        candidates that are nearest in the space of this many principal
+        components of the mean-imputed rows. (default None)
+    candidates: int
+        Initial number of candidate donors per row. In approximate
+        mode, neighbours are only searched among these candidates.
+        (default 32)
+    blocksize: int
+        Number of rows per block. (default 256)
+
+    Returns
+    -------
+    imputed: numpy.ndarray
+        Imputed float32 array.
+    """
+
+    imputed = np.array(data, dtype = 'float32')
+    observed = ~np.isnan(imputed)
+    valid = observed.any(axis = 0)
+    missing = ~observed & valid
+    receivers = np.flatnonzero(missing.any(axis = 1))
+    if len(receivers) == 0:
+        return imputed
+
+    #Features are centred to limit rounding errors in the distances
+    counts = observed.sum(axis = 0)
+    col_mean = (np.where(observed, imputed, 0).sum(axis = 0, dtype = 'float64')
+                / np.maximum(counts, 1))
+    centred = np.where(observed, imputed - col_mean.astype('float32'),
+                       np.float32(0))
+
+    if n_components is None:
+        features = (centred, observed.astype('float32'), centred ** 2)
+        distance = lambda rows: nan_euclidean_tile(rows, features,
+                                                   imputed.shape[1])
+    else:
+        #Projections are scaled up by the fraction of present features,
+        #since missing values are set to the mean
+        projected = centred @ get_principal_components(centred,
+                                                       n_components)
+        scale = imputed.shape[1] / np.maximum(observed.sum(axis = 1), 1)
+        projected *= scale.astype('float32')[:, np.newaxis]
+        norms = (projected ** 2).sum(axis = 1)
+        def distance(rows):
+            dist = norms[rows, np.newaxis] + norms - 2 * (projected[rows] @
+                                                          projected.T)
+            return np.maximum(dist, 0, out = dist)
+
+    def impute_block(start):
+        rows = receivers[start:start+blocksize]
+        return impute_rows(rows = rows,
+                           dist = distance(rows),
+                           data = centred,
+                           observed = observed,
+                           missing = missing,
+                           col_mean = col_mean,
+                           n_neighbors = n_neighbors,
+                           candidates = candidates,
+                           exact = n_components is None)
+
+    with ThreadPoolExecutor(max_workers = nthreads) as executor:
+        blocks = executor.map(impute_block,
+                              range(0, len(receivers), blocksize))
+        for block in blocks:
+            for row, cols, values in block:
+                imputed[row, cols] = values
+
+    return imputed
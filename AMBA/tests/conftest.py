@@ -0,0 +1,22 @@
+# ----------------------------------------------------------------------------
+# conftest.py
+# Author: Antoine Beauchamp
+# Created: October 17th, 2026
+
+"""
+Configuration of the tests of the AMBA scripts.
+
+Description
+-----------
+The scripts import each other as top-level modules, so that their
+directory is added to the module search path.
+"""
+
+
+# Packages -------------------------------------------------------------------
+
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir)))
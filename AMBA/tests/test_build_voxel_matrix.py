@@ -0,0 +1,119 @@
+# ----------------------------------------------------------------------------
+# test_build_voxel_matrix.py
+# Author: Antoine Beauchamp
+# Created: October 17th, 2026
+
+"""
+Tests of the chunked construction of the voxel expression matrix.
+
+Description
+-----------
+The expression matrix built in chunks of experiments is compared to
+the voxel-wise average of the experiments of every gene computed with
+pandas, and its peak memory is compared to the budget used to size
+the chunks.
+"""
+
+
+# Packages -------------------------------------------------------------------
+
+import tracemalloc
+import numpy as np
+import pandas as pd
+import pytest
+
+try:
+    import build_voxel_matrix
+except (ImportError, OSError) as err:
+    pytest.skip("Cannot import build_voxel_matrix: {}".format(err),
+                allow_module_level = True)
+
+
+# Fixtures -------------------------------------------------------------------
+
+@pytest.fixture
+def experiments():
+
+    """Experiments with missing values, 1 to 5 per gene"""
+
+    rng = np.random.default_rng(0)
+    genes = np.repeat(['G{:02d}'.format(i) for i in range(12)],
+                      rng.integers(1, 6, 12))
+    rng.shuffle(genes)
+    data = rng.random((len(genes), 50), dtype = 'float32') + 1
+    data[rng.random(data.shape) < 0.4] = np.nan
+    data[3] = np.nan
+
+    return data, genes
+
+
+def import_rows(data):
+
+    """Create a chunk importer for an array of experiments"""
+
+    def importChunk(rows):
+        arrays = data[rows]
+        return arrays, ~np.isnan(arrays).all(axis = 1)
+
+    return importChunk
+
+
+# Tests ----------------------------------------------------------------------
+
+@pytest.mark.parametrize('group_experiments', [True, False])
+def test_build_expression_matrix_chunked(experiments, tmp_path,
+                                         group_experiments):
+
+    data, genes = experiments
+    outfile = str(tmp_path/'matrix.csv')
+
+    nrows = build_voxel_matrix.buildExpressionMatrixChunked(
+        importChunk = import_rows(data),
+        genes = genes,
+        nvoxels = data.shape[1],
+        outfile = outfile,
+        log_transform = False,
+        group_experiments = group_experiments,
+        threshold = 0.5,
+        chunksize = 4,
+        verbose = False
+    )
+
+    expected = pd.DataFrame(data, index = pd.Index(genes, name = 'Gene'))
+    if group_experiments:
+        expected = expected.groupby('Gene').mean()
+    expected = expected.loc[expected.isna().mean(axis = 1) < 0.5]
+    expression = pd.read_csv(outfile, index_col = 'Gene')
+
+    assert nrows == len(expected)
+    assert expression.index.tolist() == expected.index.tolist()
+    np.testing.assert_allclose(expression.to_numpy(), expected.to_numpy(),
+                               rtol = 1e-6)
+
+
+def test_build_expression_matrix_chunked_memory(tmp_path, monkeypatch):
+
+    #Formatting the CSV file uses a buffer of fixed size
+    monkeypatch.setattr(pd.DataFrame, 'to_csv', lambda *args, **kwargs: None)
+
+    nvoxels, chunksize = 20000, 32
+    data = np.ones((4*chunksize, nvoxels), dtype = 'float32')
+    genes = ['G{:03d}'.format(i) for i in range(len(data))]
+
+    tracemalloc.start()
+    try:
+        build_voxel_matrix.buildExpressionMatrixChunked(
+            importChunk = import_rows(data),
+            genes = genes,
+            nvoxels = nvoxels,
+            outfile = str(tmp_path/'matrix.csv'),
+            group_experiments = False,
+            chunksize = chunksize,
+            verbose = False
+        )
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    budget = build_voxel_matrix.CHUNK_BYTES_PER_VOXEL * chunksize * nvoxels
+    assert peak <= budget
@@ -0,0 +1,253 @@
+# ----------------------------------------------------------------------------
+# test_download_AMBA.py
+# Author: Antoine Beauchamp
+# Created: October 17th, 2026
+
+"""
+Tests of the threaded AMBA downloader.
+
+Description
+-----------
+The grid data archives of the experiments are served by a local HTTP
+server, which records every request and can fail requests to test
+retries and the resumption of failed downloads. The experiments are
+downloaded to the expression store.
+"""
+
+
+# Packages -------------------------------------------------------------------
+
+import io
+import threading
+import http.server
+import numpy as np
+import pandas as pd
+import pytest
+from types          import SimpleNamespace
+from urllib.parse   import unquote
+from zipfile        import ZipFile
+
+try:
+    import download_AMBA
+except (ImportError, OSError) as err:
+    pytest.skip("Cannot import download_AMBA: {}".format(err),
+                allow_module_level = True)
+
+
+# Fixtures -------------------------------------------------------------------
+
+def make_handler(routes, log):
+
+    """
+    Create a request handler serving fixed responses
+
+    Arguments
+    ---------
+    routes: dict
+        Dictionary with URL paths, with or without their query string,
+        as keys and dictionaries with keys 'body', and optionally 
+        'fail', as values. If 'fail' is non-zero, that many requests
+        are answered with status 503.
+    log: list
+        List to which the path of every request is appended.
+
+    Returns
+    -------
+    handler: type
+        Subclass of http.server.BaseHTTPRequestHandler.
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+
+            log.append(self.path)
+            route = routes.get(self.path, 
+                               routes.get(self.path.split('?')[0]))
+            if route is None:
+                status, body = 404, b''
+            elif route.get('fail', 0) > 0:
+                route['fail'] -= 1
+                status, body = 503, b''
+            else:
+                status, body = 200, route['body']
+
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+@pytest.fixture
+def server():
+
+    """Local HTTP server, with its URL, routes and request log"""
+
+    routes, log = {}, []
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                            make_handler(routes, log))
+    httpd.daemon_threads = True
+    thread = threading.Thread(target = httpd.serve_forever, daemon = True)
+    thread.start()
+
+    yield SimpleNamespace(url = 'http://127.0.0.1:{}'.format(httpd.server_port),
+                          routes = routes,
+                          log = log)
+
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def add_experiment(server, experiment_id, channels = ('energy',)):
+
+    """Serve the grid data archive of an experiment"""
+
+    rng = np.random.default_rng(experiment_id)
+    volumes = {channel: rng.random(58*41*67, dtype = 'float32')
+               for channel in channels}
+
+    buffer = io.BytesIO()
+    with ZipFile(buffer, 'w') as archive:
+        for channel, volume in volumes.items():
+            archive.writestr(channel+'.raw', volume.astype('<f4').tobytes())
+
+    path = '/grid_data/download/{}'.format(experiment_id)
+    server.routes[path] = {'body': buffer.getvalue()}
+
+    return path, volumes
+
+
+def get_store_row(storefile, experiment_id, channel = 'energy'):
+
+    """Import the row of an experiment from the expression store"""
+
+    store = download_AMBA.open_store(storefile)
+    index = download_AMBA.get_store_index(store)
+    row = store[channel][index[experiment_id]]
+    store.close()
+
+    return row
+
+
+# Tests ----------------------------------------------------------------------
+
+def test_request_url_retries_throttled_requests(server):
+
+    path, _ = add_experiment(server, 1)
+    server.routes[path]['fail'] = 2
+
+    response = download_AMBA.request_url(server.url+path, retries = 2,
+                                         backoff = 0, timeout = 5)
+
+    assert response.status_code == 200
+    assert server.log == [path]*3
+
+
+def test_request_url_raises_after_retries(server):
+
+    path, _ = add_experiment(server, 1)
+    server.routes[path]['fail'] = 2
+
+    with pytest.raises(download_AMBA.requests.HTTPError):
+        download_AMBA.request_url(server.url+path, retries = 1,
+                                  backoff = 0, timeout = 5)
+
+
+def test_download_data_store(server, tmp_path):
+
+    outdir = str(tmp_path)+'/'
+    _, volumes_A = add_experiment(server, 1)
+    _, volumes_B = add_experiment(server, 2)
+    add_experiment(server, 3, channels = ('density',))
+    experiments = [(1, 'A', outdir), (2, 'B', outdir), (3, 'C', outdir)]
+
+    download_AMBA.download_data_store(experiments, 'store.h5',
+                                      connections = 2,
+                                      api_url = server.url,
+                                      manifest = 'manifest.csv')
+
+    for experiment_id, volumes in [(1, volumes_A), (2, volumes_B)]:
+        expected = (download_AMBA
+                    .reorient_to_standard(volumes['energy']
+                                          .reshape((58, 41, 67)))
+                    .ravel())
+        row = get_store_row(outdir+'store.h5', experiment_id)
+        np.testing.assert_array_equal(row, expected)
+
+    df_manifest = (download_AMBA.read_manifest(outdir+'manifest.csv')
+                   .set_index('experiment_id'))
+    assert df_manifest.loc[[1, 2, 3], 'status'].tolist() == ['complete',
+                                                             'complete',
+                                                             'no_data']
+
+
+def test_download_data_store_skips_recorded_experiments(server, tmp_path):
+
+    outdir = str(tmp_path)+'/'
+    path, _ = add_experiment(server, 1)
+    add_experiment(server, 2)
+    server.routes[path]['fail'] = 1
+    experiments = [(1, 'A'), (2, 'B')]
+    manifest = outdir+'manifest.csv'
+    storefile = outdir+'store.h5'
+
+    #Experiment 1 fails in the first run
+    download_AMBA.download_data_store([e+(outdir,) for e in experiments],
+                                      'store.h5', connections = 2,
+                                      api_url = server.url,
+                                      manifest = 'manifest.csv')
+    pending = download_AMBA.get_pending_experiments(experiments, manifest,
+                                                    outdir,
+                                                    storefile = storefile)
+    assert pending == [(1, 'A')]
+
+    #Only the failed experiment is downloaded again
+    del server.log[:]
+    download_AMBA.download_data_store([e+(outdir,) for e in pending],
+                                      'store.h5', connections = 2,
+                                      api_url = server.url,
+                                      manifest = 'manifest.csv')
+    assert server.log == [path]
+    assert download_AMBA.get_pending_experiments(experiments, manifest,
+                                                 outdir,
+                                                 storefile = storefile,
+                                                 verify = True) == []
+
+    #Corrupted rows are only detected when verifying checksums
+    store = download_AMBA.open_store(storefile)
+    index = download_AMBA.get_store_index(store)
+    store['energy'][index[2], 0] += 1
+    store.close()
+    assert download_AMBA.get_pending_experiments(experiments, manifest,
+                                                 outdir,
+                                                 storefile = storefile) == []
+    assert download_AMBA.get_pending_experiments(experiments, manifest,
+                                                 outdir,
+                                                 storefile = storefile,
+                                                 verify = True) == [(2, 'B')]
+
+
+def test_fetch_metadata_uses_api_url(server, tmp_path):
+
+    outdir = str(tmp_path)+'/'
+    table = ('experiment_id,gene\n1,A\n2,B\n2,B\n').encode()
+    path = '/api/v2/data/SectionDataSet/query.csv'
+    server.routes[path] = {'body': table, 'fail': 1}
+
+    download_AMBA.fetch_metadata(dataset = 'coronal', outdir = outdir,
+                                 outfile = 'AMBA_metadata_coronal.csv',
+                                 api_url = server.url, retries = 1,
+                                 timeout = 5, verbose = False)
+
+    assert len(server.log) == 2
+    assert server.log[0].startswith(path+'?')
+    assert 'plane_of_section[name$eqcoronal]' in unquote(server.log[0])
+    df_metadata = pd.read_csv(outdir+'AMBA_metadata_coronal.csv')
+    assert df_metadata['experiment_id'].tolist() == [1, 2]
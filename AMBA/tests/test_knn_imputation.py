@@ -0,0 +1,81 @@
+# ----------------------------------------------------------------------------
+# test_knn_imputation.py
+# Author: Antoine Beauchamp
+# Created: October 17th, 2026
+
+"""
+Tests of the blocked K-nearest neighbours imputation.
+
+Description
+-----------
+The imputation engine in knn_imputation.py is compared to
+sklearn.impute.KNNImputer on small random data sets.
+"""
+
+
+# Packages -------------------------------------------------------------------
+
+import numpy as np
+import pytest
+from sklearn.impute     import KNNImputer
+from knn_imputation     import knn_impute
+
+
+# Fixtures -------------------------------------------------------------------
+
+@pytest.fixture
+def data():
+
+    """Low-rank data with 30% missing values and an empty feature"""
+
+    rng = np.random.default_rng(0)
+    data = (rng.normal(size = (300, 3)) @ rng.normal(size = (3, 25)) +
+            0.1 * rng.normal(size = (300, 25)))
+    data[rng.random(data.shape) < 0.3] = np.nan
+    data[:, 4] = np.nan
+
+    return data
+
+
+# Tests ----------------------------------------------------------------------
+
+@pytest.mark.parametrize('candidates', [4, 32])
+def test_knn_impute_matches_knnimputer(data, candidates):
+
+    #KNNImputer removes features without any value
+    valid = ~np.isnan(data).all(axis = 0)
+    reference = KNNImputer(n_neighbors = 5).fit_transform(data)
+
+    imputed = knn_impute(data, n_neighbors = 5, nthreads = 2,
+                         candidates = candidates, blocksize = 16)
+
+    assert imputed.dtype == np.float32
+    assert np.isnan(imputed[:, ~valid]).all()
+    np.testing.assert_allclose(imputed[:, valid], reference,
+                               rtol = 0, atol = 1e-5)
+
+
+def test_knn_impute_approximate_keeps_observed_values(data):
+
+    valid = ~np.isnan(data).all(axis = 0)
+    observed = ~np.isnan(data)
+
+    imputed = knn_impute(data, n_components = 3, nthreads = 2,
+                         candidates = 32, blocksize = 16)
+
+    assert not np.isnan(imputed[:, valid]).any()
+    np.testing.assert_array_equal(imputed[observed],
+                                  data[observed].astype('float32'))
+
+    #Imputed values are close to those of KNNImputer on low-rank data
+    reference = KNNImputer(n_neighbors = 5).fit_transform(data)
+    missing = ~observed[:, valid]
+    diff = np.abs(imputed[:, valid][missing] - reference[missing])
+    assert np.median(diff) < 1e-3
+
+
+def test_knn_impute_without_missing_values():
+
+    data = np.arange(12, dtype = 'float64').reshape((4, 3))
+
+    np.testing.assert_array_equal(knn_impute(data), data)
@@ -20,7 +20,8 @@ source activate_venv.sh
 # Download AHBA data from the web
 echo "Downloading AHBA data..."
 python3 AHBA/download_AHBA.py \
-	--outdir AHBA/data/
+	--outdir AHBA/data/ \
+	--connections 6
 
 # Build sample expression matrix
 echo "Building human gene-by-sample expression matrix..." 
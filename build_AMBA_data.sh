@@ -8,17 +8,17 @@
 #
 # Pipeline steps:
 # 1. Resample DSURQE imaging files from its common space to CCFv3. 
-# 2. Download the AMBA coronal in-situ hybridization data set from the web
-# 3. Download the AMBA sagittal in-situ hybridization data set from the web
-# 4. Build a gene-by-voxel expression matrix using the coronal data set with 
+# 2. Download the AMBA coronal and sagittal in-situ hybridization data sets 
+#    from the web
+# 3. Build a gene-by-voxel expression matrix using the coronal data set with 
 #    a bilateral coronal imaging mask
-# 5. Build a gene-by-voxel expression matrix using the coronal data set with 
+# 4. Build a gene-by-voxel expression matrix using the coronal data set with 
 #    a unilateral sagittal imaging mask
-# 6. Build a gene-by-voxel expression matrix using the sagittal data set with 
+# 5. Build a gene-by-voxel expression matrix using the sagittal data set with 
 #    a unilateral sagittal imaging mask
-# 7. Build a gene-by-region expression matrix from the coronal voxel-wise 
+# 6. Build a gene-by-region expression matrix from the coronal voxel-wise 
 #    expression matrix using the DSURQE atlas.
-# 8. Build a gene expression tree by combining the coronal voxel-wise
+# 7. Build a gene expression tree by combining the coronal voxel-wise
 #    expression matrix with the AMBA hierarchical ontology. 
 
 # On MICe machines
@@ -28,22 +28,15 @@
 # Activate the python virtual environment
 source activate_venv.sh
 
-# Download AHBA data from the web
-echo "Downloading AMBA coronal in-situ hybridization data set..."
-python3 AMBA/download_AMBA.py \
-	--dataset coronal \
-	--outdir AMBA/data/expression/ \
-	--metadata AMBA_metadata_coronal.csv \
-	--parallel true \
-	--nproc 12
-
-# echo "Downloading AMBA sagittal in-situ hybridization data set..."
+# Download AMBA data from the web
+echo "Downloading AMBA coronal and sagittal in-situ hybridization data sets..."
 python3 AMBA/download_AMBA.py \
-	--dataset sagittal \
+	--dataset coronal sagittal \
 	--outdir AMBA/data/expression/ \
-	--metadata AMBA_metadata_sagittal.csv \
+	--metadata AMBA_metadata_coronal.csv AMBA_metadata_sagittal.csv \
 	--parallel true \
-	--nproc 12
+	--nproc 12 \
+	--connections 50
 
 # Build voxel expression matrix 
 echo "Building mouse gene-by-voxel expression matrix using coronal data with coronal mask..."